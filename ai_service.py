@@ -1,13 +1,129 @@
-import openai
 import json
 import base64
-from config import OPENAI_API_KEY
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from config import OPENAI_API_KEY, OPENAI_BASE_URL, AI_TIMEOUT, AI_TIMEOUTS, AI_FALLBACK_CACHE_SIZE, WARDROBE_PROMPT_CACHE_SIZE
+import metrics
+from usage import QuotaExceededError
+from tracing import tracer
+from resilience import ResilientCaller, CircuitOpenError, ConcurrencyLimitError
+
+# Shown when the AI can't come up with suggestions
+FALLBACK_SUGGESTIONS = (
+    "Casual Weekend Look: Comfortable and relaxed style",
+    "Professional Office Outfit: Clean and business-appropriate",
+    "Evening Party Ensemble: Elegant and stylish",
+    "Comfortable Home Style: Cozy and practical",
+    "Smart Casual Look: Balanced between formal and relaxed"
+)
+
+def _item_fields(item):
+    """(id, name, category, description) of a clothing item in either the dictionary or the old tuple format"""
+    if isinstance(item, dict):
+        return item.get('id'), item['name'], item['category'], item['description']
+    return item[0], item[2], item[3], item[4]
 
 class AIService:
-    def __init__(self):
-        self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    def __init__(self, usage=None, resilience=None):
+        self.usage = usage
+        self.resilience = resilience or ResilientCaller("openai")
+        self._client = None
+        self._client_lock = threading.Lock()
+        
+        # Last good response per request, served while OpenAI is failing
+        self._fallbacks = OrderedDict()
+        self._fallbacks_lock = threading.Lock()
+        
+        # Rendered wardrobe prompt sections, by wardrobe version
+        self._wardrobe_blocks = OrderedDict()
+        self._wardrobe_blocks_lock = threading.Lock()
+    
+    @property
+    def client(self):
+        """OpenAI client, created on first use since importing openai is slow"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import openai
+                    # Retries are done by self.resilience, with jitter and a circuit breaker
+                    self._client = openai.OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+        return self._client
+    
+    def _create(self, method, model, timeout, kwargs):
+        """Send one chat completion request, recording its latency"""
+        start = time.perf_counter()
+        try:
+            return self.client.chat.completions.create(timeout=timeout, **kwargs)
+        except Exception:
+            metrics.AI_REQUEST_ERRORS.inc(method=method, model=model)
+            raise
+        finally:
+            metrics.AI_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, model=model)
+    
+    def _fallback_key(self, method, kwargs):
+        request = json.dumps(kwargs, sort_keys=True, default=str)
+        return method, hashlib.sha256(request.encode("utf-8")).hexdigest()
     
-    def analyze_clothing_photo(self, photo_path):
+    def _remember(self, key, response):
+        with self._fallbacks_lock:
+            self._fallbacks[key] = response
+            self._fallbacks.move_to_end(key)
+            while len(self._fallbacks) > AI_FALLBACK_CACHE_SIZE:
+                self._fallbacks.popitem(last=False)
+    
+    def _complete(self, method, user_id=None, **kwargs):
+        """Create a chat completion, recording its latency and token usage under the calling method
+        
+        Requests go through the resilience layer (per-method timeout, retries,
+        circuit breaker, concurrency limit, hedging). When they still fail, the
+        last good answer to the same request is returned if there is one;
+        otherwise the error propagates to the caller's own fallback.
+        Raises QuotaExceededError without calling OpenAI when the user is over a limit.
+        """
+        if self.usage:
+            self.usage.check(user_id)
+        
+        model = kwargs.get("model")
+        timeout = AI_TIMEOUTS.get(method, AI_TIMEOUT)
+        key = self._fallback_key(method, kwargs)
+        with tracer.span(f"ai.{method}", model=model) as span:
+            try:
+                response = self.resilience.call(
+                    lambda request_timeout: self._create(method, model, request_timeout, kwargs),
+                    timeout, method=method)
+            except Exception as e:
+                with self._fallbacks_lock:
+                    cached = self._fallbacks.get(key)
+                metrics.cache_result("ai_fallback", cached is not None)
+                if cached is None:
+                    raise
+                reason = ("circuit_open" if isinstance(e, CircuitOpenError)
+                          else "concurrency" if isinstance(e, ConcurrencyLimitError) else "error")
+                metrics.AI_FALLBACKS.inc(method=method, reason=reason)
+                span.set("fallback", reason)
+                return cached
+            
+            self._remember(key, response)
+            usage = getattr(response, "usage", None)
+            if usage:
+                # Prompt tokens served from OpenAI's prompt cache, billed at a discount
+                details = getattr(usage, "prompt_tokens_details", None)
+                cached_tokens = getattr(details, "cached_tokens", None) or 0
+                span.set("prompt_tokens", usage.prompt_tokens)
+                span.set("cached_tokens", cached_tokens)
+                span.set("completion_tokens", usage.completion_tokens)
+        
+        if usage:
+            metrics.AI_TOKENS.inc(usage.prompt_tokens or 0, method=method, model=model, kind="prompt")
+            metrics.AI_TOKENS.inc(cached_tokens, method=method, model=model, kind="cached_prompt")
+            metrics.AI_TOKENS.inc(usage.completion_tokens or 0, method=method, model=model, kind="completion")
+            if self.usage:
+                self.usage.record(user_id, method, usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        return response
+    
+    def analyze_clothing_photo(self, photo_path, user_id=None):
         """Analyze a clothing item from photo file"""
         try:
             # Read and encode the image
@@ -41,7 +157,9 @@ class AIService:
             Be specific and accurate in your analysis.
             """
             
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                "analyze_clothing_photo",
+                user_id=user_id,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a fashion expert. Analyze clothing items from photos and provide detailed, accurate information. Always preserve full names with brands and details."},
@@ -87,6 +205,8 @@ class AIService:
             
             return result
             
+        except QuotaExceededError:
+            raise
         except Exception as e:
             print(f"Error analyzing clothing photo: {e}")
             return {
@@ -97,11 +217,11 @@ class AIService:
                 "tags": ["unknown"]
             }
     
-    def analyze_photo(self, photo_path):
+    def analyze_photo(self, photo_path, user_id=None):
         """Alias for analyze_clothing_photo"""
-        return self.analyze_clothing_photo(photo_path)
+        return self.analyze_clothing_photo(photo_path, user_id=user_id)
     
-    def analyze_text_description(self, description):
+    def analyze_text_description(self, description, user_id=None):
         """Analyze a clothing item from text description"""
         prompt = f"""
         Analyze this clothing description and provide detailed information:
@@ -133,7 +253,9 @@ class AIService:
         """
         
         try:
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                "analyze_text_description",
+                user_id=user_id,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a fashion expert. Analyze clothing descriptions and provide detailed, accurate information. Always preserve full names with brands and details. Return only valid JSON."},
@@ -255,6 +377,8 @@ class AIService:
                     "tags": ["clothing", "item"]
                 }
             
+        except QuotaExceededError:
+            raise
         except Exception as e:
             print(f"Error analyzing description: {e}")
             # Use corrected original description as fallback
@@ -291,21 +415,60 @@ class AIService:
                 "tags": ["clothing", "item"]
             }
     
-    def generate_outfit(self, user_clothes, user_request, user_preferences=None):
-        """Generate an outfit based on user's clothes and request"""
+    def cached_wardrobe_prompts(self):
+        """Number of rendered wardrobe prompt sections held in memory"""
+        return len(self._wardrobe_blocks)
+    
+    def _render_wardrobe(self, clothes):
+        items = sorted((_item_fields(item) for item in clothes), key=lambda fields: fields[0] or 0)
+        return "\n".join(f"- {name} ({category}): {description}" for _, name, category, description in items)
+    
+    def _format_wardrobe(self, clothes, wardrobe_version=None):
+        """Prompt lines listing the clothing items, memoized per wardrobe version
         
-        # Format user's clothes for the prompt
-        clothes_info = []
-        for item in user_clothes:
-            # Handle both old tuple format and new dictionary format
-            if isinstance(item, dict):
-                # New dictionary format
-                clothes_info.append(f"- {item['name']} ({item['category']}): {item['description']}")
-            else:
-                # Old tuple format (fallback)
-                clothes_info.append(f"- {item[2]} ({item[3]}): {item[4]}")
+        Items are listed in id order rather than the order they were passed
+        in, so the same wardrobe always renders the same text and newly added
+        items go at the end. The prompt up to and including the wardrobe then
+        stays identical between requests, which is what OpenAI's prompt
+        caching matches on. Versions are unique across users, so pass one
+        only with that version's whole wardrobe; without one the text is
+        rendered every time, e.g. for a subset picked for one request.
+        """
+        if wardrobe_version is None:
+            return self._render_wardrobe(clothes)
         
-        clothes_text = "\n".join(clothes_info)
+        with self._wardrobe_blocks_lock:
+            text = self._wardrobe_blocks.get(wardrobe_version)
+            if text is not None:
+                self._wardrobe_blocks.move_to_end(wardrobe_version)
+        metrics.cache_result("wardrobe_prompt", text is not None)
+        if text is not None:
+            return text
+        
+        text = self._render_wardrobe(clothes)
+        with self._wardrobe_blocks_lock:
+            self._wardrobe_blocks[wardrobe_version] = text
+            while len(self._wardrobe_blocks) > WARDROBE_PROMPT_CACHE_SIZE:
+                self._wardrobe_blocks.popitem(last=False)
+        return text
+    
+    def _format_combinations(self, combinations):
+        """Prompt section listing pre-scored item combinations, or an empty string"""
+        if not combinations:
+            return ""
+        lines = [f"- {' + '.join(item['name'] for item in combination)}" for combination in combinations]
+        return "Combinations from this wardrobe that are known to work well together:\n" + "\n".join(lines)
+    
+    def generate_outfit(self, user_clothes, user_request, user_preferences=None, combinations=None,
+                        wardrobe_version=None, user_id=None):
+        """Generate an outfit based on user's clothes and request
+        
+        The prompt puts what stays the same for a wardrobe first and the
+        request last, so repeated requests share a cached prompt prefix.
+        """
+        
+        # Format user's clothes for the prompt
+        clothes_text = self._format_wardrobe(user_clothes, wardrobe_version)
         
         # Format user preferences
         preferences_text = ""
@@ -318,14 +481,7 @@ class AIService:
             """
         
         prompt = f"""
-        Create a stylish outfit based on the user's request and available clothing items.
-        
-        User Request: {user_request}
-        
-        Available Clothing Items:
-        {clothes_text}
-        
-        {preferences_text}
+        Create a stylish outfit from the available clothing items for the user's request, given at the end.
         
         Please provide a JSON response with the following structure:
         {{
@@ -342,12 +498,24 @@ class AIService:
         }}
         
         Make sure the outfit is practical, stylish, and matches the user's request.
+        Start from one of the known combinations when it fits the request.
         Only use items from the available clothing list.
         Return only the names of the items, not descriptions.
+        
+        Available Clothing Items:
+        {clothes_text}
+        
+        {self._format_combinations(combinations)}
+        
+        {preferences_text}
+        
+        User Request: {user_request}
         """
         
         try:
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                "generate_outfit",
+                user_id=user_id,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a professional fashion stylist. Create stylish, practical outfits based on available clothing items and user preferences."},
@@ -363,6 +531,8 @@ class AIService:
             
             return json.loads(json_str)
             
+        except QuotaExceededError:
+            raise
         except Exception as e:
             print(f"Error generating outfit: {e}")
             return {
@@ -370,31 +540,29 @@ class AIService:
                 "styling_tips": ["Keep it simple and comfortable"]
             }
     
-    def suggest_outfit_improvements(self, current_outfit, user_clothes):
+    def suggest_outfit_improvements(self, current_outfit, user_clothes, wardrobe_version=None, user_id=None):
         """Suggest improvements to an existing outfit"""
         
-        clothes_info = []
-        for item in user_clothes:
-            clothes_info.append(f"- {item[2]} ({item[3]}): {item[4]}")
-        
-        clothes_text = "\n".join(clothes_info)
+        clothes_text = self._format_wardrobe(user_clothes, wardrobe_version)
         
         prompt = f"""
-        Suggest improvements to this outfit:
-        
-        Current Outfit: {current_outfit}
-        
-        Available Clothing Items:
-        {clothes_text}
+        Suggest improvements to the user's current outfit, given at the end.
         
         Please provide suggestions for:
         1. Alternative items that might work better
         2. Additional accessories that could enhance the look
         3. Styling tips for the current combination
+        
+        Available Clothing Items:
+        {clothes_text}
+        
+        Current Outfit: {current_outfit}
         """
         
         try:
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                "suggest_outfit_improvements",
+                user_id=user_id,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a professional fashion stylist. Provide helpful suggestions for improving outfits."},
@@ -405,32 +573,21 @@ class AIService:
             
             return response.choices[0].message.content
             
+        except QuotaExceededError:
+            raise
         except Exception as e:
             print(f"Error suggesting improvements: {e}")
             return "Keep it simple and comfortable!"
     
-    def generate_outfit_suggestions(self, user_clothes):
+    def generate_outfit_suggestions(self, user_clothes, combinations=None, wardrobe_version=None, user_id=None):
         """Generate general outfit suggestions based on user's wardrobe"""
         
         # Format user's clothes for the prompt
-        clothes_info = []
-        for item in user_clothes:
-            # Handle both old tuple format and new dictionary format
-            if isinstance(item, dict):
-                # New dictionary format
-                clothes_info.append(f"- {item['name']} ({item['category']}): {item['description']}")
-            else:
-                # Old tuple format (fallback)
-                clothes_info.append(f"- {item[2]} ({item[3]}): {item[4]}")
-        
-        clothes_text = "\n".join(clothes_info)
+        clothes_text = self._format_wardrobe(user_clothes, wardrobe_version)
         
         prompt = f"""
         Based on the user's wardrobe, suggest 5 different outfit combinations.
         
-        Available Clothing Items:
-        {clothes_text}
-        
         Please provide 5 outfit suggestions in this format:
         1. [Outfit Name]: [Brief description of the combination]
         2. [Outfit Name]: [Brief description of the combination]
@@ -439,10 +596,17 @@ class AIService:
         5. [Outfit Name]: [Brief description of the combination]
         
         Make the suggestions diverse, practical, and stylish.
+        
+        Available Clothing Items:
+        {clothes_text}
+        
+        {self._format_combinations(combinations)}
         """
         
         try:
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                "generate_outfit_suggestions",
+                user_id=user_id,
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a professional fashion stylist. Create diverse, practical outfit suggestions based on available clothing items."},
@@ -457,12 +621,8 @@ class AIService:
             
             return suggestions
             
+        except QuotaExceededError:
+            raise
         except Exception as e:
             print(f"Error generating outfit suggestions: {e}")
-            return [
-                "Casual Weekend Look: Comfortable and relaxed style",
-                "Professional Office Outfit: Clean and business-appropriate",
-                "Evening Party Ensemble: Elegant and stylish",
-                "Comfortable Home Style: Cozy and practical",
-                "Smart Casual Look: Balanced between formal and relaxed"
-            ] 
\ No newline at end of file
+            return list(FALLBACK_SUGGESTIONS) 
\ No newline at end of file
@@ -0,0 +1,376 @@
+"""
+Online backups of the database shards and photos
+
+The bot takes snapshots on its own every BACKUP_INTERVAL seconds, and
+admins can take one with /backup. Snapshots taken from here are safe while
+the bot runs, except during a /rebalance; restoring needs the bot stopped.
+
+Usage:
+    python backup.py snapshot
+    python backup.py list
+    python backup.py verify [NAME] [--deep]
+    python backup.py restore NAME
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from config import (BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES, BACKUP_STEP_PAUSE, BACKUP_MAX_RESTARTS, PHOTOS_DIR)
+from database import Database, shard_path
+
+MANIFEST = "manifest.json"
+PHOTO_MANIFEST = "photos.json"
+
+class BackupError(Exception):
+    """Raised when a snapshot is missing, or fails verification before a restore"""
+
+class _TooManyRestarts(Exception):
+    pass
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_database(source_path, destination, pages=BACKUP_PAGES, pause=BACKUP_STEP_PAUSE, max_restarts=BACKUP_MAX_RESTARTS):
+    """Copy a live SQLite database with the online backup API; returns how often the copy restarted
+    
+    Pages are copied `pages` at a time with a pause in between, each step a
+    short read transaction, so checkpoints keep running and the disk isn't
+    saturated. A write between steps restarts the copy from the start; after
+    max_restarts the copy is done in one step instead, a single read
+    transaction that writers in WAL mode don't wait for.
+    """
+    temp_path = destination + ".part"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    
+    restarts = 0
+    last_remaining = None
+    
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _TooManyRestarts()
+        last_remaining = remaining
+        if pause:
+            time.sleep(pause)
+    
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(temp_path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            source.backup(target)
+        # One self-contained file, without a write-ahead log next to it
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    
+    os.replace(temp_path, destination)
+    return restarts
+
+def check_database(path):
+    """Integrity check and row counts of a backed up database file; raises BackupError if it's damaged"""
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA quick_check').fetchone()[0]
+        if result != 'ok':
+            raise BackupError(f"{os.path.basename(path)} failed its integrity check: {result}")
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('users', 'clothes', 'outfits')}
+    finally:
+        conn.close()
+    return {"bytes": os.path.getsize(path), **counts}
+
+class BackupManager:
+    """Consistent snapshots of every shard, plus an incremental copy of the photos
+    
+    BACKUP_DIR holds one directory per snapshot (the shard files and a
+    manifest) and a shared photo store. Photos are stored once under their
+    SHA-256, and photos.json remembers the size and mtime each was copied
+    at, so a snapshot only reads photos that are new or changed. Photos no
+    kept snapshot refers to are deleted with the snapshots.
+    """
+    
+    def __init__(self, db, backup_dir=BACKUP_DIR, photos_dir=PHOTOS_DIR, keep=BACKUP_KEEP):
+        self.db = db
+        self.backup_dir = backup_dir
+        self.photos_dir = photos_dir
+        self.keep = max(keep, 1)
+        self.last = None  # summary of the last snapshot, or its error
+        self._lock = threading.Lock()
+    
+    @property
+    def photo_store(self):
+        return os.path.join(self.backup_dir, "photos")
+    
+    def snapshots(self):
+        """Names of the complete snapshots, oldest first"""
+        try:
+            names = os.listdir(self.backup_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if os.path.isfile(os.path.join(self.backup_dir, name, MANIFEST)))
+    
+    def read_manifest(self, name):
+        try:
+            with open(os.path.join(self.backup_dir, name, MANIFEST), encoding="utf-8") as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            raise BackupError(f"No snapshot {name}")
+    
+    def snapshot(self):
+        """Back up every shard and sync the photos; returns a summary, or None if a snapshot is already running"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self.last = self._snapshot()
+            return self.last
+        except Exception as e:
+            self.last = {"at": time.time(), "error": f"{type(e).__name__}: {e}"}
+            raise
+        finally:
+            self._lock.release()
+    
+    def _snapshot(self):
+        start = time.perf_counter()
+        name = datetime.now().strftime("%Y%m%d-%H%M%S")
+        while os.path.exists(os.path.join(self.backup_dir, name)):
+            name += "-1"
+        directory = os.path.join(self.backup_dir, name)
+        temp_dir = directory + ".part"
+        os.makedirs(temp_dir)
+        
+        shards = []
+        # Copied shard by shard, a user moved in between could be missed or copied twice
+        with self.db.pause_moves():
+            for shard_id in range(self.db.shard_count):
+                source = shard_path(self.db.db_path, shard_id)
+                filename = os.path.basename(source)
+                restarts = copy_database(source, os.path.join(temp_dir, filename))
+                shards.append({"file": filename, "restarts": restarts})
+        
+        for shard in shards:
+            shard.update(check_database(os.path.join(temp_dir, shard["file"])))
+        photos, copied, copied_bytes = self._sync_photos()
+        
+        manifest = {"created_at": datetime.now().isoformat(timespec="seconds"), "shards": shards, "photos": photos}
+        with open(os.path.join(temp_dir, MANIFEST), "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_dir, directory)
+        self.prune()
+        
+        return {
+            "name": name,
+            "at": time.time(),
+            "seconds": time.perf_counter() - start,
+            "bytes": sum(shard["bytes"] for shard in shards),
+            "items": sum(shard["clothes"] for shard in shards),
+            "restarts": sum(shard["restarts"] for shard in shards),
+            "photos": len(photos),
+            "photos_copied": copied,
+            "photo_bytes_copied": copied_bytes
+        }
+    
+    def _stored_photo(self, digest):
+        return os.path.join(self.photo_store, digest)
+    
+    def _store_photo(self, path):
+        """Copy a photo into the store, hashing it on the way; returns its SHA-256"""
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.photo_store, suffix=".part")
+        try:
+            with open(path, "rb") as source, os.fdopen(fd, "wb") as target:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    target.write(chunk)
+            os.replace(temp_path, self._stored_photo(digest.hexdigest()))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return digest.hexdigest()
+    
+    def _sync_photos(self):
+        """Store photos that are new or changed since the last sync; returns ({name: sha256}, copied, bytes copied)"""
+        manifest_path = os.path.join(self.backup_dir, PHOTO_MANIFEST)
+        try:
+            with open(manifest_path, encoding="utf-8") as manifest:
+                known = json.load(manifest)
+        except (FileNotFoundError, ValueError):
+            known = {}
+        os.makedirs(self.photo_store, exist_ok=True)
+        
+        photos = {}
+        synced = {}  # name -> [size, mtime_ns, sha256]
+        copied = copied_bytes = 0
+        try:
+            entries = list(os.scandir(self.photos_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            # Thumbnails are in a subdirectory and are rebuilt from the photos
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            try:
+                stat = entry.stat()
+                cached = known.get(entry.name)
+                if (cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns
+                        and os.path.exists(self._stored_photo(cached[2]))):
+                    digest = cached[2]
+                else:
+                    digest = self._store_photo(entry.path)
+                    copied += 1
+                    copied_bytes += stat.st_size
+            except OSError as e:
+                # Deleted since the directory was listed
+                print(f"Error backing up photo {entry.name}: {e}")
+                continue
+            photos[entry.name] = digest
+            synced[entry.name] = [stat.st_size, stat.st_mtime_ns, digest]
+        
+        with open(manifest_path + ".part", "w", encoding="utf-8") as manifest:
+            json.dump(synced, manifest)
+        os.replace(manifest_path + ".part", manifest_path)
+        return photos, copied, copied_bytes
+    
+    def prune(self):
+        """Delete snapshots beyond the newest `keep`, leftovers of interrupted ones, and photos nothing refers to"""
+        names = self.snapshots()
+        for name in names[:-self.keep]:
+            shutil.rmtree(os.path.join(self.backup_dir, name), ignore_errors=True)
+        for name in os.listdir(self.backup_dir):
+            if name.endswith(".part") and os.path.isdir(os.path.join(self.backup_dir, name)):
+                shutil.rmtree(os.path.join(self.backup_dir, name), ignore_errors=True)
+        
+        referenced = set()
+        for name in self.snapshots():
+            referenced.update(self.read_manifest(name)["photos"].values())
+        with os.scandir(self.photo_store) as entries:
+            for entry in entries:
+                if entry.name not in referenced:
+                    os.remove(entry.path)
+    
+    def verify(self, name=None, deep=False):
+        """Restore a snapshot into a scratch directory and check it against its manifest; returns the problems found
+        
+        With deep, every photo is re-hashed as well, rather than only checked to exist.
+        """
+        names = self.snapshots()
+        if name is None:
+            if not names:
+                raise BackupError("No snapshots yet")
+            name = names[-1]
+        manifest = self.read_manifest(name)
+        problems = []
+        
+        with tempfile.TemporaryDirectory(prefix="outfitify-restore-") as scratch:
+            for shard in manifest["shards"]:
+                path = os.path.join(scratch, shard["file"])
+                shutil.copyfile(os.path.join(self.backup_dir, name, shard["file"]), path)
+                try:
+                    counts = check_database(path)
+                except (BackupError, sqlite3.Error) as e:
+                    problems.append(str(e))
+                    continue
+                for table in ('users', 'clothes', 'outfits'):
+                    if counts[table] != shard[table]:
+                        problems.append(f"{shard['file']}: {counts[table]} {table} rows, manifest says {shard[table]}")
+            
+            # The restored files must open as a database with the same layout
+            if not problems:
+                try:
+                    restored = Database(os.path.join(scratch, manifest["shards"][0]["file"]), shards=len(manifest["shards"]))
+                    items = sum(shard["items"] for shard in restored.shard_stats())
+                    if items != sum(shard["clothes"] for shard in manifest["shards"]):
+                        problems.append(f"Restored database has {items} items reachable through the catalog")
+                except (sqlite3.Error, ValueError) as e:
+                    problems.append(f"Restored database doesn't open: {e}")
+        
+        for photo, digest in manifest["photos"].items():
+            path = self._stored_photo(digest)
+            if not os.path.exists(path):
+                problems.append(f"Photo {photo} is missing from the backup")
+            elif deep and file_sha256(path) != digest:
+                problems.append(f"Photo {photo} is damaged in the backup")
+        return problems
+    
+    def restore(self, name):
+        """Put a verified snapshot's databases and missing photos back in place (stop the bot first)
+        
+        The current database files are kept next to them with a .before-restore
+        suffix. Returns (shards restored, photos restored).
+        """
+        problems = self.verify(name)
+        if problems:
+            raise BackupError(f"Snapshot {name} failed verification: {problems[0]}")
+        manifest = self.read_manifest(name)
+        
+        directory = os.path.dirname(self.db.db_path) or "."
+        for shard_id in range(max(self.db.shard_count, len(manifest["shards"]))):
+            path = shard_path(self.db.db_path, shard_id)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.replace(path + suffix, path + suffix + ".before-restore")
+        for shard in manifest["shards"]:
+            destination = os.path.join(directory, shard["file"])
+            shutil.copyfile(os.path.join(self.backup_dir, name, shard["file"]), destination + ".part")
+            os.replace(destination + ".part", destination)
+        
+        restored_photos = 0
+        os.makedirs(self.photos_dir, exist_ok=True)
+        for photo, digest in manifest["photos"].items():
+            destination = os.path.join(self.photos_dir, photo)
+            if not os.path.exists(destination):
+                shutil.copyfile(self._stored_photo(digest), destination)
+                restored_photos += 1
+        return len(manifest["shards"]), restored_photos
+
+def format_size(size):
+    return f"{size / (1024 * 1024):.1f}MB"
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up, verify and restore the database shards and photos")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("snapshot", help="Take a snapshot now")
+    commands.add_parser("list", help="List the snapshots kept")
+    verify = commands.add_parser("verify", help="Restore a snapshot (the newest by default) to a scratch directory and check it")
+    verify.add_argument("name", nargs="?")
+    verify.add_argument("--deep", action="store_true", help="Re-hash every photo too")
+    restore = commands.add_parser("restore", help="Put a snapshot back in place (stop the bot first)")
+    restore.add_argument("name")
+    args = parser.parse_args()
+    
+    backups = BackupManager(Database())
+    if args.command == "snapshot":
+        summary = backups.snapshot()
+        print(f"✅ Snapshot {summary['name']}: {summary['items']} items, {format_size(summary['bytes'])}, "
+              f"{summary['photos']} photos ({summary['photos_copied']} new) in {summary['seconds']:.1f}s")
+    elif args.command == "list":
+        for name in backups.snapshots():
+            manifest = backups.read_manifest(name)
+            print(f"• {name}: {sum(shard['clothes'] for shard in manifest['shards'])} items, "
+                  f"{format_size(sum(shard['bytes'] for shard in manifest['shards']))}, {len(manifest['photos'])} photos")
+    elif args.command == "verify":
+        problems = backups.verify(args.name, deep=args.deep)
+        print("\n".join(f"❌ {problem}" for problem in problems) if problems else "✅ Snapshot restores cleanly")
+    else:
+        shards, photos = backups.restore(args.name)
+        print(f"✅ Restored {shards} database files and {photos} photos from {args.name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+End-to-end latency benchmarks for the bot's user flows
+
+Drives the real handlers in main.py through BotHarness with a fake OpenAI
+endpoint and reports p50/p95/p99 latency and throughput per flow.
+
+Usage:
+    python -m benchmarks.bench_bot
+    python -m benchmarks.bench_bot --iterations 200 --openai-latency 0.05
+    python -m benchmarks.bench_bot --save-baseline
+    python -m benchmarks.bench_bot --compare
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.fakes import BotHarness, REPO_ROOT
+
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        "iterations": len(ordered),
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        "throughput_per_s": len(ordered) / elapsed if elapsed else 0.0
+    }
+
+class BotBenchmark:
+    """One benchmark user per flow so flows never see each other's state"""
+    
+    def __init__(self, harness, wardrobe_size=30, bulk_size=5):
+        self.harness = harness
+        self.wardrobe_size = wardrobe_size
+        self.bulk_size = bulk_size
+        self._user_ids = itertools.count(10_000)
+        self._unique_ids = itertools.count(1)
+    
+    def new_user(self, wardrobe_size=None, with_photos=True):
+        user_id = next(self._user_ids)
+        size = self.wardrobe_size if wardrobe_size is None else wardrobe_size
+        item_ids = self.harness.seed_wardrobe(user_id, size, with_photos=with_photos)
+        return user_id, item_ids
+    
+    def _photo_id(self):
+        return f"bench-photo-{next(self._unique_ids)}"
+    
+    # Each flow returns a callable that runs the flow once
+    
+    def flow_single_photo(self):
+        user_id, _ = self.new_user(0)
+        def run():
+            self.harness.text(user_id, "📸 Add Photo")
+            self.harness.photo(user_id, self._photo_id())
+            self.harness.text(user_id, "✅ Save as is")
+        return run
+    
+    def flow_single_description(self):
+        user_id, _ = self.new_user(0)
+        def run():
+            self.harness.text(user_id, "✍️ Add Description")
+            self.harness.text(user_id, "Black leather jacket with silver zippers")
+            self.harness.text(user_id, "✅ Save as is")
+        return run
+    
+    def flow_bulk_photos(self):
+        user_id, _ = self.new_user(0)
+        def run():
+            self.harness.text(user_id, "📸 Bulk Photos (1-10)")
+            for _ in range(self.bulk_size):
+                self.harness.photo(user_id, self._photo_id())
+            self.harness.text(user_id, "Done")
+        return run
+    
+    def flow_bulk_descriptions(self):
+        user_id, _ = self.new_user(0)
+        def run():
+            self.harness.text(user_id, "✍️ Bulk Descriptions (1-10)")
+            for i in range(self.bulk_size):
+                self.harness.text(user_id, f"Blue nike sneakers size {i}")
+            self.harness.text(user_id, "Done")
+        return run
+    
+    def flow_create_outfit(self):
+        user_id, _ = self.new_user()
+        def run():
+            self.harness.text(user_id, "🎨 Create Outfit")
+            self.harness.text(user_id, "Casual weekend look")
+        return run
+    
+    def flow_suggestions(self):
+        user_id, _ = self.new_user()
+        def run():
+            self.harness.text(user_id, "💡 Suggestions")
+        return run
+    
+    def flow_wardrobe_view(self):
+        user_id, _ = self.new_user()
+        def run():
+            self.harness.text(user_id, "📚 My Wardrobe")
+        return run
+    
+    def flow_edit(self):
+        user_id, item_ids = self.new_user()
+        names = itertools.count()
+        def run():
+            self.harness.callback(user_id, f"edit_item_{item_ids[0]}")
+            self.harness.text(user_id, "📝 Name")
+            self.harness.text(user_id, f"Renamed item {next(names)}")
+        return run
+    
+    def flow_delete(self):
+        user_id, _ = self.new_user()
+        def run():
+            item_id = self.harness.seed_wardrobe(user_id, 1)[0]
+            self.harness.callback(user_id, f"delete_item_{item_id}")
+        return run
+    
+    FLOWS = [
+        "single_photo",
+        "single_description",
+        "bulk_photos",
+        "bulk_descriptions",
+        "create_outfit",
+        "suggestions",
+        "wardrobe_view",
+        "edit",
+        "delete",
+    ]
+    
+    def run_flow(self, name, iterations, warmup=3):
+        run = getattr(self, f"flow_{name}")()
+        for _ in range(warmup):
+            run()
+        
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run()
+            latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+        
+        self.harness.sink.reset()
+        return summarize(latencies, elapsed)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print p95 changes against a baseline and return the regressed flows"""
+    regressions = []
+    width = max([20] + [len(name) for name in results["flows"]])
+    print(f"\n{'flow':<{width}} {'baseline p95':>14} {'current p95':>14} {'change':>9}")
+    for name, current in results["flows"].items():
+        previous = baseline.get("flows", {}).get(name)
+        if not previous:
+            print(f"{name:<{width}} {'-':>14} {current['p95_ms']:>12.2f}ms {'new':>9}")
+            continue
+        change = (current["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0.0
+        marker = " ⚠️" if change > tolerance else ""
+        print(f"{name:<{width}} {previous['p95_ms']:>12.2f}ms {current['p95_ms']:>12.2f}ms {change:>+8.0%}{marker}")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end bot flow benchmarks")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--flows", nargs="+", choices=BotBenchmark.FLOWS, default=BotBenchmark.FLOWS)
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="seconds added to every fake completion")
+    parser.add_argument("--openai-jitter", type=float, default=0.0, help="random extra seconds per completion")
+    parser.add_argument("--wardrobe-size", type=int, default=30)
+    parser.add_argument("--bulk-size", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="allowed p95 slowdown before failing")
+    args = parser.parse_args(argv)
+    
+    harness = BotHarness(openai_latency=args.openai_latency, openai_jitter=args.openai_jitter)
+    benchmark = BotBenchmark(harness, wardrobe_size=args.wardrobe_size, bulk_size=args.bulk_size)
+    
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {
+            "iterations": args.iterations,
+            "openai_latency": args.openai_latency,
+            "openai_jitter": args.openai_jitter,
+            "wardrobe_size": args.wardrobe_size,
+            "bulk_size": args.bulk_size
+        },
+        "flows": {}
+    }
+    
+    print(f"{'flow':<20} {'p50':>10} {'p95':>10} {'p99':>10} {'ops/s':>10}")
+    try:
+        for name in args.flows:
+            summary = benchmark.run_flow(name, args.iterations)
+            results["flows"][name] = summary
+            print(f"{name:<20} {summary['p50_ms']:>8.2f}ms {summary['p95_ms']:>8.2f}ms "
+                  f"{summary['p99_ms']:>8.2f}ms {summary['throughput_per_s']:>10.1f}")
+    finally:
+        harness.close()
+    
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    
+    exit_code = 0
+    if args.compare:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                regressions = compare(results, json.load(baseline_file), args.tolerance)
+            if regressions:
+                print(f"\n❌ p95 regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+                exit_code = 1
+        else:
+            print(f"\n⚠️  No baseline at {args.baseline}; run with --save-baseline first")
+    
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"\n💾 Baseline saved to {args.baseline}")
+    
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""
+Micro-benchmarks for every Database method at realistic table sizes
+
+Builds synthetic SQLite databases with the real schema at each scale (1k,
+100k or 10M clothing items spread over users with 20-80 items each) and
+times the Database methods against them. Databases are generated once per
+scale and seed and reused, so runs are repeatable; the benchmark undoes its
+own writes before finishing.
+
+Usage:
+    python -m benchmarks.bench_database
+    python -m benchmarks.bench_database --scales 1k 100k 10m --iterations 500
+    python -m benchmarks.bench_database --save-baseline
+    python -m benchmarks.bench_database --compare
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_bot import summarize, compare, git_commit
+from benchmarks.fakes import REPO_ROOT
+
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "benchmarks", "db_baseline.json")
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "outfitify-bench-db")
+
+# Bump when the generated data changes so cached databases are rebuilt
+DATA_VERSION = 1
+
+CATEGORIES = ["tops", "bottoms", "dresses", "outerwear", "shoes", "accessories"]
+COLORS = ["Black", "White", "Blue", "Red", "Green", "Beige", "Grey", "Navy", "Brown", "Pink"]
+KINDS = ["t-shirt", "jeans", "dress", "jacket", "sneakers", "scarf", "shirt", "skirt", "coat", "boots"]
+BRANDS = ["Nike", "Adidas", "Zara", "Uniqlo", "Levi's", "Maison Margiela", "H&M", "COS"]
+
+def _import_database(db_path):
+    """Import Database pointed at db_path; settings are read from the environment at import time"""
+    os.environ["DATABASE_PATH"] = db_path
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK")
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import database
+    database.DATABASE_PATH = db_path
+    return database.Database
+
+def item_name(item_id):
+    rng = random.Random(item_id)
+    return f"{rng.choice(COLORS)} {rng.choice(BRANDS)} {rng.choice(KINDS)} #{item_id}"
+
+def build_database(path, rows, seed):
+    """Fill a new database with `rows` clothing items plus outfits, returning the user count"""
+    Database = _import_database(path)
+    Database()  # Creates the schema
+    
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    rng = random.Random(seed)
+    
+    # Wardrobe sizes; user N owns the IDs after the first N-1 wardrobes
+    wardrobe_ends = []
+    total = 0
+    while total < rows:
+        total = min(rows, total + rng.randint(20, 80))
+        wardrobe_ends.append(total)
+    users = len(wardrobe_ends)
+    
+    def owner(item_id):
+        return bisect.bisect_left(wardrobe_ends, item_id) + 1
+    
+    def clothes():
+        for item_id in range(1, rows + 1):
+            category = CATEGORIES[item_id % len(CATEGORIES)]
+            name = item_name(item_id)
+            yield (item_id, owner(item_id), name, category, f"{name} - {category}",
+                   json.dumps([COLORS[item_id % len(COLORS)].lower(), category]),
+                   f"2024-01-01 {item_id // 3600 % 24:02d}:{item_id // 60 % 60:02d}:{item_id % 60:02d}")
+    
+    rows_iter = clothes()
+    while True:
+        batch = list(itertools.islice(rows_iter, 50_000))
+        if not batch:
+            break
+        conn.executemany("""
+            INSERT INTO clothes (id, user_id, name, category, description, tags, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, batch)
+    
+    conn.executemany("INSERT INTO users (user_id, username) VALUES (?, ?)",
+                     ((user_id, f"user{user_id}") for user_id in range(1, users + 1)))
+    
+    # About one saved outfit per ten items, each made of up to three neighbouring items of one user
+    outfits = []
+    outfit_items = []
+    for outfit_id in range(1, rows // 10 + 1):
+        item_id = rng.randint(1, rows)
+        user_id = owner(item_id)
+        item_ids = sorted({item for item in (item_id, item_id - 1, item_id - 2) if item >= 1 and owner(item) == user_id})
+        outfits.append((outfit_id, user_id, f"Outfit {outfit_id}", "Synthetic outfit", json.dumps(item_ids)))
+        outfit_items.extend((outfit_id, item) for item in item_ids)
+    conn.executemany("""
+        INSERT INTO outfits (id, user_id, name, description, clothes_ids)
+        VALUES (?, ?, ?, ?, ?)
+    """, outfits)
+    conn.executemany("INSERT INTO outfit_items (outfit_id, item_id) VALUES (?, ?)", outfit_items)
+    
+    conn.execute("CREATE TABLE bench_meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT INTO bench_meta VALUES ('users', ?)", (str(users),))
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return users
+
+def prepare(data_dir, scale, seed, rebuild=False):
+    """Path and user count of the database for a scale, building it if needed"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"outfitify_{scale}_seed{seed}_v{DATA_VERSION}.db")
+    if rebuild and os.path.exists(path):
+        os.remove(path)
+    
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            users = int(conn.execute("SELECT value FROM bench_meta WHERE key = 'users'").fetchone()[0])
+            return path, users
+        except (sqlite3.Error, TypeError):
+            pass  # Interrupted build, start over
+        finally:
+            conn.close()
+        os.remove(path)
+    
+    print(f"🏗️  Building {scale} database ({SCALES[scale]:,} items) at {path}...")
+    started = time.perf_counter()
+    temp_path = path + ".building"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    users = build_database(temp_path, SCALES[scale], seed)
+    os.replace(temp_path, path)
+    print(f"   done in {time.perf_counter() - started:.1f}s, {users:,} users")
+    return path, users
+
+class DatabaseBenchmark:
+    """Times each Database method on one prepared database"""
+    
+    METHODS = [
+        "get_user_clothes",
+        "get_user_clothes_category",
+        "get_clothing_item",
+        "add_clothing_item",
+        "update_clothing_item",
+        "delete_clothing_item",
+        "save_outfit",
+        "get_user_outfits",
+    ]
+    
+    def __init__(self, path, users, rows, seed):
+        self.db = _import_database(path)()
+        self.users = users
+        self.rows = rows
+        self.rng = random.Random(seed)
+        self.added = []
+        
+        # Separate connection for sampling arguments, outside the timed code
+        self._conn = sqlite3.connect(path)
+        self.max_outfit_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM outfits").fetchone()[0]
+    
+    def _random_item(self):
+        """(user_id, item_id) of a random generated item"""
+        item_id = self.rng.randint(1, self.rows)
+        owner = self._conn.execute("SELECT user_id FROM clothes WHERE id = ?", (item_id,)).fetchone()[0]
+        return owner, item_id
+    
+    def _random_user(self):
+        return self.rng.randint(1, self.users)
+    
+    # Each case returns the arguments of every iteration up front, so sampling isn't timed
+    
+    def case_get_user_clothes(self, iterations):
+        return self.db.get_user_clothes, [(self._random_user(),) for _ in range(iterations)]
+    
+    def case_get_user_clothes_category(self, iterations):
+        return self.db.get_user_clothes, [(self._random_user(), self.rng.choice(CATEGORIES))
+                                          for _ in range(iterations)]
+    
+    def case_get_clothing_item(self, iterations):
+        return self.db.get_clothing_item, [self._random_item() for _ in range(iterations)]
+    
+    def case_add_clothing_item(self, iterations):
+        def add(user_id, name):
+            self.added.append((user_id, self.db.add_clothing_item(user_id, name, "tops", f"{name} - tops",
+                                                                  tags=["benchmark"])))
+        return add, [(self._random_user(), f"Benchmark shirt {i}") for i in range(iterations)]
+    
+    def case_update_clothing_item(self, iterations):
+        # Rewrites each name with the value it already has, so the data stays unchanged
+        args = []
+        for _ in range(iterations):
+            user_id, item_id = self._random_item()
+            args.append((user_id, item_id, "name", item_name(item_id)))
+        return self.db.update_clothing_item, args
+    
+    def case_delete_clothing_item(self, iterations):
+        # Deletes the items add_clothing_item created; only as many as it added
+        args, self.added = self.added[:iterations], self.added[iterations:]
+        return self.db.delete_clothing_item, args
+    
+    def case_save_outfit(self, iterations):
+        args = []
+        for i in range(iterations):
+            user_id, item_id = self._random_item()
+            args.append((user_id, f"Benchmark outfit {i}", "Benchmark", [item_id]))
+        return self.db.save_outfit, args
+    
+    def case_get_user_outfits(self, iterations):
+        return self.db.get_user_outfits, [(self._random_user(),) for _ in range(iterations)]
+    
+    def run(self, method, iterations, warmup=5):
+        function, args = getattr(self, f"case_{method}")(iterations + warmup)
+        for call_args in args[:warmup]:
+            function(*call_args)
+        
+        latencies = []
+        started = time.perf_counter()
+        for call_args in args[warmup:]:
+            start = time.perf_counter()
+            function(*call_args)
+            latencies.append(time.perf_counter() - start)
+        return summarize(latencies, time.perf_counter() - started)
+    
+    def cleanup(self):
+        """Undo the benchmark's writes"""
+        for user_id, item_id in self.added:
+            self.db.delete_clothing_item(user_id, item_id)
+        self.added = []
+        
+        self._conn.execute("DELETE FROM outfit_items WHERE outfit_id > ?", (self.max_outfit_id,))
+        self._conn.execute("DELETE FROM outfits WHERE id > ?", (self.max_outfit_id,))
+        self._conn.commit()
+        self._conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Database method micro-benchmarks")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["1k", "100k"],
+                        help="clothing items per database (10m needs a few GB of disk and minutes to build)")
+    parser.add_argument("--methods", nargs="+", choices=DatabaseBenchmark.METHODS, default=DatabaseBenchmark.METHODS)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="where generated databases are kept")
+    parser.add_argument("--rebuild", action="store_true", help="regenerate the databases")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="allowed p95 slowdown before failing")
+    args = parser.parse_args(argv)
+    
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {"iterations": args.iterations, "seed": args.seed, "data_version": DATA_VERSION},
+        # Keyed "<scale>/<method>" and named like bench_bot's results so compare() works on both
+        "flows": {}
+    }
+    
+    for scale in args.scales:
+        path, users = prepare(args.data_dir, scale, args.seed, args.rebuild)
+        benchmark = DatabaseBenchmark(path, users, SCALES[scale], args.seed)
+        
+        print(f"\n{scale} ({SCALES[scale]:,} items, {users:,} users)")
+        print(f"{'method':<28} {'p50':>10} {'p95':>10} {'p99':>10} {'ops/s':>10}")
+        try:
+            methods = list(args.methods)
+            # Deletes remove what the add benchmark created
+            if "delete_clothing_item" in methods and "add_clothing_item" not in methods:
+                methods.insert(methods.index("delete_clothing_item"), "add_clothing_item")
+            for method in methods:
+                summary = benchmark.run(method, args.iterations)
+                if method not in args.methods:
+                    continue
+                results["flows"][f"{scale}/{method}"] = summary
+                print(f"{method:<28} {summary['p50_ms']:>8.3f}ms {summary['p95_ms']:>8.3f}ms "
+                      f"{summary['p99_ms']:>8.3f}ms {summary['throughput_per_s']:>10.1f}")
+        finally:
+            benchmark.cleanup()
+    
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    
+    exit_code = 0
+    if args.compare:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                regressions = compare(results, json.load(baseline_file), args.tolerance)
+            if regressions:
+                print(f"\n❌ p95 regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+                exit_code = 1
+        else:
+            print(f"\n⚠️  No baseline at {args.baseline}; run with --save-baseline first")
+    
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"\n💾 Baseline saved to {args.baseline}")
+    
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
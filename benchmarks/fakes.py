@@ -0,0 +1,368 @@
+"""
+Offline stand-ins for Telegram and OpenAI used by the benchmark tools
+
+BotHarness imports the real main.py against a temporary working directory,
+replaces the bot's outgoing API calls with a recording sink and points the
+OpenAI client and Telegram file downloads at a local fake server.
+"""
+
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def make_jpeg(seed=0, size=(640, 800)):
+    """Build a small solid-color JPEG"""
+    from PIL import Image
+    
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=80)
+    return output.getvalue()
+
+class FakeOpenAIServer:
+    """Local HTTP server answering chat completions and Telegram file downloads
+    
+    It also stands in for an OTLP/HTTP trace collector: spans posted to
+    /v1/traces are kept in `trace_spans`.
+    
+    Completions are canned answers shaped after the prompt, returned after
+    `latency` seconds (plus up to `jitter` seconds). A share of requests given
+    by `tail_rate` takes `tail_latency` seconds instead, and a share given by
+    `error_rate` fails with HTTP `error_status`.
+    
+    Usage reports prompt caching the way OpenAI does: the longest prefix
+    shared with a recent prompt counts as cached once it reaches 1024
+    tokens, in 128-token steps.
+    """
+    
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, photo_bytes=None,
+                 tail_rate=0.0, tail_latency=0.0, error_status=500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.error_status = error_status
+        self.photo_bytes = photo_bytes or make_jpeg()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.trace_spans = []
+        self._recent_prompts = []
+        self._lock = threading.Lock()
+        self._server = None
+    
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+    
+    def start(self):
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Buffer each response into one write so Nagle and delayed ACKs don't add 40ms
+            wbufsize = -1
+            disable_nagle_algorithm = True
+            
+            def do_GET(self):
+                if "/file/bot" not in self.path:
+                    self._send(404, b"{}")
+                    return
+                self._send(200, fake.photo_bytes, "image/jpeg")
+            
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path.endswith("/v1/traces"):
+                    fake.collect_spans(body)
+                    self._send(200, b"{}")
+                    return
+                status, payload = fake.complete(body)
+                self._send(status, json.dumps(payload).encode("utf-8"))
+            
+            def _send(self, status, data, content_type="application/json"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+    
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+    
+    def collect_spans(self, body):
+        """Keep the spans of an OTLP/JSON export request"""
+        with self._lock:
+            for resource_spans in body.get("resourceSpans", []):
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    self.trace_spans.extend(scope_spans.get("spans", []))
+    
+    def complete(self, body):
+        """Build a chat completion response for a request body"""
+        delay = self.latency + random.random() * self.jitter
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay = self.tail_latency
+        if delay:
+            time.sleep(delay)
+        
+        with self._lock:
+            self.requests += 1
+        
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, {"error": {"message": "Injected failure", "type": "server_error"}}
+        
+        prompt = _prompt_text(body.get("messages", []))
+        content = _canned_answer(prompt)
+        prompt_tokens = max(1, len(prompt) // 4)
+        completion_tokens = max(1, len(content) // 4)
+        
+        with self._lock:
+            shared = max((len(os.path.commonprefix([prompt, recent])) for recent in self._recent_prompts), default=0)
+            cached_tokens = shared // 4 // 128 * 128 if shared // 4 >= 1024 else 0
+            self._recent_prompts = [prompt] + self._recent_prompts[:63]
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+        
+        return 200, {
+            "id": f"chatcmpl-fake-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+
+def _prompt_text(messages):
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(parts)
+
+_ITEM_LINE = re.compile(r"^\s*- (.+?) \(([^)]*)\):", re.MULTILINE)
+_DESCRIPTION_LINE = re.compile(r"Description: (.+)")
+
+def _canned_answer(prompt):
+    if "suggest 5 different outfit" in prompt:
+        return "\n".join(f"{i}. Look {i}: A balanced everyday combination" for i in range(1, 6))
+    
+    if "selected_items" in prompt:
+        names = [match.group(1) for match in _ITEM_LINE.finditer(prompt)]
+        return json.dumps({
+            "selected_items": names[:3],
+            "styling_tips": ["Roll the sleeves", "Match the belt and shoes"]
+        })
+    
+    if "Suggest improvements" in prompt:
+        return "Swap the shoes for loafers and add a watch."
+    
+    match = _DESCRIPTION_LINE.search(prompt)
+    name = match.group(1).strip() if match else f"Blue cotton shirt {random.randrange(10 ** 6)}"
+    return json.dumps({
+        "name": name,
+        "category": "tops",
+        "season": "all",
+        "occasion": "casual",
+        "tags": ["cotton", "blue"]
+    })
+
+class _SentMessage:
+    def __init__(self, message_id, chat_id, text=None, photo_file_id=None):
+        self.message_id = message_id
+        self.chat = type("Chat", (), {"id": chat_id})()
+        self.text = text
+        self.photo = [type("PhotoSize", (), {"file_id": photo_file_id})()] if photo_file_id else None
+
+class RecordingBot:
+    """Replaces a TeleBot's outgoing API calls with an in-memory recorder"""
+    
+    def __init__(self, bot, file_size=None):
+        self.bot = bot
+        self.file_size = file_size
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+        self._lock = threading.Lock()
+        
+        bot.send_message = self.send_message
+        bot.send_photo = self.send_photo
+        bot.send_document = self.send_document
+        bot.answer_callback_query = self._record("answer_callback_query")
+        bot.edit_message_reply_markup = self._record("edit_message_reply_markup")
+        bot.get_file = self.get_file
+    
+    def _append(self, call):
+        with self._lock:
+            self.calls.append(call)
+    
+    def _record(self, method):
+        def record(*args, **kwargs):
+            self._append((method, args, kwargs))
+            return True
+        return record
+    
+    def send_message(self, chat_id, text, **kwargs):
+        self._append(("send_message", (chat_id, text), kwargs))
+        return _SentMessage(next(self._message_ids), chat_id, text=text)
+    
+    def send_photo(self, chat_id, photo, **kwargs):
+        self._append(("send_photo", (chat_id,), kwargs))
+        message_id = next(self._message_ids)
+        return _SentMessage(message_id, chat_id, photo_file_id=f"sent-photo-{message_id}")
+    
+    def send_document(self, chat_id, document, **kwargs):
+        self._append(("send_document", (chat_id,), kwargs))
+        return _SentMessage(next(self._message_ids), chat_id)
+    
+    def get_file(self, file_id):
+        return type("File", (), {"file_id": file_id, "file_path": f"photos/{file_id}.jpg",
+                                 "file_size": self.file_size})()
+    
+    def reset(self):
+        with self._lock:
+            self.calls = []
+
+class BotHarness:
+    """Runs the real bot handlers offline
+    
+    Must be created before anything imports config, because settings are read
+    from the environment at import time.
+    """
+    
+    def __init__(self, openai_latency=0.0, openai_jitter=0.0, openai_error_rate=0.0,
+                 workdir=None, threaded=False, extra_env=None):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="outfitify-bench-")
+        self.fake_openai = FakeOpenAIServer(openai_latency, openai_jitter, openai_error_rate).start()
+        
+        os.environ.update({
+            "TELEGRAM_TOKEN": "123456:BENCHMARK",
+            "OPENAI_API_KEY": "sk-benchmark",
+            "OPENAI_BASE_URL": f"{self.fake_openai.url}/v1",
+            "DATABASE_PATH": os.path.join(self.workdir, "outfitify.db"),
+            # Benchmarks replay one user far faster than the per-user limits allow
+            "AI_USER_RATE_LIMIT": "0",
+            "AI_USER_DAILY_TOKEN_QUOTA": "0",
+        })
+        os.environ.update(extra_env or {})
+        os.chdir(self.workdir)
+        if REPO_ROOT not in sys.path:
+            sys.path.insert(0, REPO_ROOT)
+        
+        from telebot import apihelper, types
+        import main
+        
+        apihelper.FILE_URL = f"{self.fake_openai.url}/file/bot{{0}}/{{1}}"
+        self.types = types
+        self.main = main
+        self.main.bot.threaded = threaded
+        # Build the lazily created services now so their cost isn't measured as the first update's
+        main.db.get()
+        main.ai_service.client
+        self.sink = RecordingBot(main.bot, file_size=len(self.fake_openai.photo_bytes))
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+    
+    def close(self):
+        self.fake_openai.stop()
+    
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    
+    def _message(self, user_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+        }
+        message.update(fields)
+        return message
+    
+    def text_update(self, user_id, text):
+        return {"update_id": next(self._update_ids), "message": self._message(user_id, text=text)}
+    
+    def photo_update(self, user_id, unique_id):
+        size = len(self.fake_openai.photo_bytes)
+        photo = [{"file_id": f"file-{unique_id}", "file_unique_id": unique_id,
+                  "width": 640, "height": 800, "file_size": size}]
+        return {"update_id": next(self._update_ids), "message": self._message(user_id, photo=photo)}
+    
+    def callback_update(self, user_id, data, message_id=None):
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._update_ids)),
+            "chat_instance": "benchmark",
+            "data": data,
+            "from": self._user(user_id),
+            "message": {"message_id": message_id or next(self._message_ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}},
+        }}
+    
+    def process(self, update):
+        """Feed one raw update (a Bot API JSON dict) through the bot's handlers"""
+        self.main.bot.process_new_updates([self.types.Update.de_json(update)])
+    
+    def text(self, user_id, text):
+        self.process(self.text_update(user_id, text))
+    
+    def photo(self, user_id, unique_id):
+        self.process(self.photo_update(user_id, unique_id))
+    
+    def callback(self, user_id, data, message_id=None):
+        self.process(self.callback_update(user_id, data, message_id))
+    
+    def seed_wardrobe(self, user_id, size, with_photos=False):
+        """Add synthetic items straight to the database, returning their IDs"""
+        photo_path = None
+        if with_photos:
+            os.makedirs("photos", exist_ok=True)
+            photo_path = os.path.join("photos", f"seed_{user_id}.jpg")
+            with open(photo_path, "wb") as photo_file:
+                photo_file.write(self.fake_openai.photo_bytes)
+        
+        colors = ["Black", "White", "Blue", "Red", "Green", "Beige", "Grey"]
+        kinds = [("t-shirt", "tops"), ("jeans", "bottoms"), ("dress", "dresses"),
+                 ("jacket", "outerwear"), ("sneakers", "shoes"), ("scarf", "accessories")]
+        item_ids = []
+        for i in range(size):
+            kind, category = kinds[i % len(kinds)]
+            name = f"{colors[i % len(colors)]} {kind} #{i}"
+            item_ids.append(self.main.db.add_clothing_item(
+                user_id, name, category, f"{name} - {category}",
+                photo_file_id=None, photo_path=photo_path, tags=[colors[i % len(colors)].lower(), kind]
+            ))
+        return item_ids
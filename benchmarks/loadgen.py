@@ -0,0 +1,450 @@
+"""
+Multi-user load generator and update log replayer
+
+Synthesizes user sessions as random walks over the menu buttons in main.py
+and runs many virtual users against the bot with the offline stand-ins from
+benchmarks.fakes. Updates go through the bot's real worker pool, so the
+report shows queueing delay as well as handler time.
+
+Each virtual user is closed-loop: it waits for its previous update to be
+handled, thinks, then sends the next one.
+
+Usage:
+    python -m benchmarks.loadgen --users 500 --duration 60 --think-time 2
+    python -m benchmarks.loadgen --mix suggestions=5,create_outfit=3,wardrobe=2
+    python -m benchmarks.loadgen --record session.jsonl
+    python -m benchmarks.loadgen --replay session.jsonl --speed 10
+"""
+
+import argparse
+import heapq
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+from benchmarks.bench_bot import percentile
+from benchmarks.fakes import BotHarness
+
+DEFAULT_MIX = {
+    "add_photo": 1,
+    "add_description": 2,
+    "bulk_photos": 0.5,
+    "bulk_descriptions": 0.5,
+    "create_outfit": 3,
+    "suggestions": 3,
+    "wardrobe": 3,
+    "edit": 1,
+    "delete": 0.5,
+}
+
+DESCRIPTIONS = [
+    "Black pants maison margiela",
+    "Blue nike sneakers",
+    "Red dress with flowers",
+    "Grey wool coat",
+    "White linen shirt",
+    "Beige chinos",
+]
+
+OUTFIT_REQUESTS = [
+    "Casual weekend look",
+    "Professional office outfit",
+    "Evening party ensemble",
+    "Something warm for a rainy day",
+]
+
+def parse_mix(value):
+    """Parse 'flow=weight,flow=weight' into a dict"""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown flow '{name}'")
+        mix[name] = float(weight or 1)
+    return mix
+
+class SessionWalker:
+    """Produces the next update of one virtual user's session
+    
+    A session is a walk over flows chosen by weight; each flow is the sequence
+    of button presses, texts, photos and callbacks a real user would send.
+    Steps are built lazily so edits and deletes target items that exist.
+    """
+    
+    def __init__(self, harness, user_id, rng, mix, bulk_size):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = rng
+        self.flows = list(mix)
+        self.weights = [mix[flow] for flow in self.flows]
+        self.bulk_size = bulk_size
+        self.pending = []
+        self.flow = None
+    
+    def _item_id(self):
+        clothes = self.harness.main.db.get_user_clothes(self.user_id)
+        return self.rng.choice(clothes)['id'] if clothes else None
+    
+    def _photo(self):
+        return ("photo", f"load-{self.user_id}-{self.rng.randrange(10 ** 9)}")
+    
+    def _steps(self, flow):
+        rng = self.rng
+        if flow == "add_photo":
+            return [("text", "📸 Add Photo"), self._photo, ("text", "✅ Save as is")]
+        if flow == "add_description":
+            return [("text", "✍️ Add Description"), ("text", rng.choice(DESCRIPTIONS)), ("text", "✅ Save as is")]
+        if flow == "bulk_photos":
+            return [("text", "📸 Bulk Photos (1-10)")] + [self._photo] * self.bulk_size + [("text", "Done")]
+        if flow == "bulk_descriptions":
+            return ([("text", "✍️ Bulk Descriptions (1-10)")]
+                    + [("text", rng.choice(DESCRIPTIONS)) for _ in range(self.bulk_size)]
+                    + [("text", "Done")])
+        if flow == "create_outfit":
+            return [("text", "🎨 Create Outfit"), ("text", rng.choice(OUTFIT_REQUESTS))]
+        if flow == "suggestions":
+            return [("text", "💡 Suggestions")]
+        if flow == "wardrobe":
+            return [("text", "📚 My Wardrobe")]
+        if flow == "edit":
+            return [lambda: ("callback", f"edit_item_{self._item_id()}"),
+                    ("text", "📝 Name"), ("text", f"Renamed {rng.randrange(1000)}")]
+        if flow == "delete":
+            return [lambda: ("callback", f"delete_item_{self._item_id()}")]
+        raise ValueError(flow)
+    
+    def next_update(self):
+        """Build the next raw update, or None if the step has nothing to act on"""
+        if not self.pending:
+            self.flow = self.rng.choices(self.flows, self.weights)[0]
+            self.pending = self._steps(self.flow)
+        
+        step = self.pending.pop(0)
+        kind, value = step() if callable(step) else step
+        
+        if kind == "text":
+            return self.harness.text_update(self.user_id, value)
+        if kind == "photo":
+            return self.harness.photo_update(self.user_id, value)
+        if value.endswith("_None"):
+            self.pending = []
+            return None
+        return self.harness.callback_update(self.user_id, value)
+
+class LoadMonitor:
+    """Collects queueing delay, handler time, user_states size and SQLite lock errors"""
+    
+    def __init__(self, harness):
+        self.harness = harness
+        self.queue_delays = []
+        self.handler_times = []
+        self.db_times = []
+        self.lock_errors = 0
+        self.handler_errors = 0
+        self.completed = 0
+        self.state_samples = []
+        self._lock = threading.Lock()
+        self._instrument_database()
+    
+    def _instrument_database(self):
+        db = self.harness.main.db
+        for name in dir(db):
+            method = getattr(db, name)
+            if name.startswith("_") or not callable(method):
+                continue
+            setattr(db, name, self._time_db_call(method))
+    
+    def _time_db_call(self, method):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e):
+                    with self._lock:
+                        self.lock_errors += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.db_times.append(elapsed)
+        return timed
+    
+    def wrap_task(self, task, enqueued_at, on_done):
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self.handler_errors += 1
+                    if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+                        self.lock_errors += 1
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.queue_delays.append(started - enqueued_at)
+                    self.handler_times.append(finished - started)
+                    self.completed += 1
+                on_done()
+        return run
+    
+    def sample_states(self, elapsed):
+        user_states = self.harness.main.user_states
+        self.state_samples.append({
+            "elapsed_s": round(elapsed, 1),
+            "users": len(user_states),
+            "bytes": _deep_size(user_states)
+        })
+
+def _deep_size(obj, seen=None):
+    """Approximate memory held by an object graph"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(key, seen) + _deep_size(value, seen) for key, value in list(obj.items()))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(value, seen) for value in list(obj))
+    elif hasattr(obj, "__dict__"):
+        size += _deep_size(vars(obj), seen)
+    return size
+
+class LoadRunner:
+    def __init__(self, harness, monitor):
+        self.harness = harness
+        self.monitor = monitor
+        self.recorded = []
+        self.record = False
+        self._start = None
+        
+        pool = harness.main.bot.worker_pool
+        self._pool_put = pool.put
+        self._pool = pool
+        self._current = threading.local()
+        pool.put = self._put
+    
+    def _put(self, task, *args, **kwargs):
+        on_done = getattr(self._current, "on_done", None) or (lambda: None)
+        self._current.enqueued = True
+        wrapped = self.monitor.wrap_task(task, time.perf_counter(), on_done)
+        self._pool_put(wrapped, *args, **kwargs)
+    
+    def submit(self, update, on_done):
+        """Hand an update to the bot; on_done runs once its handler finished"""
+        if self.record:
+            self.recorded.append({"t": round(time.perf_counter() - self._start, 3), "update": update})
+        
+        handled = threading.Event()
+        def done():
+            if not handled.is_set():
+                handled.set()
+                on_done()
+        
+        self._current.on_done = done
+        self._current.enqueued = False
+        try:
+            self.harness.process(update)
+        finally:
+            self._current.on_done = None
+        
+        # Updates no handler accepted never reach the pool
+        if not self._current.enqueued:
+            done()
+    
+    def run_synthetic(self, users, duration, think_time, mix, wardrobe_sizes, bulk_size, seed):
+        rng = random.Random(seed)
+        walkers = []
+        for index in range(users):
+            user_id = 100_000 + index
+            self.harness.seed_wardrobe(user_id, rng.randint(*wardrobe_sizes))
+            walkers.append(SessionWalker(self.harness, user_id, random.Random(seed + index), mix, bulk_size))
+        
+        schedule = []
+        lock = threading.Condition()
+        self._start = time.perf_counter()
+        deadline = self._start + duration
+        for index in range(users):
+            heapq.heappush(schedule, (self._start + rng.expovariate(1 / think_time) if think_time else 0, index))
+        
+        def reschedule(index):
+            delay = rng.expovariate(1 / think_time) if think_time else 0
+            with lock:
+                heapq.heappush(schedule, (time.perf_counter() + delay, index))
+                lock.notify()
+        
+        next_sample = self._start
+        while True:
+            now = time.perf_counter()
+            if now >= next_sample:
+                self.monitor.sample_states(now - self._start)
+                next_sample = now + 1
+            if now >= deadline:
+                break
+            
+            with lock:
+                if not schedule or schedule[0][0] > now:
+                    timeout = min(schedule[0][0] - now if schedule else 0.1, 0.1)
+                    lock.wait(timeout)
+                    continue
+                _, index = heapq.heappop(schedule)
+            
+            update = walkers[index].next_update()
+            if update is None:
+                reschedule(index)
+                continue
+            self.submit(update, lambda index=index: reschedule(index))
+        
+        self._drain()
+        return time.perf_counter() - self._start
+    
+    def run_replay(self, path, speed):
+        entries = []
+        with open(path) as log_file:
+            for line in log_file:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+        
+        # Accept our own recordings ({"t", "update"}) and plain Bot API updates paced by their date
+        first_date = None
+        timeline = []
+        for entry in entries:
+            if "update" in entry:
+                timeline.append((entry["t"], entry["update"]))
+                continue
+            message = entry.get("message") or (entry.get("callback_query") or {}).get("message") or {}
+            date = message.get("date", 0)
+            first_date = date if first_date is None else first_date
+            timeline.append((date - first_date, entry))
+        
+        self._start = time.perf_counter()
+        next_sample = self._start
+        for offset, update in timeline:
+            due = self._start + (offset / speed if speed else 0)
+            while time.perf_counter() < due:
+                time.sleep(min(0.01, due - time.perf_counter()))
+            now = time.perf_counter()
+            if now >= next_sample:
+                self.monitor.sample_states(now - self._start)
+                next_sample = now + 1
+            self.submit(update, lambda: None)
+        
+        self._drain()
+        return time.perf_counter() - self._start
+    
+    def _drain(self, timeout=30):
+        deadline = time.perf_counter() + timeout
+        while self._pool.tasks.qsize() and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.1)
+        self.monitor.sample_states(time.perf_counter() - self._start)
+
+def report(monitor, elapsed, harness):
+    queue = sorted(monitor.queue_delays)
+    handler = sorted(monitor.handler_times)
+    db_times = sorted(monitor.db_times)
+    first, last = monitor.state_samples[0], monitor.state_samples[-1]
+    return {
+        "elapsed_s": elapsed,
+        "updates_handled": monitor.completed,
+        "throughput_per_s": monitor.completed / elapsed if elapsed else 0.0,
+        "queue_delay_ms": {name: percentile(queue, q) * 1000 for name, q in (("p50", .5), ("p95", .95), ("p99", .99))},
+        "handler_ms": {name: percentile(handler, q) * 1000 for name, q in (("p50", .5), ("p95", .95), ("p99", .99))},
+        "db_call_ms": {name: percentile(db_times, q) * 1000 for name, q in (("p50", .5), ("p95", .95), ("p99", .99))},
+        "db_calls": len(db_times),
+        "sqlite_lock_errors": monitor.lock_errors,
+        "handler_errors": monitor.handler_errors,
+        "user_states": {
+            "users": last["users"],
+            "bytes": last["bytes"],
+            "growth_bytes": last["bytes"] - first["bytes"],
+            "samples": monitor.state_samples
+        },
+        "openai_requests": harness.fake_openai.requests,
+        "ai_retries": harness.main.metrics.AI_RETRIES.total(),
+        "ai_hedges": harness.main.metrics.AI_HEDGES.total(),
+        "ai_fallbacks": harness.main.metrics.AI_FALLBACKS.total()
+    }
+
+def print_report(result):
+    print(f"⏱️  {result['updates_handled']} updates in {result['elapsed_s']:.1f}s "
+          f"({result['throughput_per_s']:.1f}/s)")
+    for label, key in (("Queueing delay", "queue_delay_ms"), ("Handler time", "handler_ms"), ("DB call", "db_call_ms")):
+        values = result[key]
+        print(f"{label:<15} p50 {values['p50']:8.2f}ms  p95 {values['p95']:8.2f}ms  p99 {values['p99']:8.2f}ms")
+    states = result["user_states"]
+    print(f"user_states     {states['users']} users, {states['bytes'] / 1024:.1f}KB "
+          f"(+{states['growth_bytes'] / 1024:.1f}KB during the run)")
+    print(f"SQLite locks    {result['sqlite_lock_errors']} 'database is locked' errors over {result['db_calls']} calls")
+    print(f"Errors          {result['handler_errors']} handler exceptions, "
+          f"{result['openai_requests']} fake OpenAI requests")
+    print(f"AI resilience   {result['ai_retries']} retries, {result['ai_hedges']} hedged requests, "
+          f"{result['ai_fallbacks']} cached fallbacks")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-user load generator for the bot")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of synthetic load")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between a user's updates")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="flow=weight,... (default: realistic mix)")
+    parser.add_argument("--wardrobe-min", type=int, default=5)
+    parser.add_argument("--wardrobe-max", type=int, default=60)
+    parser.add_argument("--bulk-size", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=2, help="bot worker threads (telebot default: 2)")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--openai-jitter", type=float, default=0.5)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="share of completions failing with 500")
+    parser.add_argument("--openai-tail-rate", type=float, default=0.0, help="share of completions that are slow")
+    parser.add_argument("--openai-tail-latency", type=float, default=10.0, help="seconds a slow completion takes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="write the synthesized updates to a JSONL file for replay")
+    parser.add_argument("--replay", help="replay updates from a JSONL file instead of synthesizing")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier (0 = as fast as possible)")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    
+    from telebot import util
+    
+    harness = BotHarness(openai_latency=args.openai_latency, openai_jitter=args.openai_jitter,
+                         openai_error_rate=args.openai_error_rate, threaded=True)
+    harness.fake_openai.tail_rate = args.openai_tail_rate
+    harness.fake_openai.tail_latency = args.openai_tail_latency
+    harness.main.bot.worker_pool = util.ThreadPool(harness.main.bot, num_threads=args.threads)
+    monitor = LoadMonitor(harness)
+    runner = LoadRunner(harness, monitor)
+    runner.record = bool(args.record)
+    
+    try:
+        if args.replay:
+            elapsed = runner.run_replay(args.replay, args.speed)
+        else:
+            elapsed = runner.run_synthetic(args.users, args.duration, args.think_time, args.mix,
+                                           (args.wardrobe_min, args.wardrobe_max), args.bulk_size, args.seed)
+        result = report(monitor, elapsed, harness)
+    finally:
+        harness.main.bot.worker_pool.close()
+        harness.close()
+    
+    print_report(result)
+    
+    if args.record:
+        with open(args.record, "w") as record_file:
+            for entry in runner.recorded:
+                record_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        print(f"💾 Recorded {len(runner.recorded)} updates to {args.record}")
+    
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
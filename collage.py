@@ -0,0 +1,139 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from config import THUMBNAILS_DIR, THUMBNAIL_SIZE, THUMBNAIL_CACHE_SIZE, COLLAGE_COLUMNS
+import metrics
+
+class CollageRenderer:
+    def __init__(self, thumbnails_dir=THUMBNAILS_DIR, thumbnail_size=THUMBNAIL_SIZE,
+                 cache_size=THUMBNAIL_CACHE_SIZE, columns=COLLAGE_COLUMNS):
+        self.thumbnails_dir = thumbnails_dir
+        self.thumbnail_size = thumbnail_size
+        self.cache_size = cache_size
+        self.columns = columns
+        
+        # Decoded thumbnails by item ID, least recently used first
+        self._thumbnails = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def cached_thumbnails(self):
+        """Number of decoded thumbnails held in memory"""
+        return len(self._thumbnails)
+    
+    def thumbnail_path(self, item_id):
+        """Path of the pre-generated thumbnail for an item"""
+        return os.path.join(self.thumbnails_dir, f"{item_id}_{self.thumbnail_size}.jpg")
+    
+    def ensure_thumbnail(self, item_id, photo_path):
+        """Generate the fixed-size thumbnail for an item if it doesn't exist yet"""
+        thumbnail_path = self.thumbnail_path(item_id)
+        if os.path.exists(thumbnail_path):
+            return thumbnail_path
+        
+        if not photo_path or not os.path.exists(photo_path):
+            return None
+        
+        try:
+            with Image.open(photo_path) as photo:
+                photo = ImageOps.exif_transpose(photo).convert("RGB")
+                # Pad rather than crop so the whole garment stays visible
+                thumbnail = ImageOps.pad(photo, (self.thumbnail_size, self.thumbnail_size),
+                                         color=(255, 255, 255))
+            
+            os.makedirs(self.thumbnails_dir, exist_ok=True)
+            temp_path = thumbnail_path + ".part"
+            thumbnail.save(temp_path, "JPEG", quality=85)
+            os.replace(temp_path, thumbnail_path)
+            return thumbnail_path
+        
+        except (OSError, ValueError) as e:
+            print(f"Error generating thumbnail for item {item_id}: {e}")
+            return None
+    
+    def remove_thumbnail(self, item_id):
+        """Drop an item's thumbnail from memory and disk"""
+        with self._lock:
+            self._thumbnails.pop(item_id, None)
+        
+        thumbnail_path = self.thumbnail_path(item_id)
+        if os.path.exists(thumbnail_path):
+            try:
+                os.remove(thumbnail_path)
+            except OSError:
+                pass  # Ignore errors if file deletion fails
+    
+    def _get_thumbnail(self, item):
+        """Get an item's decoded thumbnail, generating it on first use"""
+        item_id = item['id']
+        with self._lock:
+            thumbnail = self._thumbnails.get(item_id)
+            if thumbnail is not None:
+                self._thumbnails.move_to_end(item_id)
+                metrics.cache_result("thumbnail", True)
+                return thumbnail
+        
+        metrics.cache_result("thumbnail", False)
+        thumbnail_path = self.ensure_thumbnail(item_id, item.get('photo_path'))
+        if not thumbnail_path:
+            return None
+        
+        with Image.open(thumbnail_path) as image:
+            thumbnail = image.convert("RGB")
+        
+        with self._lock:
+            self._thumbnails[item_id] = thumbnail
+            self._thumbnails.move_to_end(item_id)
+            while len(self._thumbnails) > self.cache_size:
+                self._thumbnails.popitem(last=False)
+        
+        return thumbnail
+    
+    def stale_keys(self, cache_keys, item_id):
+        """The collage keys among `cache_keys` that show an item"""
+        item_id = str(item_id)
+        return [key for key in cache_keys if item_id in key.split(":")[1].split(",")]
+    
+    def cache_key(self, user_id, items):
+        """Key identifying a collage of these items, independent of their order"""
+        item_ids = sorted(item['id'] for item in items if item.get('photo_path'))
+        if not item_ids:
+            return None
+        return f"{user_id}:{','.join(str(item_id) for item_id in item_ids)}:{self.thumbnail_size}"
+    
+    def render(self, items):
+        """Compose the items' thumbnails into one JPEG collage
+        
+        Returns (BytesIO ready to send, items shown), or (None, []) if no item
+        has a usable photo. Items whose thumbnail can't be made are left out,
+        so the collage should be cached under the key of the items shown.
+        """
+        thumbnails = []
+        shown = []
+        for item in sorted(items, key=lambda item: item['id']):
+            if item.get('photo_path'):
+                thumbnail = self._get_thumbnail(item)
+                if thumbnail is not None:
+                    thumbnails.append(thumbnail)
+                    shown.append(item)
+        
+        if not thumbnails:
+            return None, []
+        
+        columns = min(self.columns, len(thumbnails))
+        rows = (len(thumbnails) + columns - 1) // columns
+        size = self.thumbnail_size
+        
+        collage = Image.new("RGB", (columns * size, rows * size), (255, 255, 255))
+        for index, thumbnail in enumerate(thumbnails):
+            row, column = divmod(index, columns)
+            collage.paste(thumbnail, (column * size, row * size))
+        
+        output = io.BytesIO()
+        collage.save(output, "JPEG", quality=85)
+        output.seek(0)
+        output.name = "outfit.jpg"
+        return output, shown
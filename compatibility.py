@@ -0,0 +1,294 @@
+import re
+import threading
+from collections import OrderedDict
+
+from config import COMPATIBILITY_CACHE_SIZE, COMPATIBILITY_MIN_SCORE
+import metrics
+
+# How well two categories complete each other in one outfit (0 = never worn together)
+CATEGORY_COMPLEMENT = {
+    frozenset(["tops", "bottoms"]): 1.0,
+    frozenset(["tops", "outerwear"]): 0.7,
+    frozenset(["tops", "shoes"]): 0.6,
+    frozenset(["tops", "accessories"]): 0.5,
+    frozenset(["bottoms", "shoes"]): 0.8,
+    frozenset(["bottoms", "outerwear"]): 0.7,
+    frozenset(["bottoms", "accessories"]): 0.5,
+    frozenset(["dresses", "shoes"]): 0.9,
+    frozenset(["dresses", "outerwear"]): 0.7,
+    frozenset(["dresses", "accessories"]): 0.7,
+    frozenset(["outerwear", "shoes"]): 0.5,
+    frozenset(["outerwear", "accessories"]): 0.4,
+    frozenset(["shoes", "accessories"]): 0.4,
+    frozenset(["accessories"]): 0.3
+}
+
+# Pieces an outfit is built around, and the categories that complete it, most important first
+OUTFIT_SLOTS = {
+    "tops": ("bottoms", "shoes", "outerwear", "accessories"),
+    "dresses": ("shoes", "outerwear", "accessories")
+}
+
+SEASON_ORDER = ("spring", "summer", "fall", "winter")
+
+OCCASION_AFFINITY = {
+    frozenset(["casual", "sport"]): 0.5,
+    frozenset(["casual", "party"]): 0.4,
+    frozenset(["business", "formal"]): 0.7,
+    frozenset(["party", "formal"]): 0.6,
+    frozenset(["casual", "business"]): 0.3
+}
+
+NEUTRAL_COLORS = {"black", "white", "grey", "gray", "beige", "navy", "cream", "denim", "brown", "khaki", "tan"}
+ACCENT_COLORS = {"red", "blue", "green", "yellow", "orange", "pink", "purple", "burgundy", "olive", "teal"}
+COLOR_PAIRS = {
+    frozenset(["blue", "orange"]), frozenset(["red", "green"]), frozenset(["purple", "yellow"]),
+    frozenset(["pink", "olive"]), frozenset(["burgundy", "olive"]), frozenset(["teal", "orange"])
+}
+
+# Share of the pair score each signal contributes
+WEIGHTS = {"category": 0.45, "season": 0.2, "occasion": 0.2, "style": 0.15}
+
+_WORD = re.compile(r"[a-z]+")
+
+def _beats(score, item_id, current):
+    """Whether (score, item_id) is a better partner than `current`; equal scores go to the lower ID"""
+    return current is None or score > current[0] or (score == current[0] and item_id < current[1])
+
+class ItemFeatures:
+    """What the pair score needs to know about one item, extracted once"""
+    __slots__ = ("item_id", "name", "category", "seasons", "occasion", "colors", "tags")
+    
+    def __init__(self, item):
+        self.item_id = item["id"]
+        self.name = item["name"]
+        self.category = (item.get("category") or "").lower()
+        season = (item.get("season") or "").lower()
+        self.seasons = set(SEASON_ORDER) if season in ("", "all") else {season}
+        self.occasion = (item.get("occasion") or "").lower() or None
+        
+        tags = {tag.lower() for tag in item.get("tags") or []}
+        words = set(_WORD.findall(self.name.lower())) | {word for tag in tags for word in _WORD.findall(tag)}
+        self.colors = words & (NEUTRAL_COLORS | ACCENT_COLORS)
+        self.tags = tags - self.colors
+
+def _season_score(a, b):
+    if a.seasons & b.seasons:
+        return 1.0
+    # Adjacent seasons still work for layering
+    for season in a.seasons:
+        index = SEASON_ORDER.index(season) if season in SEASON_ORDER else None
+        if index is not None and {SEASON_ORDER[index - 1], SEASON_ORDER[(index + 1) % 4]} & b.seasons:
+            return 0.5
+    return 0.0
+
+def _occasion_score(a, b):
+    if not a.occasion or not b.occasion:
+        return 0.5
+    if a.occasion == b.occasion:
+        return 1.0
+    return OCCASION_AFFINITY.get(frozenset([a.occasion, b.occasion]), 0.1)
+
+def _style_score(a, b):
+    """Color harmony, plus a bonus for shared tags"""
+    if not a.colors or not b.colors:
+        color = 0.6
+    elif a.colors <= NEUTRAL_COLORS or b.colors <= NEUTRAL_COLORS:
+        color = 0.9
+    elif a.colors & b.colors:
+        color = 0.7
+    elif any(frozenset([x, y]) in COLOR_PAIRS for x in a.colors for y in b.colors):
+        color = 0.8
+    else:
+        color = 0.3
+    
+    union = a.tags | b.tags
+    overlap = len(a.tags & b.tags) / len(union) if union else 0.0
+    return min(1.0, color + 0.3 * overlap)
+
+def pair_score(a, b):
+    """Compatibility of two items, 0 (never together) to 1"""
+    category = CATEGORY_COMPLEMENT.get(frozenset([a.category, b.category]), 0.0)
+    if not category:
+        return 0.0
+    return (WEIGHTS["category"] * category
+            + WEIGHTS["season"] * _season_score(a, b)
+            + WEIGHTS["occasion"] * _occasion_score(a, b)
+            + WEIGHTS["style"] * _style_score(a, b))
+
+class CompatibilityMatrix:
+    """Pair scores for one user's wardrobe, kept up to date item by item
+    
+    Adding, updating or removing an item rescores it against every other item
+    (O(n)) instead of rebuilding the n² matrix. Each item also keeps its best
+    partner per category, so an outfit around an anchor is assembled from a
+    handful of lookups.
+    """
+    
+    def __init__(self, clothes=()):
+        self.items = {}
+        self.features = {}
+        self.scores = {}  # item_id -> {other_id: score}, only for pairs that can be worn together
+        self.best = {}  # item_id -> {category: (score, other_id)}
+        self._ranked = None  # every anchor's outfit, best first; None until needed after a change
+        for item in clothes:
+            self.add(item)
+    
+    def __len__(self):
+        return len(self.features)
+    
+    def add(self, item):
+        """Score a new (or changed) item against the rest of the wardrobe"""
+        if item["id"] in self.features:
+            self.remove(item["id"])
+        
+        self._ranked = None
+        features = ItemFeatures(item)
+        row = {}
+        best = {}
+        for other_id, other in self.features.items():
+            score = pair_score(features, other)
+            if score < COMPATIBILITY_MIN_SCORE:
+                continue
+            row[other_id] = score
+            self.scores[other_id][features.item_id] = score
+            if _beats(score, other_id, best.get(other.category)):
+                best[other.category] = (score, other_id)
+            other_best = self.best[other_id]
+            if _beats(score, features.item_id, other_best.get(features.category)):
+                other_best[features.category] = (score, features.item_id)
+        
+        self.items[features.item_id] = item
+        self.features[features.item_id] = features
+        self.scores[features.item_id] = row
+        self.best[features.item_id] = best
+    
+    def remove(self, item_id):
+        """Drop an item, re-picking the best partner of items that pointed at it"""
+        features = self.features.pop(item_id, None)
+        if features is None:
+            return
+        self._ranked = None
+        del self.items[item_id]
+        self.best.pop(item_id)
+        for other_id in self.scores.pop(item_id):
+            self.scores[other_id].pop(item_id, None)
+            if self.best[other_id].get(features.category, (0.0, None))[1] == item_id:
+                self._refresh_best(other_id, features.category)
+    
+    def _refresh_best(self, item_id, category):
+        candidates = [(score, other_id) for other_id, score in self.scores[item_id].items()
+                      if self.features[other_id].category == category]
+        if candidates:
+            # Same tie-break as add(), so the result doesn't depend on the order items came in
+            self.best[item_id][category] = max(candidates, key=lambda candidate: (candidate[0], -candidate[1]))
+        else:
+            self.best[item_id].pop(category, None)
+    
+    def score(self, item_id, other_id):
+        return self.scores.get(item_id, {}).get(other_id, 0.0)
+    
+    def outfit_for(self, anchor_id):
+        """The best outfit around an anchor item as (score, [item IDs]), or None if it has no partners"""
+        features = self.features.get(anchor_id)
+        slots = OUTFIT_SLOTS.get(features.category) if features else None
+        if not slots:
+            return None
+        
+        best = self.best[anchor_id]
+        item_ids = [anchor_id]
+        total = 0.0
+        for category in slots:
+            if category in best:
+                score, other_id = best[category]
+                item_ids.append(other_id)
+                total += score
+        if len(item_ids) == 1:
+            return None
+        # Partners that clash with each other pull the outfit down
+        for i in range(1, len(item_ids)):
+            for j in range(i + 1, len(item_ids)):
+                total += self.score(item_ids[i], item_ids[j])
+        pairs = len(item_ids) - 1 + (len(item_ids) - 1) * (len(item_ids) - 2) / 2
+        return total / pairs, item_ids
+    
+    def top_outfits(self, k=5):
+        """The k best-scoring outfits, one per anchor item
+        
+        The ranking of every anchor's outfit is kept until the next add or
+        remove, so between wardrobe changes this is a slice, O(k). Ranking
+        again after a change is a few lookups in `best` per top or dress and
+        never rescans pairs.
+        """
+        if self._ranked is None:
+            outfits = (self.outfit_for(item_id) for item_id, features in self.features.items()
+                       if features.category in OUTFIT_SLOTS)
+            self._ranked = sorted((outfit for outfit in outfits if outfit), reverse=True)
+        return self._ranked[:k]
+
+class CompatibilityIndex:
+    """Compatibility matrices for recently active users, maintained through Database change hooks"""
+    
+    def __init__(self, db, cache_size=COMPATIBILITY_CACHE_SIZE):
+        self.db = db
+        self.cache_size = cache_size
+        self._matrices = OrderedDict()  # user_id -> (wardrobe version, matrix)
+        self._lock = threading.Lock()
+    
+    def cached_matrices(self):
+        """Number of user matrices held in memory"""
+        return len(self._matrices)
+    
+    def get(self, user_id, clothes=None, version=None):
+        """The user's matrix, built from `clothes` (or the database) if it isn't in memory
+        
+        `version` is the wardrobe version read before `clothes` was. A matrix
+        built from clothes without one is used once but not kept, since a
+        change after they were read would leave it labelled with a newer
+        version than its contents.
+        """
+        keep = version is not None or clothes is None
+        if version is None:
+            version = self.db.get_wardrobe_version(user_id)
+        with self._lock:
+            cached = self._matrices.get(user_id)
+            if cached and cached[0] == version:
+                self._matrices.move_to_end(user_id)
+                metrics.cache_result("compatibility", True)
+                return cached[1]
+        
+        metrics.cache_result("compatibility", False)
+        matrix = CompatibilityMatrix(clothes if clothes is not None else self.db.get_user_clothes(user_id))
+        if not keep:
+            return matrix
+        with self._lock:
+            self._matrices[user_id] = (version, matrix)
+            self._matrices.move_to_end(user_id)
+            while len(self._matrices) > self.cache_size:
+                self._matrices.popitem(last=False)
+        return matrix
+    
+    def on_change(self, user_id, action, item_id):
+        """Database change hook: rescore the one item that changed in the user's cached matrix"""
+        with self._lock:
+            if action == "reload":
+                self._matrices.pop(user_id, None)
+                return
+            cached = self._matrices.get(user_id)
+        if cached is None:
+            return
+        
+        item = self.db.get_clothing_item(user_id, item_id) if action != "delete" else None
+        with self._lock:
+            matrix = cached[1]
+            if item is None:
+                matrix.remove(item_id)
+            else:
+                matrix.add(item)
+            self._matrices[user_id] = (self.db.get_wardrobe_version(user_id), matrix)
+    
+    def top_outfits(self, user_id, clothes=None, k=5, version=None):
+        """The user's k best outfits as lists of item dicts, best first"""
+        matrix = self.get(user_id, clothes, version)
+        with self._lock:
+            return [[matrix.items[item_id] for item_id in item_ids] for _, item_ids in matrix.top_outfits(k)]
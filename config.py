@@ -7,11 +7,149 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', 'Your telegram bot token')
 
 # OpenAI API Key
-OPENAI_API_KEY = os.getenv('Your Open AI key')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# OpenAI-compatible endpoint (defaults to the official API)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
 
 # Database
-DATABASE_PATH = 'outfitify.db'
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'outfitify.db')
+
+# Database sharding (users are spread over DATABASE_SHARDS SQLite files; the count can grow, not shrink)
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', '1'))
+SHARD_ID_BLOCK = 100  # item/outfit IDs reserved from the catalog at a time
+SHARD_MOVE_TIMEOUT = 5  # seconds a move waits for a user's running queries before giving up
+SHARD_REBALANCE_PAUSE = 0.05  # seconds between user moves during /rebalance
+
+# Backups of the database shards and photos (BACKUP_INTERVAL of 0 turns scheduled snapshots off)
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '21600'))  # seconds between snapshots
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))  # snapshots kept; older ones, and photos only they use, are deleted
+BACKUP_PAGES = 256  # database pages copied per step, each step a short read transaction
+BACKUP_STEP_PAUSE = 0.005  # seconds between steps, so a backup doesn't saturate the disk
+BACKUP_MAX_RESTARTS = 3  # writes between steps restart the copy; after this many it is done in a single step
+
+# Storage maintenance (MAINTENANCE_INTERVAL of 0 turns it off)
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', '3600'))  # seconds between runs
+OUTFIT_ARCHIVE_DAYS = int(os.getenv('OUTFIT_ARCHIVE_DAYS', '180'))  # saved outfits older than this move to outfits_archive, 0 keeps them
+ARCHIVE_BATCH_SIZE = 500  # outfits moved per transaction
+VACUUM_STEP_PAGES = 256  # free pages handed back to the filesystem per transaction
+MAINTENANCE_MAX_STEPS = 40  # archive batches and vacuum steps per shard per run
+MAINTENANCE_STEP_PAUSE = 0.05  # seconds between transactions, so other writers get the shard in between
+MAINTENANCE_CACHE_KB = 2048  # page cache of maintenance connections, so vacuuming doesn't grow memory use
+MAINTENANCE_CONVERT_MAX_SIZE = 64 * 1024 * 1024  # older shards up to this size switch to incremental auto-vacuum on their own
+OPTIMIZE_ANALYSIS_LIMIT = 400  # rows ANALYZE samples per index
 
 # Bot settings
 MAX_PHOTO_SIZE = 10 * 1024 * 1024  # 10MB
 SUPPORTED_PHOTO_FORMATS = ['jpg', 'jpeg', 'png', 'webp'] 
+
+# Photo storage
+PHOTOS_DIR = 'photos'
+PHOTO_DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 64KB
+PHOTO_DOWNLOAD_TIMEOUT = 30  # seconds
+
+# Outfit collages
+THUMBNAILS_DIR = os.path.join(PHOTOS_DIR, 'thumbnails')
+THUMBNAIL_SIZE = 256  # pixels, square
+THUMBNAIL_CACHE_SIZE = 512  # decoded thumbnails kept in memory
+COLLAGE_COLUMNS = 3
+COLLAGE_CACHE_DAYS = 90  # sent collage file IDs older than this are dropped by maintenance
+COLLAGE_CACHE_MAX_ENTRIES = 50000  # newest sent collage file IDs kept; maintenance drops the rest
+
+# Outfit item resolution
+RESOLVER_MATCH_THRESHOLD = 0.5  # minimum fuzzy score to accept a match
+RESOLVER_CACHE_SIZE = 1024  # users whose name index is kept in memory
+
+# Item compatibility
+COMPATIBILITY_CACHE_SIZE = 1024  # users whose compatibility matrix is kept in memory
+COMPATIBILITY_MIN_SCORE = 0.3  # pairs scoring lower aren't stored
+COMPATIBILITY_TOP_OUTFITS = 5  # pre-scored combinations offered to the outfit prompts
+
+# Wardrobe search
+SEARCH_VECTOR_DIM = 512  # hashed features per item vector
+SEARCH_CACHE_SIZE = 256  # users whose vector index is kept in memory (about 2KB per item)
+SEARCH_RESULTS = 5  # items /find returns
+SEARCH_MIN_SCORE = 0.1  # cosine similarity below which /find leaves an item out
+OUTFIT_PROMPT_MAX_ITEMS = 40  # larger wardrobes send only the items most relevant to the request
+WARDROBE_PROMPT_CACHE_SIZE = 1024  # rendered wardrobe prompt sections kept in memory
+
+# AI result cache (answers for an unchanged wardrobe and the same request)
+RESULT_CACHE_SIZE = 2048  # (user, request) keys kept in memory
+RESULT_CACHE_VARIANTS = 3  # answers kept per key; More Suggestions cycles through them once they're all made
+
+# Duplicate photo detection
+DUPLICATE_MAX_DISTANCE = 6  # differing bits (of 64) at which two photos count as the same garment
+PHOTO_HASH_CACHE_SIZE = 1024  # users whose photo hash tree is kept in memory
+
+# Wardrobe export and import (/export, /import)
+EXPORT_BATCH_SIZE = 500  # rows read per query while exporting
+EXPORT_MAX_UPLOAD = 50 * 1024 * 1024  # Telegram bots can't send larger files
+IMPORT_CHUNK_SIZE = 500  # rows written per transaction while importing
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Telegram bots can't download larger files
+IMPORT_MAX_ITEMS = 100000  # items read from one file; the rest are left out
+IMPORT_MAX_LINE = 64 * 1024  # characters; longer lines are skipped
+
+# AI usage limits (0 disables a limit)
+AI_USER_DAILY_TOKEN_QUOTA = int(os.getenv('AI_USER_DAILY_TOKEN_QUOTA', '200000'))  # tokens per user per day
+AI_USER_RATE_LIMIT = int(os.getenv('AI_USER_RATE_LIMIT', '20'))  # AI requests per user per window
+AI_USER_RATE_WINDOW = 60  # seconds, sliding
+AI_DAILY_TOKEN_BUDGET = int(os.getenv('AI_DAILY_TOKEN_BUDGET', '0'))  # tokens per day for all users together
+USAGE_FLUSH_INTERVAL = 5  # seconds between usage writes
+USAGE_FLUSH_BATCH = 200  # buffered usage rows that trigger an early write
+AI_SYSTEM_USER_ID = 0  # off-peak precomputation is recorded under this id, with no per-user quota or rate limit
+
+# OpenAI resilience
+AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', '30'))  # seconds per request for methods not listed below
+AI_TIMEOUTS = {
+    'analyze_clothing_photo': 45,  # vision requests upload the photo
+    'generate_outfit': 40,
+    'analyze_text_description': 20,
+    'suggest_outfit_improvements': 20,
+    'generate_outfit_suggestions': 20
+}
+AI_MAX_RETRIES = 2  # retries of timeouts, connection errors, 429 and 5xx responses
+AI_RETRY_BASE_DELAY = 0.5  # seconds, doubled per retry with full jitter
+AI_RETRY_MAX_DELAY = 8  # seconds
+AI_BREAKER_FAILURES = 5  # failures in a row that open the circuit
+AI_BREAKER_RESET = 30  # seconds the circuit stays open before a probe request
+AI_CONCURRENCY_INITIAL = 8  # concurrent requests to start with, adjusted by AIMD
+AI_CONCURRENCY_MIN = 1
+AI_CONCURRENCY_MAX = int(os.getenv('AI_CONCURRENCY_MAX', '32'))
+AI_CONCURRENCY_WAIT = 5  # seconds a call waits for a free slot before falling back
+AI_LATENCY_TARGET = 15  # seconds; slower requests count as overload
+AI_HEDGE_AFTER = float(os.getenv('AI_HEDGE_AFTER', '0'))  # seconds before a duplicate request is sent, 0 disables
+AI_FALLBACK_CACHE_SIZE = 256  # last good answers kept to serve while OpenAI is failing
+
+# Tracing (TRACE_SAMPLE_RATE of 0 turns it off)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))  # share of updates traced, 0-1
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')  # JSON Lines export
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT')  # OTLP/HTTP collector, used instead of TRACE_FILE
+TRACE_BATCH_SIZE = 256  # spans per export
+TRACE_FLUSH_INTERVAL = 2  # seconds
+
+# Slow query log
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '50'))  # statements at least this slow are logged with their plan
+SLOW_QUERY_LOG_SIZE = 50  # slow statements kept for /dbstats
+
+# Admins (comma-separated Telegram user IDs) can use /dbstats, /stats, /rebalance and /backup
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+
+# Metrics (Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics, 0 disables)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Runtime stats and background jobs
+STATS_SAMPLE_INTERVAL = 30  # seconds between samples for AI call rates
+STATS_RATE_WINDOW = 300  # seconds AI call rates and latency are averaged over
+WAL_CHECKPOINT_INTERVAL = 300  # seconds between passive WAL checkpoints
+PHOTO_SCAN_INTERVAL = 600  # seconds between recounts of the photos directory
+HEALTH_MAX_QUEUE_DEPTH = int(os.getenv('HEALTH_MAX_QUEUE_DEPTH', '100'))  # queued updates before /healthz reports 503
+
+# Off-peak precomputation of suggestions and today's outfit (empty PRECOMPUTE_HOURS turns it off)
+PRECOMPUTE_HOURS = os.getenv('PRECOMPUTE_HOURS', '2-6')  # local hours, start-end; '22-4' wraps past midnight
+PRECOMPUTE_INTERVAL = 120  # seconds between precompute runs within those hours
+PRECOMPUTE_BATCH = 5  # users refreshed per run, so other background jobs aren't held up for long
+PRECOMPUTE_ACTIVE_DAYS = 7  # users who made AI requests this many days back get precomputed results
+PRECOMPUTE_CACHE_SIZE = 4096  # precomputed values kept in memory, two per user
+PRECOMPUTE_SUGGESTION_ROUNDS = 2  # AI calls per suggestion pool, each adding about 5 suggestions
@@ -1,19 +1,358 @@
 import sqlite3
 import json
+import itertools
+import time
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
-from config import DATABASE_PATH
+from config import DATABASE_PATH, DATABASE_SHARDS, SHARD_ID_BLOCK, SHARD_MOVE_TIMEOUT, AI_SYSTEM_USER_ID
 import os
+import functools
+import metrics
+from tracing import tracer
+from query_stats import QueryStats
+
+# Columns update_clothing_item may change, with their prepared statements
+_UPDATE_ITEM_SQL = {
+    field: f'''
+            UPDATE clothes 
+            SET {field} = ?
+            WHERE id = ? AND user_id = ?
+        '''
+    for field in ('name', 'category', 'description', 'tags', 'season', 'occasion')
+}
+
+# Wardrobe versions start from the clock so they never repeat across restarts
+_wardrobe_version_counter = itertools.count(int(time.time() * 1000))
+
+# Tables with one row set per user, moved together when a user changes shard (outfit_items follow their outfits)
+_USER_TABLES = ('users', 'clothes', 'outfits', 'outfits_archive', 'ai_usage', 'user_preferences')
+
+def shard_path(db_path, shard_id):
+    """File of a shard: shard 0 is DATABASE_PATH itself, shard N is e.g. outfitify.shardN.db"""
+    if shard_id == 0:
+        return db_path
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{shard_id}{ext}"
+
+class ShardMoveError(Exception):
+    """Raised when a user can't be moved to another shard right now"""
+
+def _instrumented(method):
+    """Record a Database method's latency and failures in the metrics registry, and trace it"""
+    name = method.__name__
+    traced_method = tracer.traced(f"db.{name}")(method)
+    
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return traced_method(*args, **kwargs)
+        except Exception:
+            metrics.DB_ERRORS.inc(method=name)
+            raise
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - start, method=name)
+    return wrapper
 
 class Database:
-    def __init__(self):
-        self.db_path = DATABASE_PATH
+    """SQLite storage, split by user over one or more shard files
+    
+    Shard 0 is DATABASE_PATH and also holds the catalog: the list of shards,
+    users placed away from their hashed shard, and ID sequences. A user's rows
+    live in the shard crc32(user_id) % shard count points at, unless the
+    catalog pins them elsewhere; pins are only made when the shard count grows
+    and are removed as rebalancing moves users to their hashed shard. Each
+    shard has its own write lock, so writes for users on different shards
+    don't wait on each other.
+    """
+    
+    def __init__(self, db_path=None, shards=None):
+        self.db_path = db_path or DATABASE_PATH
+        self.shard_count = shards or DATABASE_SHARDS
+        self._wardrobe_versions = {}
+        self.query_stats = QueryStats()
+        self.last_checkpoint = None
+        self._change_hooks = []
+        self._pins = {}  # user_id -> shard_id, for users not on their hashed shard
+        self._placement = threading.Condition()
+        self._moving = set()
+        self._open = Counter()  # user_id -> connections open on the user's shard
+        self._id_blocks = {}  # table -> [next ID, end of block]
+        self._id_lock = threading.Lock()
+        self._move_lock = threading.Lock()  # held by a move, or by a backup to keep users in place
+        self._connection_class = self._make_connection_class()
         self.init_database()
     
+    def _make_connection_class(self):
+        database = self
+        
+        class ShardConnection(self.query_stats.connection_factory):
+            """Connection that lets a user's pending shard move go ahead once it's closed"""
+            fenced_user = None
+            
+            def close(self):
+                try:
+                    super().close()
+                finally:
+                    if self.fenced_user is not None:
+                        database._release([self.fenced_user])
+                        self.fenced_user = None
+            
+            # Connections dropped by an exception still let the move through
+            __del__ = close
+        
+        return ShardConnection
+    
+    def shard_for(self, user_id):
+        """The shard holding a user's rows"""
+        shard_id = self._pins.get(user_id)
+        if shard_id is None:
+            shard_id = self.home_shard(user_id)
+        return shard_id
+    
+    def home_shard(self, user_id):
+        """The shard a user belongs on for the current shard count"""
+        return zlib.crc32(str(user_id).encode()) % self.shard_count
+    
+    def _acquire(self, user_ids):
+        """Wait out any move of these users, then hold them in place until _release"""
+        with self._placement:
+            while self._moving.intersection(user_ids):
+                self._placement.wait()
+            self._open.update(user_ids)
+    
+    def _release(self, user_ids):
+        with self._placement:
+            self._open.subtract(user_ids)
+            for user_id in user_ids:
+                if self._open[user_id] <= 0:
+                    del self._open[user_id]
+            self._placement.notify_all()
+    
+    @contextmanager
+    def pause_moves(self):
+        """Keep every user on their current shard for the duration of the block, e.g. while the shards are backed up
+        
+        Waits for a move in progress to finish; moves started meanwhile wait for the block to end.
+        """
+        with self._move_lock:
+            yield
+    
+    @contextmanager
+    def _fenced(self, user_ids):
+        """Keep users from being moved to another shard for the duration of the block"""
+        user_ids = set(user_ids)
+        self._acquire(user_ids)
+        try:
+            yield
+        finally:
+            self._release(user_ids)
+    
+    def _connect(self, user_id=None):
+        """Open a connection to the user's shard (or the catalog), timing statements into query_stats
+        
+        The user can't move shard until the connection is closed.
+        """
+        if user_id is None:
+            return self._connect_shard(0)
+        self._acquire([user_id])
+        try:
+            conn = self._connect_shard(self.shard_for(user_id))
+        except Exception:
+            self._release([user_id])
+            raise
+        conn.fenced_user = user_id
+        return conn
+    
+    def _connect_shard(self, shard_id):
+        return sqlite3.connect(shard_path(self.db_path, shard_id), factory=self._connection_class)
+    
+    def query_all(self, sql, params=()):
+        """Run a read-only statement on every shard: [(shard_id, rows)], for admin and cross-user queries"""
+        results = []
+        for shard_id in range(self.shard_count):
+            conn = self._connect_shard(shard_id)
+            try:
+                results.append((shard_id, conn.execute(sql, params).fetchall()))
+            finally:
+                conn.close()
+        return results
+    
+    def add_change_hook(self, hook):
+        """Call hook(user_id, action, item_id) after a clothing item is added, updated or deleted
+        
+        Bulk inserts call it once with action 'reload' and item_id None: drop
+        whatever is cached for the user rather than patching it item by item.
+        """
+        self._change_hooks.append(hook)
+    
+    def _notify_change(self, user_id, action, item_id):
+        for hook in self._change_hooks:
+            try:
+                hook(user_id, action, item_id)
+            except Exception as e:
+                print(f"Error in clothes change hook: {e}")
+    
+    def get_query_report(self, limit=10):
+        """Per-statement stats, most total time first, each with its query plan"""
+        report = self.query_stats.snapshot()[:limit]
+        conn = sqlite3.connect(self.db_path)
+        for statement in report:
+            statement['plan'] = QueryStats.explain(conn, statement['sql'])
+        conn.close()
+        return report
+    
+    def file_sizes(self, shard_id=None):
+        """Sizes in bytes of the database files and write-ahead logs (all shards, or one), read from the filesystem"""
+        sizes = {'db': 0, 'wal': 0}
+        for shard in range(self.shard_count) if shard_id is None else (shard_id,):
+            path = shard_path(self.db_path, shard)
+            for name, file_path in (('db', path), ('wal', path + '-wal')):
+                try:
+                    sizes[name] += os.stat(file_path).st_size
+                except OSError:
+                    pass
+        return sizes
+    
+    def pinned_users(self):
+        """Number of users not on the shard their ID hashes to"""
+        return len(self._pins)
+    
+    def shard_stats(self):
+        """Users, items and file sizes per shard"""
+        counts = self.query_all('SELECT COUNT(DISTINCT user_id), COUNT(*) FROM clothes')
+        pinned = Counter(self._pins.values())
+        return [{
+            'shard': shard_id,
+            'users': rows[0][0],
+            'items': rows[0][1],
+            'pinned_users': pinned[shard_id],
+            **self.file_sizes(shard_id)
+        } for shard_id, rows in counts]
+    
+    @_instrumented
+    def checkpoint(self, mode='PASSIVE'):
+        """Copy each shard's write-ahead log back into its database file without blocking writers"""
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(f"Unknown checkpoint mode {mode}")
+        
+        start = time.perf_counter()
+        busy = log_pages = checkpointed_pages = 0
+        for shard_id in range(self.shard_count):
+            conn = sqlite3.connect(shard_path(self.db_path, shard_id))
+            shard_busy, shard_log_pages, shard_checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+            conn.close()
+            busy += shard_busy
+            log_pages += max(shard_log_pages, 0)
+            checkpointed_pages += max(shard_checkpointed, 0)
+        
+        self.last_checkpoint = {
+            'at': time.time(),
+            'mode': mode,
+            'busy': bool(busy),
+            'log_pages': log_pages,
+            'checkpointed_pages': checkpointed_pages,
+            'seconds': time.perf_counter() - start
+        }
+        return self.last_checkpoint
+    
     def init_database(self):
-        """Initialize database tables"""
+        """Initialize the catalog and the tables of every shard"""
+        self._init_catalog()
+        for shard_id in range(self.shard_count):
+            self._init_shard(shard_path(self.db_path, shard_id))
+        self._place_existing_users()
+    
+    def _init_catalog(self):
+        """Create the catalog tables in shard 0 and load the shard count and pins"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        # Only takes effect before the first table is created; older files are converted by maintenance.py
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY,
+                path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Users whose rows aren't on the shard their ID hashes to
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_shards (
+                user_id INTEGER PRIMARY KEY,
+                shard_id INTEGER
+            )
+        ''')
+        
+        # Item and outfit IDs are handed out here so they stay unique when users move between shards
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS id_sequences (
+                name TEXT PRIMARY KEY,
+                next_id INTEGER
+            )
+        ''')
+        
+        # A database from before sharding is shard 0 on its own
+        cursor.execute('SELECT COUNT(*) FROM shards')
+        self._previous_shard_count = cursor.fetchone()[0] or 1
+        if self.shard_count < self._previous_shard_count:
+            print(f"DATABASE_SHARDS is {self.shard_count} but {self._previous_shard_count} shards exist; "
+                  f"using {self._previous_shard_count} (shards can't be removed)")
+            self.shard_count = self._previous_shard_count
+        
+        cursor.execute('SELECT user_id, shard_id FROM user_shards')
+        self._pins = dict(cursor.fetchall())
+        
+        conn.commit()
+        conn.close()
+    
+    def _place_existing_users(self):
+        """After the shard count grows, pin users whose rows are where the old count put them"""
+        if self.shard_count > self._previous_shard_count:
+            previous_count = self._previous_shard_count
+            pins = []
+            for shard_id in range(previous_count):
+                conn = self._connect_shard(shard_id)
+                cursor = conn.cursor()
+                user_ids = set()
+                for table in _USER_TABLES:
+                    cursor.execute(f'SELECT DISTINCT user_id FROM {table} WHERE user_id IS NOT NULL')
+                    user_ids.update(row[0] for row in cursor.fetchall())
+                conn.close()
+                pins.extend((user_id, shard_id) for user_id in user_ids
+                            if user_id not in self._pins and self.home_shard(user_id) != shard_id)
+            
+            conn = sqlite3.connect(self.db_path)
+            conn.executemany('INSERT OR REPLACE INTO user_shards (user_id, shard_id) VALUES (?, ?)', pins)
+            conn.commit()
+            conn.close()
+            self._pins.update(pins)
+            if pins:
+                print(f"Shards grew from {previous_count} to {self.shard_count}; {len(pins)} users stay put until rebalanced")
+        
         conn = sqlite3.connect(self.db_path)
+        conn.executemany('INSERT OR IGNORE INTO shards (shard_id, path) VALUES (?, ?)',
+                         [(shard_id, shard_path(self.db_path, shard_id)) for shard_id in range(self.shard_count)])
+        conn.commit()
+        conn.close()
+    
+    def _init_shard(self, path):
+        """Create (or migrate) the tables of one shard"""
+        conn = sqlite3.connect(path)
         cursor = conn.cursor()
         
+        # Free pages can then be handed back to the filesystem a few at a time (see maintenance.py)
+        cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        
+        # Write-ahead logging lets readers run while a write is in progress
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # Users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -37,10 +376,32 @@ class Database:
                 photo_path TEXT,
                 tags TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                photo_unique_id TEXT,
+                season TEXT,
+                occasion TEXT,
+                photo_hash TEXT,
                 FOREIGN KEY (user_id) REFERENCES users (user_id)
             )
         ''')
         
+        # Databases created before these columns existed need them added, in table order
+        cursor.execute('PRAGMA table_info(clothes)')
+        clothes_columns = [row[1] for row in cursor.fetchall()]
+        for column in ('photo_unique_id', 'season', 'occasion', 'photo_hash'):
+            if column not in clothes_columns:
+                cursor.execute(f'ALTER TABLE clothes ADD COLUMN {column} TEXT')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_clothes_photo_unique_id
+            ON clothes (user_id, photo_unique_id)
+        ''')
+        
+        # Also keeps each user's rows in ID order, for paging through large wardrobes
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_clothes_user_id
+            ON clothes (user_id)
+        ''')
+        
         # Outfits table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS outfits (
@@ -56,6 +417,84 @@ class Database:
             )
         ''')
         
+        # Items of each outfit, so outfits can be looked up by item
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outfit_items (
+                outfit_id INTEGER,
+                item_id INTEGER,
+                PRIMARY KEY (outfit_id, item_id),
+                FOREIGN KEY (outfit_id) REFERENCES outfits (id)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outfit_items_item_id
+            ON outfit_items (item_id)
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outfits_user_id
+            ON outfits (user_id)
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outfits_created_at
+            ON outfits (created_at)
+        ''')
+        
+        # Old outfits, moved out of the outfits and outfit_items B-trees (see archive_outfits)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outfits_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                name TEXT,
+                description TEXT,
+                clothes_ids TEXT,
+                season TEXT,
+                occasion TEXT,
+                created_at TIMESTAMP,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outfits_archive_user_id
+            ON outfits_archive (user_id)
+        ''')
+        
+        # Telegram file IDs of sent outfit collages, kept with the catalog
+        if path == self.db_path:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS collage_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    file_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_collage_cache_created_at
+                ON collage_cache (created_at)
+            ''')
+        
+        # OpenAI token usage per user, day and AIService method
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_usage (
+                user_id INTEGER,
+                day TEXT,
+                method TEXT,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                requests INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, day, method)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_ai_usage_day
+            ON ai_usage (day)
+        ''')
+        
         # User preferences table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS user_preferences (
@@ -71,9 +510,46 @@ class Database:
         conn.commit()
         conn.close()
     
+    def _next_id(self, table):
+        """A new row ID for clothes or outfits, unique across all shards"""
+        with self._id_lock:
+            block = self._id_blocks.get(table)
+            if block is None or block[0] >= block[1]:
+                start = self._allocate_id_block(table)
+                block = self._id_blocks[table] = [start, start + SHARD_ID_BLOCK]
+            block[0] += 1
+            return block[0] - 1
+    
+    def _allocate_id_block(self, table):
+        """Reserve the next SHARD_ID_BLOCK IDs in the catalog, past any ID already in use"""
+        highest = max((rows[0][0] or 0) for _, rows in self.query_all(f'SELECT MAX(id) FROM {table}'))
+        
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT next_id FROM id_sequences WHERE name = ?', (table,)).fetchone()
+            start = max(row[0] if row else 1, highest + 1)
+            conn.execute('INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES (?, ?)',
+                         (table, start + SHARD_ID_BLOCK))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return start
+    
+    def get_wardrobe_version(self, user_id):
+        """Get a value that changes whenever the user's clothes change"""
+        version = self._wardrobe_versions.get(user_id)
+        if version is None:
+            version = self._wardrobe_versions.setdefault(user_id, next(_wardrobe_version_counter))
+        return version
+    
+    def _bump_wardrobe_version(self, user_id):
+        self._wardrobe_versions[user_id] = next(_wardrobe_version_counter)
+    
+    @_instrumented
     def add_user(self, user_id, username=None, first_name=None, last_name=None):
         """Add or update user"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -84,27 +560,36 @@ class Database:
         conn.commit()
         conn.close()
     
-    def add_clothing_item(self, user_id, name, category, description, photo_file_id=None, photo_path=None, tags=None):
+    @_instrumented
+    def add_clothing_item(self, user_id, name, category, description, photo_file_id=None, photo_path=None, tags=None, photo_unique_id=None,
+                          season=None, occasion=None, photo_hash=None):
         """Add a clothing item to the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         tags_json = json.dumps(tags) if tags else None
+        # Stored as hex: a 64-bit hash doesn't fit SQLite's signed integers
+        photo_hash_hex = f'{photo_hash:016x}' if photo_hash is not None else None
         
+        item_id = self._next_id('clothes')
         cursor.execute('''
-            INSERT INTO clothes (user_id, name, category, description, photo_file_id, photo_path, tags)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, name, category, description, photo_file_id, photo_path, tags_json))
-        
-        item_id = cursor.lastrowid
+            INSERT INTO clothes (id, user_id, name, category, description, photo_file_id, photo_path, tags, photo_unique_id, season,
+                                 occasion, photo_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (item_id, user_id, name, category, description, photo_file_id, photo_path, tags_json, photo_unique_id, season,
+              occasion, photo_hash_hex))
         conn.commit()
         conn.close()
         
+        self._bump_wardrobe_version(user_id)
+        self._notify_change(user_id, 'add', item_id)
+        
         return item_id
     
+    @_instrumented
     def delete_clothing_item(self, user_id, item_id):
         """Delete a clothing item by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         # First check if the item exists and belongs to the user
@@ -124,12 +609,31 @@ class Database:
             WHERE id = ? AND user_id = ?
         ''', (item_id, user_id))
         
+        # Saved outfits no longer link to it
+        cursor.execute('''
+            DELETE FROM outfit_items 
+            WHERE item_id = ?
+        ''', (item_id,))
+        
+        # Re-uploaded photos share one file, so keep it while other items use it
+        photo_path = item[1]
+        photo_in_use = False
+        if photo_path:
+            cursor.execute('''
+                SELECT 1 FROM clothes 
+                WHERE photo_path = ? AND user_id = ?
+                LIMIT 1
+            ''', (photo_path, user_id))
+            photo_in_use = cursor.fetchone() is not None
+        
         conn.commit()
         conn.close()
         
+        self._bump_wardrobe_version(user_id)
+        self._notify_change(user_id, 'delete', item_id)
+        
         # Delete photo file if it exists
-        photo_path = item[1]
-        if photo_path and os.path.exists(photo_path):
+        if photo_path and not photo_in_use and os.path.exists(photo_path):
             try:
                 os.remove(photo_path)
             except:
@@ -137,9 +641,28 @@ class Database:
         
         return True, f"Successfully deleted '{item[0]}'"
     
+    def _clothing_item_from_row(self, item):
+        """Convert a clothes row to a dictionary with proper field names"""
+        return {
+            'id': item[0],
+            'user_id': item[1],
+            'name': item[2],
+            'category': item[3],
+            'description': item[4],
+            'photo_file_id': item[5],
+            'photo_path': item[6],
+            'tags': json.loads(item[7]) if item[7] else [],
+            'created_at': item[8],
+            'photo_unique_id': item[9],
+            'season': item[10],
+            'occasion': item[11],
+            'photo_hash': int(item[12], 16) if item[12] else None
+        }
+    
+    @_instrumented
     def get_user_clothes(self, user_id, category=None):
         """Get all clothes for a user, optionally filtered by category"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         if category:
@@ -161,23 +684,14 @@ class Database:
         # Convert to list of dictionaries with proper field names
         clothes_list = []
         for item in clothes:
-            clothes_list.append({
-                'id': item[0],
-                'user_id': item[1],
-                'name': item[2],
-                'category': item[3],
-                'description': item[4],
-                'photo_file_id': item[5],
-                'photo_path': item[6],
-                'tags': json.loads(item[7]) if item[7] else [],
-                'created_at': item[8]
-            })
+            clothes_list.append(self._clothing_item_from_row(item))
         
         return clothes_list
     
+    @_instrumented
     def get_clothing_item(self, user_id, item_id):
         """Get a specific clothing item by ID"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -189,22 +703,66 @@ class Database:
         conn.close()
         
         if item:
-            return {
-                'id': item[0],
-                'user_id': item[1],
-                'name': item[2],
-                'category': item[3],
-                'description': item[4],
-                'photo_file_id': item[5],
-                'photo_path': item[6],
-                'tags': json.loads(item[7]) if item[7] else [],
-                'created_at': item[8]
-            }
+            return self._clothing_item_from_row(item)
         return None
     
+    @_instrumented
+    def get_clothing_item_by_photo(self, user_id, photo_unique_id):
+        """Get the clothing item stored for a Telegram photo, if any"""
+        conn = self._connect(user_id)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT * FROM clothes 
+            WHERE user_id = ? AND photo_unique_id = ?
+            LIMIT 1
+        ''', (user_id, photo_unique_id))
+        
+        item = cursor.fetchone()
+        conn.close()
+        
+        if item:
+            return self._clothing_item_from_row(item)
+        return None
+    
+    @_instrumented
+    def get_photo_hashes(self, user_id):
+        """(item ID, photo path, photo hash or None) for each of the user's items with a stored photo"""
+        conn = self._connect(user_id)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, photo_path, photo_hash FROM clothes 
+            WHERE user_id = ? AND photo_path IS NOT NULL
+        ''', (user_id,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [(item_id, photo_path, int(photo_hash, 16) if photo_hash else None) for item_id, photo_path, photo_hash in rows]
+    
+    @_instrumented
+    def set_photo_hash(self, user_id, item_id, photo_hash):
+        """Store the perceptual hash of an item's photo (for items saved before hashes existed)"""
+        conn = self._connect(user_id)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE clothes SET photo_hash = ? 
+            WHERE id = ? AND user_id = ?
+        ''', (f'{photo_hash:016x}', item_id, user_id))
+        
+        conn.commit()
+        conn.close()
+    
+    @_instrumented
     def update_clothing_item(self, user_id, item_id, field, value):
         """Update a specific field of a clothing item"""
-        conn = sqlite3.connect(self.db_path)
+        update_sql = _UPDATE_ITEM_SQL.get(field)
+        if update_sql is None:
+            return False
+        
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         # Check if item exists and belongs to user
@@ -222,20 +780,20 @@ class Database:
             value = json.dumps(value)
         
         # Update the field
-        cursor.execute(f'''
-            UPDATE clothes 
-            SET {field} = ?
-            WHERE id = ? AND user_id = ?
-        ''', (value, item_id, user_id))
+        cursor.execute(update_sql, (value, item_id, user_id))
         
         conn.commit()
         conn.close()
         
+        self._bump_wardrobe_version(user_id)
+        self._notify_change(user_id, 'update', item_id)
+        
         return True
     
+    @_instrumented
     def get_clothing_categories(self, user_id):
         """Get all clothing categories for a user"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -248,27 +806,165 @@ class Database:
         
         return categories
     
+    @_instrumented
     def save_outfit(self, user_id, name, description, clothes_ids, season=None, occasion=None):
         """Save a generated outfit"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         clothes_ids_json = json.dumps(clothes_ids)
         
+        outfit_id = self._next_id('outfits')
         cursor.execute('''
-            INSERT INTO outfits (user_id, name, description, clothes_ids, season, occasion)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, name, description, clothes_ids_json, season, occasion))
+            INSERT INTO outfits (id, user_id, name, description, clothes_ids, season, occasion)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (outfit_id, user_id, name, description, clothes_ids_json, season, occasion))
+        
+        cursor.executemany('''
+            INSERT OR IGNORE INTO outfit_items (outfit_id, item_id)
+            VALUES (?, ?)
+        ''', [(outfit_id, item_id) for item_id in clothes_ids])
         
-        outfit_id = cursor.lastrowid
         conn.commit()
         conn.close()
         
         return outfit_id
     
+    @_instrumented
+    def get_collage_file_id(self, cache_key):
+        """Get the Telegram file ID of a previously sent collage"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT file_id FROM collage_cache 
+            WHERE cache_key = ?
+        ''', (cache_key,))
+        
+        row = cursor.fetchone()
+        conn.close()
+        
+        return row[0] if row else None
+    
+    @_instrumented
+    def save_collage_file_id(self, cache_key, file_id):
+        """Remember the Telegram file ID of a sent collage"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO collage_cache (cache_key, file_id)
+            VALUES (?, ?)
+        ''', (cache_key, file_id))
+        
+        conn.commit()
+        conn.close()
+    
+    @_instrumented
+    def get_collage_keys(self, prefix):
+        """Cache keys of sent collages starting with a prefix"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        # A range on the primary key, which LIKE wouldn't use
+        cursor.execute('''
+            SELECT cache_key FROM collage_cache 
+            WHERE cache_key >= ? AND cache_key < ?
+        ''', (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        
+        keys = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return keys
+    
+    @_instrumented
+    def delete_collage_file_ids(self, cache_keys):
+        """Forget sent collages, e.g. ones showing a deleted item"""
+        conn = self._connect()
+        conn.executemany('DELETE FROM collage_cache WHERE cache_key = ?', [(key,) for key in cache_keys])
+        conn.commit()
+        conn.close()
+    
+    @_instrumented
+    def prune_collage_cache(self, before, max_entries):
+        """Drop sent collages created before `before` and all but the newest `max_entries`; returns how many"""
+        conn = self._connect()
+        try:
+            deleted = conn.execute('DELETE FROM collage_cache WHERE created_at < ?', (before,)).rowcount
+            deleted += conn.execute('''
+                DELETE FROM collage_cache WHERE cache_key IN (
+                    SELECT cache_key FROM collage_cache
+                    ORDER BY created_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,)).rowcount
+            conn.commit()
+            return deleted
+        finally:
+            conn.close()
+    
+    @_instrumented
+    def add_ai_usage(self, rows):
+        """Add (user_id, day, method, prompt_tokens, completion_tokens, requests) rows to the usage totals"""
+        with self._fenced(row[0] for row in rows):
+            by_shard = {}
+            for row in rows:
+                by_shard.setdefault(self.shard_for(row[0]), []).append(row)
+            
+            for shard_id, shard_rows in by_shard.items():
+                conn = self._connect_shard(shard_id)
+                cursor = conn.cursor()
+                
+                cursor.executemany('''
+                    INSERT INTO ai_usage (user_id, day, method, prompt_tokens, completion_tokens, requests)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, day, method) DO UPDATE SET
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        requests = requests + excluded.requests
+                ''', shard_rows)
+                
+                conn.commit()
+                conn.close()
+    
+    @_instrumented
+    def get_ai_usage_tokens(self, day, user_id=None):
+        """Get the tokens used on a day by one user, or by everyone when user_id is None"""
+        if user_id is None:
+            return sum(rows[0][0] for _, rows in self.query_all('''
+                SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0)
+                FROM ai_usage WHERE day = ?
+            ''', (day,)))
+        
+        conn = self._connect(user_id)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0)
+            FROM ai_usage WHERE user_id = ? AND day = ?
+        ''', (user_id, day))
+        
+        tokens = cursor.fetchone()[0]
+        conn.close()
+        return tokens
+    
+    @_instrumented
+    def get_active_users(self, since_day):
+        """IDs of users who made AI requests on or after a day, most recently active first"""
+        results = self.query_all('''
+            SELECT user_id, MAX(day), SUM(requests) FROM ai_usage 
+            WHERE day >= ? AND user_id IS NOT NULL AND user_id != ?
+            GROUP BY user_id
+        ''', (since_day, AI_SYSTEM_USER_ID))
+        
+        # Rows of a user left behind by an interrupted move are only counted on the user's own shard
+        users = [row for shard_id, rows in results for row in rows if self.shard_for(row[0]) == shard_id]
+        users.sort(key=lambda row: (row[1], row[2]), reverse=True)
+        return [row[0] for row in users]
+    
+    @_instrumented
     def get_user_outfits(self, user_id):
         """Get all outfits for a user"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -282,9 +978,28 @@ class Database:
         
         return outfits
     
+    @_instrumented
+    def get_outfits_with_item(self, user_id, item_id):
+        """Get all saved outfits of a user that contain a clothing item"""
+        conn = self._connect(user_id)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT outfits.* FROM outfit_items
+            JOIN outfits ON outfits.id = outfit_items.outfit_id
+            WHERE outfit_items.item_id = ? AND outfits.user_id = ?
+            ORDER BY outfits.created_at DESC
+        ''', (item_id, user_id))
+        
+        outfits = cursor.fetchall()
+        conn.close()
+        
+        return outfits
+    
+    @_instrumented
     def update_user_preferences(self, user_id, style_preference=None, color_preference=None, season_preference=None):
         """Update user preferences"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -296,9 +1011,10 @@ class Database:
         conn.commit()
         conn.close()
     
+    @_instrumented
     def get_user_preferences(self, user_id):
         """Get user preferences"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect(user_id)
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -309,4 +1025,291 @@ class Database:
         preferences = cursor.fetchone()
         conn.close()
         
-        return preferences 
\ No newline at end of file
+        return preferences
+    
+    @_instrumented
+    def add_clothing_items(self, user_id, items):
+        """Add many clothing items in one transaction; returns their IDs in order
+        
+        Each item is a dict of add_clothing_item's arguments, plus an optional
+        created_at to keep the original date.
+        """
+        rows = []
+        for item in items:
+            photo_hash = item.get('photo_hash')
+            rows.append((self._next_id('clothes'), user_id, item['name'], item['category'], item.get('description'),
+                         item.get('photo_file_id'), item.get('photo_path'),
+                         json.dumps(item['tags']) if item.get('tags') else None, item.get('photo_unique_id'),
+                         item.get('season'), item.get('occasion'),
+                         f'{photo_hash:016x}' if photo_hash is not None else None, item.get('created_at')))
+        if not rows:
+            return []
+        
+        conn = self._connect(user_id)
+        conn.executemany('''
+            INSERT INTO clothes (id, user_id, name, category, description, photo_file_id, photo_path, tags, photo_unique_id, season,
+                                 occasion, photo_hash, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', rows)
+        conn.commit()
+        conn.close()
+        
+        self._bump_wardrobe_version(user_id)
+        self._notify_change(user_id, 'reload', None)
+        
+        return [row[0] for row in rows]
+    
+    @_instrumented
+    def save_outfits(self, user_id, outfits):
+        """Save many outfits in one transaction; returns their IDs in order
+        
+        Each outfit is a dict of save_outfit's arguments, plus an optional created_at.
+        """
+        rows = []
+        item_rows = []
+        for outfit in outfits:
+            outfit_id = self._next_id('outfits')
+            rows.append((outfit_id, user_id, outfit['name'], outfit.get('description'), json.dumps(outfit['clothes_ids']),
+                         outfit.get('season'), outfit.get('occasion'), outfit.get('created_at')))
+            item_rows.extend((outfit_id, item_id) for item_id in outfit['clothes_ids'])
+        if not rows:
+            return []
+        
+        conn = self._connect(user_id)
+        conn.executemany('''
+            INSERT INTO outfits (id, user_id, name, description, clothes_ids, season, occasion, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+        ''', rows)
+        conn.executemany('''
+            INSERT OR IGNORE INTO outfit_items (outfit_id, item_id)
+            VALUES (?, ?)
+        ''', item_rows)
+        conn.commit()
+        conn.close()
+        
+        return [row[0] for row in rows]
+    
+    def _iter_user_rows(self, user_id, table, batch_size):
+        """A user's clothes or outfits rows in ID order, read batch_size rows per query"""
+        last_id = 0
+        while True:
+            # A fresh connection per page, so a long export doesn't hold up a shard move of the user
+            conn = self._connect(user_id)
+            rows = conn.execute(f'''
+                SELECT * FROM {table} 
+                WHERE user_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (user_id, last_id, batch_size)).fetchall()
+            conn.close()
+            
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+    
+    def iter_clothes(self, user_id, batch_size=500):
+        """All of a user's clothes as dictionaries, oldest first, without loading them all at once"""
+        for row in self._iter_user_rows(user_id, 'clothes', batch_size):
+            yield self._clothing_item_from_row(row)
+    
+    def iter_outfits(self, user_id, batch_size=500, archived=False):
+        """All of a user's outfit rows (or archived outfit rows), oldest first, without loading them all at once"""
+        return self._iter_user_rows(user_id, 'outfits_archive' if archived else 'outfits', batch_size)
+    
+    @_instrumented
+    def archive_outfits(self, shard_id, before, limit):
+        """Move up to `limit` outfits created before `before` into outfits_archive, in one transaction; returns how many"""
+        conn = self._connect_shard(shard_id)
+        try:
+            # The batch goes through a temp table so every statement has fixed SQL text
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM archive_batch')
+            count = conn.execute('''
+                INSERT INTO archive_batch (id)
+                SELECT id FROM outfits 
+                WHERE created_at < ?
+                ORDER BY created_at
+                LIMIT ?
+            ''', (before, limit)).rowcount
+            if not count:
+                conn.rollback()
+                return 0
+            
+            conn.execute('''
+                INSERT OR REPLACE INTO outfits_archive (id, user_id, name, description, clothes_ids, season, occasion, created_at)
+                SELECT id, user_id, name, description, clothes_ids, season, occasion, created_at FROM outfits
+                WHERE id IN (SELECT id FROM archive_batch)
+            ''')
+            conn.execute('DELETE FROM outfit_items WHERE outfit_id IN (SELECT id FROM archive_batch)')
+            conn.execute('DELETE FROM outfits WHERE id IN (SELECT id FROM archive_batch)')
+            conn.commit()
+            return count
+        finally:
+            conn.close()
+    
+    def storage_info(self, shard_id):
+        """Page counts of a shard file and whether free pages can be reclaimed incrementally"""
+        conn = sqlite3.connect(shard_path(self.db_path, shard_id))
+        try:
+            auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            return {
+                'incremental': auto_vacuum == 2,
+                'page_size': conn.execute('PRAGMA page_size').fetchone()[0],
+                'pages': conn.execute('PRAGMA page_count').fetchone()[0],
+                'free_pages': conn.execute('PRAGMA freelist_count').fetchone()[0]
+            }
+        finally:
+            conn.close()
+    
+    @_instrumented
+    def enable_incremental_vacuum(self, shard_id):
+        """Switch a shard created before incremental auto-vacuum over to it
+        
+        This rewrites the whole file with VACUUM, holding the shard's write lock
+        throughout, so it's only worth doing once and on small or idle shards.
+        """
+        conn = sqlite3.connect(shard_path(self.db_path, shard_id), isolation_level=None)
+        try:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+    
+    @_instrumented
+    def incremental_vacuum(self, shard_id, pages, cache_kb=None):
+        """Hand up to `pages` free pages of a shard back to the filesystem in one short transaction; returns how many"""
+        conn = sqlite3.connect(shard_path(self.db_path, shard_id), isolation_level=None)
+        try:
+            if cache_kb:
+                conn.execute(f'PRAGMA cache_size=-{int(cache_kb)}')
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if before:
+                # executescript steps the pragma to completion; execute() would free a single page
+                conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+            return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        finally:
+            conn.close()
+    
+    @_instrumented
+    def optimize(self, shard_id, analysis_limit=None, cache_kb=None):
+        """Refresh the query planner's statistics on a shard where they're missing or out of date"""
+        conn = sqlite3.connect(shard_path(self.db_path, shard_id))
+        try:
+            if cache_kb:
+                conn.execute(f'PRAGMA cache_size=-{int(cache_kb)}')
+            if analysis_limit:
+                # Sample at most this many rows per index rather than reading whole tables
+                conn.execute(f'PRAGMA analysis_limit={int(analysis_limit)}')
+            if sqlite3.sqlite_version_info >= (3, 46, 0):
+                conn.execute('PRAGMA optimize=0x10002')
+            else:
+                # Older SQLite only optimizes tables this connection has queried, which is none
+                conn.execute('ANALYZE')
+        finally:
+            conn.close()
+    
+    def _copy_user_rows(self, user_id, source, target):
+        """Replace the user's rows in the target shard with those in the source shard (target in a transaction)"""
+        target.execute('''
+            DELETE FROM outfit_items 
+            WHERE outfit_id IN (SELECT id FROM outfits WHERE user_id = ?)
+        ''', (user_id,))
+        for table in _USER_TABLES:
+            target.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+            columns = [row[1] for row in source.execute(f'PRAGMA table_info({table})')]
+            rows = source.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE user_id = ?', (user_id,)).fetchall()
+            target.executemany(f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+        
+        rows = source.execute('''
+            SELECT outfit_items.outfit_id, outfit_items.item_id FROM outfit_items
+            JOIN outfits ON outfits.id = outfit_items.outfit_id
+            WHERE outfits.user_id = ?
+        ''', (user_id,)).fetchall()
+        target.executemany('INSERT OR IGNORE INTO outfit_items (outfit_id, item_id) VALUES (?, ?)', rows)
+    
+    def _delete_user_rows(self, conn, user_id):
+        conn.execute('''
+            DELETE FROM outfit_items 
+            WHERE outfit_id IN (SELECT id FROM outfits WHERE user_id = ?)
+        ''', (user_id,))
+        for table in _USER_TABLES:
+            conn.execute(f'DELETE FROM {table} WHERE user_id = ?', (user_id,))
+    
+    @_instrumented
+    def move_user(self, user_id, shard_id, timeout=SHARD_MOVE_TIMEOUT):
+        """Move a user's rows to another shard while the bot keeps running
+        
+        The user's own requests wait (for milliseconds) until the move is done;
+        everyone else's carry on. Rows are copied before the catalog points at
+        the new shard and deleted from the old one after, so an interruption
+        never loses data, only leaves a copy behind that the next move replaces.
+        """
+        if not 0 <= shard_id < self.shard_count:
+            raise ValueError(f"No shard {shard_id}")
+        
+        # Wait out a backup before fencing the user, so their requests aren't held up meanwhile
+        with self._move_lock:
+            return self._move_user(user_id, shard_id, timeout)
+    
+    def _move_user(self, user_id, shard_id, timeout):
+        with self._placement:
+            if user_id in self._moving:
+                raise ShardMoveError(f"User {user_id} is already being moved")
+            self._moving.add(user_id)
+            # Let statements already running for the user finish first
+            if not self._placement.wait_for(lambda: not self._open[user_id], timeout):
+                self._moving.discard(user_id)
+                self._placement.notify_all()
+                raise ShardMoveError(f"User {user_id} is busy, try again later")
+        
+        try:
+            source_id = self.shard_for(user_id)
+            if source_id == shard_id:
+                return False
+            
+            source = self._connect_shard(source_id)
+            target = self._connect_shard(shard_id)
+            try:
+                self._copy_user_rows(user_id, source, target)
+                target.commit()
+                
+                catalog = sqlite3.connect(self.db_path)
+                if shard_id == self.home_shard(user_id):
+                    catalog.execute('DELETE FROM user_shards WHERE user_id = ?', (user_id,))
+                    self._pins.pop(user_id, None)
+                else:
+                    catalog.execute('INSERT OR REPLACE INTO user_shards (user_id, shard_id) VALUES (?, ?)', (user_id, shard_id))
+                    self._pins[user_id] = shard_id
+                catalog.commit()
+                catalog.close()
+                
+                self._delete_user_rows(source, user_id)
+                source.commit()
+            finally:
+                source.close()
+                target.close()
+            return True
+        finally:
+            with self._placement:
+                self._moving.discard(user_id)
+                self._placement.notify_all()
+    
+    def rebalance(self, limit=None, pause=0.0):
+        """Move pinned users to the shard their ID hashes to, one at a time; returns (moved, failed)
+        
+        `pause` seconds between moves keep the extra writes from crowding out live traffic.
+        """
+        moved = failed = 0
+        for user_id in list(self._pins):
+            if limit is not None and moved >= limit:
+                break
+            try:
+                if self.move_user(user_id, self.home_shard(user_id)):
+                    moved += 1
+            except (ShardMoveError, sqlite3.Error) as e:
+                print(f"Error moving user {user_id}: {e}")
+                failed += 1
+            if pause:
+                time.sleep(pause)
+        return moved, failed
@@ -0,0 +1,111 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from config import RESOLVER_MATCH_THRESHOLD, RESOLVER_CACHE_SIZE
+import metrics
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+def normalize_name(name):
+    """Lowercase a name and collapse punctuation and whitespace"""
+    return " ".join(_TOKEN_PATTERN.findall((name or "").lower()))
+
+class WardrobeIndex:
+    """Name lookup structures for one user's wardrobe"""
+    
+    def __init__(self, clothes):
+        self.items = list(clothes)
+        self.exact = {}
+        self.postings = {}
+        
+        item_tokens = []
+        for position, item in enumerate(self.items):
+            normalized = normalize_name(item['name'])
+            self.exact.setdefault(normalized, item)
+            tokens = set(normalized.split())
+            item_tokens.append(tokens)
+            for token in tokens:
+                self.postings.setdefault(token, []).append(position)
+        
+        # Rare tokens like brands say more about an item than "black" or "shirt"
+        total = len(self.items)
+        self.weights = {token: math.log(1 + total / len(positions))
+                        for token, positions in self.postings.items()}
+        self.item_weights = [sum(self.weights[token] for token in tokens) for tokens in item_tokens]
+    
+    def match(self, name, threshold=RESOLVER_MATCH_THRESHOLD):
+        """Find the item a free-text name refers to, or None"""
+        normalized = normalize_name(name)
+        item = self.exact.get(normalized)
+        if item is not None:
+            return item
+        
+        query_tokens = set(normalized.split())
+        query_weight = 0.0
+        shared = {}
+        for token in query_tokens:
+            weight = self.weights.get(token)
+            if weight is None:
+                continue
+            query_weight += weight
+            for position in self.postings[token]:
+                shared[position] = shared.get(position, 0.0) + weight
+        
+        if not shared:
+            return None
+        
+        # Weighted Dice coefficient between the query and each candidate
+        best_position, best_score = None, 0.0
+        for position, weight in shared.items():
+            score = 2 * weight / (query_weight + self.item_weights[position])
+            if score > best_score:
+                best_position, best_score = position, score
+        
+        if best_score < threshold:
+            return None
+        return self.items[best_position]
+
+class ItemResolver:
+    """Maps the item names an outfit generator returns back to clothing items"""
+    
+    def __init__(self, cache_size=RESOLVER_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def cached_indexes(self):
+        """Number of wardrobe indexes held in memory"""
+        return len(self._indexes)
+    
+    def get_index(self, user_id, wardrobe_version, clothes):
+        """Get the user's index, rebuilding it when the wardrobe version changed"""
+        with self._lock:
+            cached = self._indexes.get(user_id)
+            if cached and cached[0] == wardrobe_version:
+                self._indexes.move_to_end(user_id)
+                metrics.cache_result("wardrobe_index", True)
+                return cached[1]
+        
+        metrics.cache_result("wardrobe_index", False)
+        index = WardrobeIndex(clothes)
+        with self._lock:
+            self._indexes[user_id] = (wardrobe_version, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.cache_size:
+                self._indexes.popitem(last=False)
+        return index
+    
+    def resolve(self, user_id, wardrobe_version, clothes, names):
+        """Resolve names to clothing items, skipping names without a match and duplicates"""
+        index = self.get_index(user_id, wardrobe_version, clothes)
+        
+        resolved = []
+        seen_ids = set()
+        for name in names:
+            item = index.match(name)
+            if item is not None and item['id'] not in seen_ids:
+                seen_ids.add(item['id'])
+                resolved.append(item)
+        return resolved
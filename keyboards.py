@@ -0,0 +1,82 @@
+from telebot import types
+
+# Keyboards are built and serialized once at startup; telebot sends
+# pre-serialized markup strings as they are.
+
+def _reply_keyboard(*labels):
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(*[types.KeyboardButton(label) for label in labels])
+    return markup.to_json()
+
+def _inline_keyboard(*buttons, row_width=3):
+    markup = types.InlineKeyboardMarkup(row_width=row_width)
+    markup.add(*[types.InlineKeyboardButton(text, callback_data=data) for text, data in buttons])
+    return markup.to_json()
+
+CATEGORIES = ["tops", "bottoms", "dresses", "outerwear", "shoes", "accessories"]
+SEASONS = ["spring", "summer", "fall", "winter", "all"]
+OCCASIONS = ["casual", "formal", "business", "party", "sport"]
+
+MAIN_MENU = _reply_keyboard(
+    "📸 Add Photo",
+    "✍️ Add Description",
+    "📦 Bulk Upload",
+    "🎨 Create Outfit",
+    "📚 My Wardrobe",
+    "💡 Suggestions",
+    "❓ Help"
+)
+
+BULK_UPLOAD_MENU = _reply_keyboard(
+    "📸 Bulk Photos (1-10)",
+    "✍️ Bulk Descriptions (1-10)",
+    "❌ Cancel"
+)
+
+IMPORT_MENU = _reply_keyboard(
+    "❌ Cancel"
+)
+
+CONFIRM_ANALYSIS = _reply_keyboard(
+    "✅ Save as is",
+    "✏️ Edit details",
+    "❌ Cancel"
+)
+
+EDIT_NEW_ITEM_FIELDS = _reply_keyboard(
+    "📝 Name",
+    "📂 Category",
+    "🏷️ Tags",
+    "🌤️ Season",
+    "🎯 Occasion",
+    "❌ Cancel Edit"
+)
+
+EDIT_EXISTING_ITEM_FIELDS = _reply_keyboard(
+    "📝 Name",
+    "📂 Category",
+    "🏷️ Tags",
+    "📄 Description",
+    "🌤️ Season",
+    "🎯 Occasion",
+    "❌ Cancel Edit"
+)
+
+CATEGORY_CHOICES = _reply_keyboard(*[category.title() for category in CATEGORIES])
+SEASON_CHOICES = _reply_keyboard(*[season.title() for season in SEASONS])
+OCCASION_CHOICES = _reply_keyboard(*[occasion.title() for occasion in OCCASIONS])
+
+OUTFIT_ACTIONS = _inline_keyboard(
+    ("💾 Save Outfit", "save_outfit"),
+    ("🔄 New Outfit", "new_outfit")
+)
+
+SUGGESTION_ACTIONS = _inline_keyboard(
+    ("🎨 Create Outfit", "create_from_suggestion"),
+    ("🔄 More Suggestions", "more_suggestions")
+)
+
+DUPLICATE_PHOTO_ACTIONS = _inline_keyboard(
+    ("➕ Add anyway", "add_duplicate"),
+    ("⏭️ Skip", "skip_duplicate")
+)
@@ -0,0 +1,37 @@
+import threading
+
+class Lazy:
+    """Stands in for an object that is only built the first time it is used
+    
+    Attribute access is forwarded to the object, so module-level singletons
+    can be declared at import time without paying for their construction.
+    """
+    
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+    
+    def get(self):
+        """The wrapped object, built on first call"""
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    instance = self._factory()
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+    
+    @property
+    def is_built(self):
+        return self._instance is not None
+    
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+    
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+    
+    def __dir__(self):
+        return dir(self.get())
@@ -4,31 +4,274 @@ import os
 import json
 from datetime import datetime
 import time
+import tempfile
+import threading
+from collections import OrderedDict
 
-from config import TELEGRAM_TOKEN, MAX_PHOTO_SIZE, SUPPORTED_PHOTO_FORMATS
+from config import (TELEGRAM_TOKEN, MAX_PHOTO_SIZE, SUPPORTED_PHOTO_FORMATS, METRICS_HOST, METRICS_PORT, ADMIN_USER_IDS,
+                    STATS_SAMPLE_INTERVAL, STATS_RATE_WINDOW, WAL_CHECKPOINT_INTERVAL, PHOTO_SCAN_INTERVAL,
+                    HEALTH_MAX_QUEUE_DEPTH, COMPATIBILITY_TOP_OUTFITS, SEARCH_RESULTS, SEARCH_MIN_SCORE,
+                    OUTFIT_PROMPT_MAX_ITEMS, PRECOMPUTE_INTERVAL, PRECOMPUTE_SUGGESTION_ROUNDS, SHARD_REBALANCE_PAUSE,
+                    EXPORT_MAX_UPLOAD, IMPORT_MAX_FILE_SIZE, BACKUP_INTERVAL, MAINTENANCE_INTERVAL,
+                    AI_SYSTEM_USER_ID)
 from database import Database
-from ai_service import AIService
+from ai_service import AIService, FALLBACK_SUGGESTIONS
+from photo_store import PhotoStore
+from collage import CollageRenderer
+from router import Router
+from item_resolver import ItemResolver
+from compatibility import CompatibilityIndex
+from photo_hash import PhotoIndex, dhash, hamming
+from singleflight import SingleFlight
+from usage import UsageTracker, QuotaExceededError
+from lazy import Lazy
+from precompute import Precomputer
+from result_cache import ResultCache
+from wardrobe_io import export_wardrobe, import_wardrobe
+from backup import BackupManager
+from maintenance import Maintenance
+from scheduler import Scheduler
+import keyboards
+import metrics
+import tracing
+from tracing import tracer
 
-# Initialize bot and services
+# Initialize bot and services; the database and OpenAI client are built on first use
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
-db = Database()
-ai_service = AIService()
+
+def build_database():
+    database = Database()
+    database.add_change_hook(compatibility.on_change)
+    database.add_change_hook(photo_index.on_change)
+    database.add_change_hook(ai_results.on_change)
+    database.add_change_hook(lambda *change: wardrobe_search.on_change(*change) if wardrobe_search.is_built else None)
+    return database
+
+def build_wardrobe_search():
+    # Imported here because NumPy is slow to import and only needed once someone searches
+    from wardrobe_search import WardrobeSearch
+    return WardrobeSearch(db)
+
+db = Lazy(build_database)
+usage_tracker = UsageTracker(db)
+ai_service = Lazy(lambda: AIService(usage_tracker))
+photo_store = PhotoStore(TELEGRAM_TOKEN)
+collage_renderer = CollageRenderer()
+item_resolver = ItemResolver()
+compatibility = CompatibilityIndex(db)
+photo_index = PhotoIndex(db)
+wardrobe_search = Lazy(build_wardrobe_search)
+ai_requests = SingleFlight()
+ai_results = ResultCache()
+backups = BackupManager(db)
+maintenance = Maintenance(db)
+router = Router()
+scheduler = Scheduler()
+started_at = time.time()
 
 # User states for conversation flow
 user_states = {}
 
+# Generated outfits kept per user so their Save buttons keep working
+MAX_PENDING_OUTFITS = 5
+
+# Suggestions shown per Suggestions or More Suggestions tap
+SUGGESTIONS_SHOWN = 5
+
 class UserState:
     def __init__(self):
         self.state = "idle"
         self.temp_data = {}
         self.waiting_for = None
+        self.pending_outfits = OrderedDict()
+    
+    def reset(self):
+        # Downloaded photos that were never saved would otherwise stay in photos/ for good
+        for photo_data in self.temp_data.get('photos', []) + [self.temp_data.get('duplicate_photo')]:
+            if photo_data:
+                discard_photo(photo_data)
+        self.state = "idle"
+        self.temp_data = {}
+        self.waiting_for = None
+
+# Metrics
+router.add_timing_hook(lambda route, seconds: metrics.HANDLER_SECONDS.observe(seconds, route=route))
+metrics.ACTIVE_USERS.set_function(lambda: len(user_states))
+metrics.QUEUE_DEPTH.set_function(ai_requests.in_flight, queue="ai_in_flight")
+
+def bot_queue_depth():
+    """Updates waiting for a bot worker thread"""
+    return bot.worker_pool.tasks.qsize() if getattr(bot, "worker_pool", None) else 0
+
+metrics.QUEUE_DEPTH.set_function(bot_queue_depth, queue="bot_workers")
+
+def ai_totals():
+    """Cumulative AI call count, latency sum, errors and latency buckets"""
+    bucket_counts, total_seconds, count = metrics.AI_REQUEST_SECONDS.totals()
+    return (count, total_seconds, metrics.AI_REQUEST_ERRORS.total(), *bucket_counts)
+
+ai_rates = metrics.RateWindow(ai_totals, STATS_RATE_WINDOW)
+
+def collect_stats():
+    """Runtime snapshot for /stats and /healthz, read from in-process counters and file sizes only"""
+    caches = {
+        "thumbnail": {"size": collage_renderer.cached_thumbnails()},
+        "wardrobe_index": {"size": item_resolver.cached_indexes()},
+        "compatibility": {"size": compatibility.cached_matrices()},
+        "search_index": {"size": wardrobe_search.cached_indexes() if wardrobe_search.is_built else 0},
+        "photo_hash": {"size": photo_index.cached_trees()},
+        "precomputed": {"size": precomputer.cached_entries()},
+        "ai_result": {"size": ai_results.cached_entries()},
+        "wardrobe_prompt": {"size": ai_service.cached_wardrobe_prompts() if ai_service.is_built else 0},
+        "ai_singleflight": {"size": ai_requests.in_flight()},
+        "collage": {"size": None}
+    }
+    for (cache, result), count in metrics.CACHE_REQUESTS.totals("cache", "result").items():
+        counts = caches.setdefault(cache, {"size": None})
+        counts[result] = counts.get(result, 0) + count
+    for counts in caches.values():
+        lookups = counts.get("hit", 0) + counts.get("miss", 0)
+        counts["hit_rate"] = counts.get("hit", 0) / lookups if lookups else None
+    
+    ai = {"window_seconds": 0, "calls_per_minute": None, "errors_per_minute": None,
+          "avg_ms": None, "p95_ms": None, "total_calls": ai_totals()[0]}
+    seconds, deltas = ai_rates.deltas()
+    if deltas and seconds > 0:
+        calls, latency, errors, *bucket_counts = deltas
+        p95 = metrics.AI_REQUEST_SECONDS.quantile(0.95, bucket_counts)
+        ai.update({
+            "window_seconds": seconds,
+            "calls_per_minute": calls * 60 / seconds,
+            "errors_per_minute": errors * 60 / seconds,
+            "avg_ms": latency * 1000 / calls if calls else None,
+            "p95_ms": p95 * 1000 if p95 is not None else None
+        })
+    
+    if ai_service.is_built:
+        ai["circuit"] = ai_service.resilience.breaker.state
+        ai["concurrency_limit"] = int(ai_service.resilience.limit.limit)
+    
+    return {
+        "uptime_seconds": time.time() - started_at,
+        "active_users": len(user_states),
+        "caches": caches,
+        "ai": ai,
+        "queues": {
+            "bot_workers": bot_queue_depth(),
+            "ai_in_flight": ai_requests.in_flight(),
+            "usage_writes": usage_tracker.buffered(),
+            "scheduler": scheduler.pending()
+        },
+        "database": {**db.file_sizes(), "last_checkpoint": db.last_checkpoint, "pinned_users": db.pinned_users(),
+                     "shards": [{"shard": shard_id, **db.file_sizes(shard_id)} for shard_id in range(db.shard_count)]},
+        "photos": photo_store.usage(),
+        "backup": backups.last,
+        "maintenance": maintenance.last,
+        "jobs": scheduler.jobs()
+    }
+
+def health_check():
+    """HTTP response for /healthz: 503 when updates back up or background jobs stopped"""
+    stats = collect_stats()
+    problems = []
+    if stats["queues"]["bot_workers"] > HEALTH_MAX_QUEUE_DEPTH:
+        problems.append(f"{stats['queues']['bot_workers']} updates queued")
+    if not scheduler.running:
+        problems.append("scheduler not running")
+    
+    body = {"status": "unhealthy" if problems else "ok", "problems": problems, **stats}
+    return 503 if problems else 200, "application/json", json.dumps(body, default=str)
+
+# Background jobs, started with the bot
+scheduler.every(STATS_SAMPLE_INTERVAL, "stats_sample", ai_rates.sample, run_now=True)
+scheduler.every(WAL_CHECKPOINT_INTERVAL, "wal_checkpoint", lambda: db.checkpoint())
+if MAINTENANCE_INTERVAL:
+    scheduler.every(MAINTENANCE_INTERVAL, "maintenance", maintenance.run)
+scheduler.every(PHOTO_SCAN_INTERVAL, "photo_scan", photo_store.scan, run_now=True)
 
 def get_user_state(user_id):
     if user_id not in user_states:
         user_states[user_id] = UserState()
     return user_states[user_id]
 
+def call_ai(user_id, method_name, key_input, *args, version=None):
+    """Call an AIService method, sharing the result with identical calls already in flight
+    
+    Calls about a wardrobe pass the version read before its clothes were.
+    """
+    if version is None:
+        version = db.get_wardrobe_version(user_id)
+    key = (user_id, method_name, version, key_input)
+    return ai_requests.do(key, getattr(ai_service, method_name), *args, user_id=user_id)
+
+@router.error(QuotaExceededError)
+def quota_exceeded_handler(update, error):
+    """Tell the user an AI request was refused; their current flow stays open to retry later"""
+    bot.send_message(update.from_user.id, error.message)
+
+def format_analysis(analysis):
+    """Format analyzed item details as a bullet list"""
+    return (f"• Name: {analysis['name']}\n"
+            f"• Category: {analysis['category']}\n"
+            f"• Season: {analysis['season']}\n"
+            f"• Occasion: {analysis['occasion']}\n"
+            f"• Tags: {', '.join(analysis['tags'])}")
+
+def send_analysis_confirmation(user_id, state, header):
+    """Show the analysis being edited and ask the user to confirm it"""
+    confirm_text = f"""
+{header}
+
+📋 Item Details:
+{format_analysis(state.temp_data['analysis'])}
+
+Is this correct? You can edit any field if needed.
+"""
+    
+    state.state = "confirming_photo_analysis" if state.temp_data.get('photo_path') else "confirming_description"
+    state.waiting_for = "confirmation"
+    
+    bot.send_message(user_id, confirm_text, reply_markup=keyboards.CONFIRM_ANALYSIS)
+
+def send_outfit_collage(user_id, items):
+    """Send a collage of the outfit's item photos, reusing the Telegram upload when possible"""
+    cache_key = collage_renderer.cache_key(user_id, items)
+    if not cache_key:
+        return
+    
+    try:
+        file_id = db.get_collage_file_id(cache_key)
+        metrics.cache_result("collage", bool(file_id))
+        if file_id:
+            bot.send_photo(user_id, file_id)
+            return
+        
+        with tracer.span("collage.render", items=len(items)):
+            collage, shown = collage_renderer.render(items)
+        if collage is None:
+            return
+        
+        sent = bot.send_photo(user_id, collage)
+        # A collage missing an item whose photo is broken mustn't be reused for the whole outfit
+        db.save_collage_file_id(collage_renderer.cache_key(user_id, shown), sent.photo[-1].file_id)
+    except Exception as e:
+        print(f"Error sending outfit collage: {e}")
+
+def ask_for_outfit_request(user_id, state):
+    """Ask the user what kind of outfit to create"""
+    state.state = "waiting_for_outfit_request"
+    state.waiting_for = "outfit_request"
+    
+    bot.send_message(user_id, 
+                    "🎨 What kind of outfit would you like me to create?\n\n"
+                    "Examples:\n"
+                    "• 'Casual weekend look'\n"
+                    "• 'Professional office outfit'\n"
+                    "• 'Evening party ensemble'\n"
+                    "• 'Comfortable weekend look'")
+
 @bot.message_handler(commands=['start'])
+@router.wrap
 def start(message):
     """Handle /start command"""
     user_id = message.from_user.id
@@ -49,19 +292,344 @@ I'm your AI fashion assistant that helps you:
 Let's start building your digital wardrobe!
 """
     
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    btn1 = types.KeyboardButton("📸 Add Photo")
-    btn2 = types.KeyboardButton("✍️ Add Description")
-    btn3 = types.KeyboardButton("📦 Bulk Upload")
-    btn4 = types.KeyboardButton("🎨 Create Outfit")
-    btn5 = types.KeyboardButton("📚 My Wardrobe")
-    btn6 = types.KeyboardButton("💡 Suggestions")
-    btn7 = types.KeyboardButton("❓ Help")
-    markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
+    bot.send_message(user_id, welcome_text, reply_markup=keyboards.MAIN_MENU)
+
+def send_long_message(user_id, text, limit=4000):
+    """Send text in several messages if it is over Telegram's message length limit"""
+    chunk = ""
+    for line in text.split("\n"):
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            bot.send_message(user_id, chunk)
+            chunk = ""
+        chunk += line[:limit] + "\n"
+    if chunk.strip():
+        bot.send_message(user_id, chunk)
+
+@bot.message_handler(commands=['dbstats'], func=lambda message: message.from_user.id in ADMIN_USER_IDS)
+@router.wrap
+def db_stats_command(message):
+    """Show the slowest database statements and their query plans (admins only)"""
+    report = db.get_query_report()
+    if not report:
+        bot.send_message(message.from_user.id, "📊 No queries recorded yet.")
+        return
     
-    bot.send_message(user_id, welcome_text, reply_markup=markup)
+    lines = ["📊 Database statements by total time:\n"]
+    for i, statement in enumerate(report, 1):
+        full_scan = any(step.startswith("SCAN") for step in statement['plan'])
+        lines.append(f"{i}. {statement['count']}× total {statement['total_ms']:.1f}ms, "
+                     f"avg {statement['avg_ms']:.2f}ms, max {statement['max_ms']:.1f}ms, {statement['rows']} rows"
+                     f"{' ⚠️ full scan' if full_scan else ''}")
+        lines.append(f"   {statement['sql'][:200]}")
+        if statement['plan']:
+            lines.append(f"   plan: {' | '.join(statement['plan'])}")
+    
+    slow_queries = list(db.query_stats.slow_queries)[-5:]
+    if slow_queries:
+        lines.append(f"\n🐢 Recent queries over {db.query_stats.slow_threshold * 1000:g}ms:")
+        for query in reversed(slow_queries):
+            lines.append(f"• {query['at']} {query['ms']:.1f}ms, {query['rows']} rows: {query['sql'][:200]}")
+            if query['plan']:
+                lines.append(f"   plan: {' | '.join(query['plan'])}")
+    
+    send_long_message(message.from_user.id, "\n".join(lines))
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_age(timestamp):
+    return f"{time.time() - timestamp:.0f}s ago" if timestamp else "never"
+
+@bot.message_handler(commands=['stats'], func=lambda message: message.from_user.id in ADMIN_USER_IDS)
+@router.wrap
+def stats_command(message):
+    """Show live runtime stats (admins only)"""
+    stats = collect_stats()
+    ai = stats['ai']
+    database = stats['database']
+    photos = stats['photos']
+    
+    lines = [f"📈 Runtime stats (up {stats['uptime_seconds'] / 3600:.1f}h)\n",
+             f"👥 Active users: {stats['active_users']}\n",
+             "🗂 Caches:"]
+    for name, cache in stats['caches'].items():
+        size = f"{cache['size']} entries, " if cache['size'] is not None else ""
+        hit_rate = f"{cache['hit_rate']:.0%} hits" if cache['hit_rate'] is not None else "no lookups"
+        lines.append(f"• {name}: {size}{hit_rate} ({cache.get('hit', 0)}/{cache.get('hit', 0) + cache.get('miss', 0)})")
+    
+    lines.append(f"\n🤖 AI calls: {ai['total_calls']} total")
+    if ai['calls_per_minute'] is not None:
+        lines.append(f"• last {ai['window_seconds']:.0f}s: {ai['calls_per_minute']:.1f}/min, "
+                     f"{ai['errors_per_minute']:.1f} errors/min")
+    if ai['avg_ms'] is not None:
+        lines.append(f"• latency: avg {ai['avg_ms']:.0f}ms, p95 {ai['p95_ms']:.0f}ms")
+    if 'circuit' in ai:
+        lines.append(f"• circuit {ai['circuit']}, concurrency limit {ai['concurrency_limit']}")
+    
+    lines.append("\n📬 Queues: " + ", ".join(f"{name} {depth}" for name, depth in stats['queues'].items()))
+    
+    checkpoint = database['last_checkpoint']
+    lines.append(f"\n💾 Database: {format_bytes(database['db'])}, WAL {format_bytes(database['wal'])}")
+    if len(database['shards']) > 1:
+        lines.append("• shards: " + ", ".join(f"#{shard['shard']} {format_bytes(shard['db'])}" for shard in database['shards'])
+                     + f"; {database['pinned_users']} users waiting to be rebalanced")
+    if checkpoint:
+        lines.append(f"• last checkpoint {format_age(checkpoint['at'])}: {checkpoint['checkpointed_pages']}/"
+                     f"{checkpoint['log_pages']} pages{' (busy)' if checkpoint['busy'] else ''}")
+    else:
+        lines.append("• no checkpoint yet")
+    if stats['maintenance']:
+        run = stats['maintenance']
+        lines.append(f"• last maintenance {format_age(run['at'])}: {run['archived_outfits']} outfits archived, "
+                     f"{run['pruned_collages']} collages pruned, {run['freed_pages']} pages freed, {run['free_pages']} free")
+    
+    lines.append(f"\n📸 Photos: {photos['photos']} files, {format_bytes(photos['bytes'])} "
+                 f"(counted {format_age(photos['scanned_at'])})")
+    
+    backup = stats['backup']
+    if backup and 'error' in backup:
+        lines.append(f"⚠️ Last backup failed {format_age(backup['at'])}: {backup['error']}")
+    elif backup:
+        lines.append(f"🗄 Last backup {format_age(backup['at'])}: {format_bytes(backup['bytes'])}, "
+                     f"{backup['photos']} photos ({backup['photos_copied']} new), {backup['seconds']:.0f}s")
+    
+    failed_jobs = [job for job in stats['jobs'] if job['last_error']]
+    for job in failed_jobs:
+        lines.append(f"⚠️ Job {job['name']} failed {format_age(job['last_run'])}: {job['last_error']}")
+    
+    send_long_message(message.from_user.id, "\n".join(lines))
+
+rebalance_lock = threading.Lock()
+
+@bot.message_handler(commands=['rebalance'], func=lambda message: message.from_user.id in ADMIN_USER_IDS)
+@router.wrap
+def rebalance_command(message):
+    """Move users to the shard their ID hashes to while the bot keeps serving (admins only)"""
+    user_id = message.from_user.id
+    if not db.pinned_users():
+        bot.send_message(user_id, "✅ Every user is already on their shard.")
+        return
+    if not rebalance_lock.acquire(blocking=False):
+        bot.send_message(user_id, "⏳ A rebalance is already running.")
+        return
+    
+    bot.send_message(user_id, f"🔀 Moving {db.pinned_users()} users between shards...")
+    
+    def run():
+        start = time.perf_counter()
+        try:
+            moved, failed = db.rebalance(pause=SHARD_REBALANCE_PAUSE)
+        finally:
+            rebalance_lock.release()
+        lines = [f"✅ Moved {moved} users in {time.perf_counter() - start:.1f}s"
+                 + (f", {failed} failed (run /rebalance again)" if failed else "")]
+        for shard in db.shard_stats():
+            lines.append(f"• #{shard['shard']}: {shard['users']} users, {shard['items']} items, {format_bytes(shard['db'])}")
+        bot.send_message(user_id, "\n".join(lines))
+    
+    # Moves take a while for many users; don't hold up a bot worker
+    threading.Thread(target=run, name="rebalance", daemon=True).start()
+
+def start_backup(user_id=None):
+    """Take a snapshot on its own thread, so other scheduled jobs keep running; report to user_id if given"""
+    def run():
+        try:
+            summary = backups.snapshot()
+        except Exception as e:
+            print(f"Error taking backup: {e}")
+            if user_id:
+                bot.send_message(user_id, f"❌ Backup failed: {e}")
+            return
+        if summary is None:
+            if user_id:
+                bot.send_message(user_id, "⏳ A backup is already running.")
+            return
+        
+        print(f"Backup {summary['name']}: {format_bytes(summary['bytes'])} in {summary['seconds']:.1f}s, "
+              f"{summary['photos_copied']} new photos")
+        if user_id:
+            bot.send_message(user_id, f"✅ Backup {summary['name']}: {summary['items']} items, "
+                                      f"{format_bytes(summary['bytes'])}, {summary['photos']} photos "
+                                      f"({summary['photos_copied']} new) in {summary['seconds']:.1f}s")
+    
+    threading.Thread(target=run, name="backup", daemon=True).start()
+
+if BACKUP_INTERVAL:
+    scheduler.every(BACKUP_INTERVAL, "backup", start_backup)
+
+@bot.message_handler(commands=['backup'], func=lambda message: message.from_user.id in ADMIN_USER_IDS)
+@router.wrap
+def backup_command(message):
+    """Take a backup now (admins only)"""
+    bot.send_message(message.from_user.id, "🗄 Backing up the database and photos...")
+    start_backup(message.from_user.id)
+
+@bot.message_handler(commands=['find'])
+@router.wrap
+def find_command(message):
+    """Search the user's wardrobe by meaning, without calling the AI"""
+    user_id = message.from_user.id
+    query = message.text.partition(' ')[2].strip()
+    if not query:
+        bot.send_message(user_id, "🔎 Tell me what to look for, e.g. /find something warm for a rainy office day")
+        return
+    
+    clothes = db.get_user_clothes(user_id)
+    if not clothes:
+        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first.")
+        return
+    
+    results = [(score, item) for score, item in wardrobe_search.search(user_id, query, SEARCH_RESULTS, clothes)
+               if score >= SEARCH_MIN_SCORE]
+    if not results:
+        bot.send_message(user_id, f"🔎 Nothing in your wardrobe matches \"{query}\".")
+        return
+    
+    lines = [f"🔎 Best matches for \"{query}\":\n"]
+    for i, (score, item) in enumerate(results, 1):
+        lines.append(f"{i}. {item['name']} ({item['category']}) · {score:.0%}")
+    bot.send_message(user_id, "\n".join(lines))
+    send_outfit_collage(user_id, [item for _, item in results])
+
+# Users with an export or import running, so each has at most one at a time
+wardrobe_transfers = set()
+wardrobe_transfers_lock = threading.Lock()
+
+def start_wardrobe_transfer(user_id, name, work):
+    """Run an export or import in the background; returns False if the user already has one running"""
+    with wardrobe_transfers_lock:
+        if user_id in wardrobe_transfers:
+            return False
+        wardrobe_transfers.add(user_id)
+    
+    def run():
+        try:
+            work()
+        except Exception as e:
+            print(f"Error in wardrobe {name} for user {user_id}: {e}")
+            bot.send_message(user_id, f"❌ Sorry, the {name} failed. Please try again later.")
+        finally:
+            with wardrobe_transfers_lock:
+                wardrobe_transfers.discard(user_id)
+    
+    # Large wardrobes take a while; don't hold up a bot worker
+    threading.Thread(target=run, name=f"wardrobe-{name}", daemon=True).start()
+    return True
+
+@bot.message_handler(commands=['export'])
+@router.wrap
+def export_command(message):
+    """Send the user their wardrobe as a file; '/export photos' zips the photos in too"""
+    user_id = message.from_user.id
+    photos = message.text.partition(' ')[2].strip().lower() == "photos"
+    
+    def work():
+        fd, path = tempfile.mkstemp(suffix=".zip" if photos else ".jsonl")
+        os.close(fd)
+        try:
+            counts = export_wardrobe(db, user_id, path, photos=photos)
+            if not counts["items"]:
+                bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first.")
+                return
+            if os.path.getsize(path) > EXPORT_MAX_UPLOAD:
+                bot.send_message(user_id, f"❌ The export is larger than {EXPORT_MAX_UPLOAD // (1024 * 1024)}MB, "
+                                          "too large for Telegram. Try /export without photos.")
+                return
+            
+            caption = f"📦 {counts['items']} items and {counts['outfits']} outfits"
+            if photos:
+                caption += f", {counts['photos']} photos"
+            with open(path, "rb") as export_file:
+                bot.send_document(user_id, export_file, caption=caption + ". Send it to /import to restore it.",
+                                  visible_file_name=f"wardrobe-{datetime.now():%Y-%m-%d}" + (".zip" if photos else ".jsonl"))
+        finally:
+            os.remove(path)
+    
+    if start_wardrobe_transfer(user_id, "export", work):
+        bot.send_message(user_id, "📦 Exporting your wardrobe... Please wait!")
+    else:
+        bot.send_message(user_id, "⏳ Your last export or import is still running.")
+
+@bot.message_handler(commands=['import'])
+@router.wrap
+def import_command(message):
+    """Ask for a file made by /export"""
+    user_id = message.from_user.id
+    state = get_user_state(user_id)
+    state.reset()
+    state.state = "waiting_for_import"
+    
+    bot.send_message(user_id,
+                    "📥 Send me a wardrobe file from /export (.jsonl, or .zip with photos).\n\n"
+                    "Items already in your wardrobe are skipped.",
+                    reply_markup=keyboards.IMPORT_MENU)
+
+@bot.message_handler(content_types=['document'])
+@router.wrap
+def handle_document(message):
+    """Import a wardrobe file sent after /import"""
+    user_id = message.from_user.id
+    state = get_user_state(user_id)
+    if state.state != "waiting_for_import":
+        return
+    
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        bot.send_message(user_id, f"❌ This file is too large. Maximum size is {IMPORT_MAX_FILE_SIZE // (1024 * 1024)}MB.")
+        return
+    
+    def work():
+        fd, path = tempfile.mkstemp(suffix=".import")
+        os.close(fd)
+        try:
+            file_info = bot.get_file(document.file_id)
+            success, error, _ = photo_store.fetch(file_info.file_path, path, IMPORT_MAX_FILE_SIZE)
+            if not success:
+                bot.send_message(user_id, f"❌ Sorry, I couldn't download this file: {error}. Please try again.")
+                return
+            
+            start = time.perf_counter()
+            try:
+                counts = import_wardrobe(db, user_id, path)
+            except ValueError as e:
+                bot.send_message(user_id, f"❌ {e}. Please send a file made by /export.", reply_markup=keyboards.MAIN_MENU)
+                return
+            print(f"Imported {counts['items']} items for user {user_id} in {time.perf_counter() - start:.1f}s")
+            
+            lines = [f"✅ Added {counts['items']} items and {counts['outfits']} outfits to your wardrobe!"]
+            if counts['photos']:
+                lines.append(f"📸 {counts['photos']} photos restored")
+            if counts['duplicates']:
+                lines.append(f"♻️ {counts['duplicates']} items were already in your wardrobe")
+            if counts['skipped']:
+                lines.append(f"⚠️ {counts['skipped']} entries couldn't be read or were left out")
+            bot.send_message(user_id, "\n".join(lines), reply_markup=keyboards.MAIN_MENU)
+        finally:
+            os.remove(path)
+    
+    if start_wardrobe_transfer(user_id, "import", work):
+        state.reset()
+        bot.send_message(user_id, "📥 Importing your wardrobe... Please wait!")
+    else:
+        bot.send_message(user_id, "⏳ Your last export or import is still running.")
+
+@router.state_button("waiting_for_import", "❌ Cancel")
+def cancel_import_handler(message, state):
+    """Stop waiting for an import file"""
+    state.reset()
+    
+    bot.send_message(message.from_user.id, "❌ Import cancelled.", reply_markup=keyboards.MAIN_MENU)
+
+@router.state("waiting_for_import")
+def import_text_handler(message, state):
+    """Remind the user an import needs a file"""
+    bot.send_message(message.from_user.id, "📥 Please send the wardrobe file as a document, or tap ❌ Cancel.")
 
 @bot.message_handler(commands=['help'])
+@router.wrap
 def help_command(message):
     """Handle /help command"""
     help_text = """
@@ -79,10 +647,14 @@ def help_command(message):
   - Click ✏️ to edit any item
   - Click 🗑️ to delete any item
 • All wardrobe management is now in one place!
+• /export: Download your wardrobe as a file (/export photos includes the photos)
+• /import: Add a wardrobe file from /export; items you already have are skipped
 
 🎨 **Creating Outfits:**
 • Create Outfit: Get AI-generated outfit suggestions
 • Suggestions: Get outfit ideas based on your wardrobe
+• /today: Today's outfit, picked from your wardrobe
+• /find <text>: Search your wardrobe, e.g. /find something warm for a rainy office day
 
 💡 **Tips:**
 • Use clear, well-lit photos for better analysis
@@ -96,11 +668,15 @@ def help_command(message):
     
     bot.send_message(message.from_user.id, help_text)
 
-@bot.message_handler(func=lambda message: message.text == "📸 Add Photo")
-def add_photo_handler(message):
+@router.button("❓ Help")
+def help_button_handler(message, state):
+    """Handle help button"""
+    help_command(message)
+
+@router.button("📸 Add Photo")
+def add_photo_handler(message, state):
     """Handle photo addition request"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     state.state = "waiting_for_photo"
     state.waiting_for = "photo"
     
@@ -108,11 +684,10 @@ def add_photo_handler(message):
                     "📸 Please send me a photo of your clothing item.\n\n"
                     "I'll analyze it with AI and show you the details!")
 
-@bot.message_handler(func=lambda message: message.text == "✍️ Add Description")
-def add_description_handler(message):
+@router.button("✍️ Add Description")
+def add_description_handler(message, state):
     """Handle add description button"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
     state.state = "waiting_for_description"
     state.waiting_for = "description"
@@ -124,31 +699,24 @@ def add_description_handler(message):
                     "• 'Black leather jacket with silver zippers'\n"
                     "• 'Red summer dress with floral pattern'")
 
-@bot.message_handler(func=lambda message: message.text == "📦 Bulk Upload")
-def bulk_upload_handler(message):
+@router.button("📦 Bulk Upload")
+def bulk_upload_handler(message, state):
     """Handle bulk upload button"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
-    
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    btn1 = types.KeyboardButton("📸 Bulk Photos (1-10)")
-    btn2 = types.KeyboardButton("✍️ Bulk Descriptions (1-10)")
-    btn3 = types.KeyboardButton("❌ Cancel")
-    markup.add(btn1, btn2, btn3)
     
     bot.send_message(user_id, 
                     "📦 Choose your bulk upload method:\n\n"
                     "📸 Bulk Photos: Upload 1-10 photos at once\n"
                     "✍️ Bulk Descriptions: Add 1-10 items via text\n\n"
                     "You can send multiple photos/descriptions and I'll process them all together!",
-                    reply_markup=markup)
+                    reply_markup=keyboards.BULK_UPLOAD_MENU)
 
-@bot.message_handler(func=lambda message: message.text == "📸 Bulk Photos (1-10)")
-def bulk_photos_handler(message):
+@router.button("📸 Bulk Photos (1-10)")
+def bulk_photos_handler(message, state):
     """Handle bulk photos button"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
+    state.reset()
     state.state = "bulk_photos"
     state.waiting_for = "photos"
     state.temp_data = {'photos': [], 'max_photos': 10}
@@ -161,12 +729,12 @@ def bulk_photos_handler(message):
                     "Type '❌ Cancel' to stop.\n\n"
                     f"📸 Photos added: 0/{state.temp_data['max_photos']}")
 
-@bot.message_handler(func=lambda message: message.text == "✍️ Bulk Descriptions (1-10)")
-def bulk_descriptions_handler(message):
+@router.button("✍️ Bulk Descriptions (1-10)")
+def bulk_descriptions_handler(message, state):
     """Handle bulk descriptions button"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
+    state.reset()
     state.state = "bulk_descriptions"
     state.waiting_for = "descriptions"
     state.temp_data = {'descriptions': [], 'max_descriptions': 10}
@@ -182,11 +750,10 @@ def bulk_descriptions_handler(message):
                     "Type '❌ Cancel' to stop.\n\n"
                     f"✍️ Descriptions added: 0/{state.temp_data['max_descriptions']}")
 
-@bot.message_handler(func=lambda message: message.text == "🎨 Create Outfit")
-def create_outfit_handler(message):
+@router.button("🎨 Create Outfit")
+def create_outfit_handler(message, state):
     """Handle outfit creation request"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
     # Check if user has clothes
     clothes = db.get_user_clothes(user_id)
@@ -196,22 +763,12 @@ def create_outfit_handler(message):
         return
     
     # Ask for outfit request
-    state.state = "waiting_for_outfit_request"
-    state.waiting_for = "outfit_request"
-    
-    bot.send_message(user_id, 
-                    "🎨 What kind of outfit would you like me to create?\n\n"
-                    "Examples:\n"
-                    "• 'Casual weekend look'\n"
-                    "• 'Professional office outfit'\n"
-                    "• 'Evening party ensemble'\n"
-                    "• 'Comfortable weekend look'")
+    ask_for_outfit_request(user_id, state)
 
-@bot.message_handler(func=lambda message: message.text == "📚 My Wardrobe")
-def wardrobe_handler(message):
+@router.button("📚 My Wardrobe")
+def wardrobe_handler(message, state):
     """Handle wardrobe view request"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
     # Get user's clothes
     clothes = db.get_user_clothes(user_id)
@@ -232,7 +789,7 @@ def wardrobe_handler(message):
             callback_data=f"edit_item_{item['id']}"
         )
         delete_btn = types.InlineKeyboardButton(
-            f"🗑️ Delete {item['name']}", 
+            f"🗑️ Delete {item['name']}",
             callback_data=f"delete_item_{item['id']}"
         )
         markup.add(edit_btn, delete_btn)
@@ -241,11 +798,10 @@ def wardrobe_handler(message):
     
     bot.send_message(user_id, wardrobe_text, reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text == "🗑️ Delete Clothes")
-def delete_clothes_handler(message):
+@router.button("🗑️ Delete Clothes")
+def delete_clothes_handler(message, state):
     """Handle delete clothes request"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
     # Get user's clothes
     clothes = db.get_user_clothes(user_id)
@@ -268,97 +824,184 @@ def delete_clothes_handler(message):
     
     bot.send_message(user_id, delete_text, reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text == "💡 Suggestions")
-def suggestions_handler(message):
-    """Handle outfit suggestions request"""
+@router.button("✏️ Edit Wardrobe")
+def edit_wardrobe_handler(message, state):
+    """Handle edit wardrobe button"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     
     # Get user's clothes
     clothes = db.get_user_clothes(user_id)
     
     if not clothes:
-        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first to get suggestions.")
+        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first.")
         return
     
-    # Generate outfit suggestions
-    bot.send_message(user_id, "💡 Generating outfit suggestions... Please wait!")
+    # Show clothes with edit options
+    wardrobe_text = "📚 Your Wardrobe - Click to edit:\n\n"
+    
+    markup = types.InlineKeyboardMarkup(row_width=1)
     
-    suggestions = ai_service.generate_outfit_suggestions(clothes)
+    for item in clothes:
+        btn_text = f"✏️ {item['name']} (ID: {item['id']})"
+        callback_data = f"edit_item_{item['id']}"
+        markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_data))
+    
+    markup.add(types.InlineKeyboardButton("❌ Close", callback_data="close_wardrobe"))
+    
+    bot.send_message(user_id, wardrobe_text, reply_markup=markup)
+
+def send_suggestions(user_id, more=False):
+    """Send outfit suggestions for the user's wardrobe; `more` moves on to different ones"""
+    # Read the version first, so a change in between makes it stale rather than mislabelled
+    version = db.get_wardrobe_version(user_id)
+    clothes = db.get_user_clothes(user_id)
+    
+    if not clothes:
+        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first to get suggestions.")
+        return
+    
+    # Serve the next few from the pool made off-peak, and only ask the AI once it's used up
+    suggestions = precomputer.take(user_id, "suggestions", SUGGESTIONS_SHOWN)
+    if not suggestions:
+        # Then the answers already given for this wardrobe, before asking for new ones
+        key = ai_results.key(user_id, 'generate_outfit_suggestions', clothes)
+        suggestions = ai_results.rotate(key) if more else ai_results.get(key)
+    if not suggestions:
+        bot.send_message(user_id, "💡 Generating outfit suggestions... Please wait!")
+        
+        combinations = compatibility.top_outfits(user_id, clothes, COMPATIBILITY_TOP_OUTFITS, version)
+        suggestions = call_ai(user_id, 'generate_outfit_suggestions', None,
+                              clothes, combinations, version, version=version)
+        # The stock list means the AI had no answer; ask again next time
+        if suggestions and tuple(suggestions) != FALLBACK_SUGGESTIONS:
+            ai_results.add(key, suggestions)
     
     if suggestions:
         suggestion_text = "💡 Outfit Suggestions:\n\n"
         
-        for i, suggestion in enumerate(suggestions[:5], 1):  # Show top 5 suggestions
+        for i, suggestion in enumerate(suggestions[:SUGGESTIONS_SHOWN], 1):
             suggestion_text += f"{i}. {suggestion}\n\n"
         
-        markup = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("🎨 Create Outfit", callback_data="create_from_suggestion")
-        btn2 = types.InlineKeyboardButton("🔄 More Suggestions", callback_data="more_suggestions")
-        markup.add(btn1, btn2)
-        
-        bot.send_message(user_id, suggestion_text, reply_markup=markup)
+        bot.send_message(user_id, suggestion_text, reply_markup=keyboards.SUGGESTION_ACTIONS)
     else:
         bot.send_message(user_id, "❌ Sorry, I couldn't generate suggestions right now. Try again later!")
 
+@router.button("💡 Suggestions")
+def suggestions_handler(message, state):
+    """Handle outfit suggestions request"""
+    send_suggestions(message.from_user.id)
+
 @bot.message_handler(content_types=['photo'])
+@router.wrap
 def handle_photo(message):
     """Handle photo uploads"""
     user_id = message.from_user.id
     state = get_user_state(user_id)
     
+    # Photos are only accepted while a photo flow is active
+    if state.state not in ("waiting_for_photo", "bulk_photos"):
+        return
+    
+    if state.state == "bulk_photos" and len(state.temp_data['photos']) >= state.temp_data['max_photos']:
+        bot.send_message(user_id, f"❌ Maximum {state.temp_data['max_photos']} photos reached! Type 'Done' to process them.")
+        return
+    
     # Get the largest photo size
     photo = message.photo[-1]
     file_id = photo.file_id
+    unique_id = photo.file_unique_id
+    
+    # Reject oversize photos before spending any bandwidth on them
+    if photo_store.is_too_large(photo.file_size):
+        bot.send_message(user_id, 
+                        f"❌ This photo is too large. Maximum size is {MAX_PHOTO_SIZE // (1024 * 1024)}MB.")
+        return
     
-    # Download the photo
+    # The exact same Telegram photo needs no download to be recognised
+    existing_item = db.get_clothing_item_by_photo(user_id, unique_id)
+    if existing_item and existing_item['photo_path'] and os.path.exists(existing_item['photo_path']):
+        # The saved item's file is reused, so it must never be discarded with this upload
+        photo_data = {'file_id': file_id, 'unique_id': unique_id, 'path': existing_item['photo_path'],
+                      'hash': existing_item['photo_hash'], 'shared': True}
+        offer_duplicate(user_id, state, photo_data, existing_item['name'])
+        return
+    
+    if state.state == "bulk_photos":
+        for pending in state.temp_data['photos']:
+            if pending['unique_id'] == unique_id:
+                bot.send_message(user_id, "♻️ This photo is already in this batch.")
+                return
+    
+    # Stream the photo to local storage
     file_info = bot.get_file(file_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    photo_filename = photo_store.build_path(user_id, file_id)
+    success, error = photo_store.download(file_info.file_path, photo_filename, file_info.file_size)
     
-    # Save photo to local storage
-    photo_filename = f"photos/{user_id}_{int(time.time())}_{file_id}.jpg"
-    os.makedirs("photos", exist_ok=True)
+    if not success:
+        bot.send_message(user_id, f"❌ Sorry, I couldn't download this photo: {error}. Please try again.")
+        return
     
-    with open(photo_filename, 'wb') as new_file:
-        new_file.write(downloaded_file)
+    photo_data = {'file_id': file_id, 'unique_id': unique_id, 'path': photo_filename, 'hash': None}
     
+    # A new upload of a garment already saved (re-taken, re-sent or cropped) still hashes close to the original
+    try:
+        photo_data['hash'] = dhash(photo_filename)
+    except OSError as e:
+        print(f"Error hashing photo: {e}")
+    
+    if photo_data['hash'] is not None:
+        duplicate_id = photo_index.find_duplicate(user_id, photo_data['hash'])
+        duplicate = db.get_clothing_item(user_id, duplicate_id) if duplicate_id else None
+        if duplicate:
+            offer_duplicate(user_id, state, photo_data, duplicate['name'])
+            return
+        if state.state == "bulk_photos":
+            for pending in state.temp_data['photos']:
+                if pending['hash'] is not None and hamming(pending['hash'], photo_data['hash']) <= photo_index.max_distance:
+                    discard_photo(photo_data)
+                    bot.send_message(user_id, "♻️ This looks like a photo already in this batch.")
+                    return
+    
+    accept_photo(user_id, state, photo_data)
+
+def discard_photo(photo_data):
+    """Delete a downloaded photo that won't be saved, unless it's a saved item's file"""
+    if photo_data.get('shared'):
+        return
+    try:
+        os.remove(photo_data['path'])
+    except OSError as e:
+        print(f"Error deleting photo: {e}")
+
+def offer_duplicate(user_id, state, photo_data, item_name):
+    """Tell the user the photo matches a saved item, without analyzing it, and let them add it anyway"""
+    # Only the latest duplicate can still be added
+    previous = state.temp_data.get('duplicate_photo')
+    if previous and previous['path'] != photo_data['path']:
+        discard_photo(previous)
+    state.temp_data['duplicate_photo'] = photo_data
+    bot.send_message(user_id, f"♻️ This looks like an item already in your wardrobe as \"{item_name}\".",
+                     reply_markup=keyboards.DUPLICATE_PHOTO_ACTIONS)
+
+def accept_photo(user_id, state, photo_data):
+    """Analyze a single photo, or add it to the bulk batch"""
     if state.state == "waiting_for_photo":
         # Single photo upload
         bot.send_message(user_id, "🔍 Analyzing your photo... Please wait!")
         
         # Analyze the photo
-        analysis = ai_service.analyze_photo(photo_filename)
+        analysis = call_ai(user_id, 'analyze_photo', photo_data['path'], photo_data['path'])
         
         if analysis:
             # Store analysis in state
             state.temp_data['analysis'] = analysis
-            state.temp_data['photo_path'] = photo_filename
-            state.temp_data['photo_file_id'] = file_id
+            state.temp_data['photo_path'] = photo_data['path']
+            state.temp_data['photo_file_id'] = photo_data['file_id']
+            state.temp_data['photo_unique_id'] = photo_data['unique_id']
+            state.temp_data['photo_hash'] = photo_data['hash']
             
             # Show analysis and ask for confirmation
-            confirm_text = f"""
-✅ Analysis Results:
-
-📋 Item Details:
-• Name: {analysis['name']}
-• Category: {analysis['category']}
-• Season: {analysis['season']}
-• Occasion: {analysis['occasion']}
-• Tags: {', '.join(analysis['tags'])}
-
-Is this correct? You can edit any field if needed.
-"""
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("✅ Save as is")
-            btn2 = types.KeyboardButton("✏️ Edit details")
-            btn3 = types.KeyboardButton("❌ Cancel")
-            markup.add(btn1, btn2, btn3)
-            
-            state.state = "confirming_photo_analysis"
-            state.waiting_for = "confirmation"
-            
-            bot.send_message(user_id, confirm_text, reply_markup=markup)
+            send_analysis_confirmation(user_id, state, "✅ Analysis Results:")
         else:
             bot.send_message(user_id, "❌ Sorry, I couldn't analyze this photo. Please try again with a clearer image.")
             state.state = "idle"
@@ -366,638 +1009,676 @@ Is this correct? You can edit any field if needed.
     
     elif state.state == "bulk_photos":
         # Bulk photo upload
-        current_count = len(state.temp_data['photos'])
         max_photos = state.temp_data['max_photos']
-        
-        if current_count >= max_photos:
+        if len(state.temp_data['photos']) >= max_photos:
             bot.send_message(user_id, f"❌ Maximum {max_photos} photos reached! Type 'Done' to process them.")
             return
         
-        state.temp_data['photos'].append({
-            'file_id': file_id,
-            'path': photo_filename
-        })
+        state.temp_data['photos'].append(photo_data)
         
         new_count = len(state.temp_data['photos'])
         bot.send_message(user_id, f"📸 Photo {new_count} added! ({new_count}/{max_photos})\n\nSend more photos or type 'Done' when finished.")
 
-@bot.message_handler(func=lambda message: True)
-def handle_text(message):
-    """Handle all text messages"""
+@router.state("waiting_for_description")
+def description_handler(message, state):
+    """Analyze a single item description"""
     user_id = message.from_user.id
-    state = get_user_state(user_id)
     text = message.text
     
-    if text == "❓ Help":
-        help_command(message)
-        return
+    # Analyze the description
+    analysis = call_ai(user_id, 'analyze_text_description', text.strip(), text)
     
-    # Handle different states
-    if state.state == "waiting_for_description":
-        # Analyze the description
-        analysis = ai_service.analyze_text_description(text)
-        
-        # Store analysis in state
-        state.temp_data['analysis'] = analysis
-        state.temp_data['user_description'] = text
-        
-        # Show analysis and ask for confirmation
-        confirm_text = f"""
+    # Store analysis in state
+    state.temp_data['analysis'] = analysis
+    state.temp_data['user_description'] = text
+    
+    # Show analysis and ask for confirmation
+    confirm_text = f"""
 ✅ I analyzed your description: "{text}"
 
 📋 Analysis Results:
-• Name: {analysis['name']}
-• Category: {analysis['category']}
-• Season: {analysis['season']}
-• Occasion: {analysis['occasion']}
-• Tags: {', '.join(analysis['tags'])}
+{format_analysis(analysis)}
 
 Is this correct? You can edit any field if needed.
 """
-        
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        btn1 = types.KeyboardButton("✅ Save as is")
-        btn2 = types.KeyboardButton("✏️ Edit details")
-        btn3 = types.KeyboardButton("❌ Cancel")
-        markup.add(btn1, btn2, btn3)
-        
-        state.state = "confirming_description"
-        state.waiting_for = "confirmation"
-        
-        bot.send_message(user_id, confirm_text, reply_markup=markup)
     
-    elif state.state == "confirming_photo_analysis" or state.state == "confirming_description":
-        if text == "✅ Save as is":
-            # Save the item
-            analysis = state.temp_data['analysis']
-            
-            # Add to database
+    state.state = "confirming_description"
+    state.waiting_for = "confirmation"
+    
+    bot.send_message(user_id, confirm_text, reply_markup=keyboards.CONFIRM_ANALYSIS)
+
+@router.state_button(("confirming_photo_analysis", "confirming_description"), "✅ Save as is")
+def save_analysis_handler(message, state):
+    """Save the confirmed item"""
+    user_id = message.from_user.id
+    analysis = state.temp_data['analysis']
+    
+    # Add to database
+    item_id = db.add_clothing_item(
+        user_id=user_id,
+        name=analysis['name'],
+        category=analysis['category'],
+        description=f"{analysis['name']} - {analysis['category']}",
+        photo_file_id=state.temp_data.get('photo_file_id'),
+        photo_path=state.temp_data.get('photo_path'),
+        tags=analysis['tags'],
+        photo_unique_id=state.temp_data.get('photo_unique_id'),
+        season=analysis.get('season'),
+        occasion=analysis.get('occasion'),
+        photo_hash=state.temp_data.get('photo_hash')
+    )
+    
+    if state.temp_data.get('photo_path'):
+        collage_renderer.ensure_thumbnail(item_id, state.temp_data['photo_path'])
+    
+    # Reset state
+    state.reset()
+    
+    # Show main menu
+    bot.send_message(user_id, 
+                    f"✅ Successfully added '{analysis['name']}' to your wardrobe!\n\n"
+                    f"Category: {analysis['category'].title()}\n"
+                    f"Item ID: {item_id}",
+                    reply_markup=keyboards.MAIN_MENU)
+
+@router.state_button(("confirming_photo_analysis", "confirming_description"), "✏️ Edit details")
+def edit_analysis_handler(message, state):
+    """Start editing the analyzed item before saving"""
+    state.state = "editing_item"
+    state.waiting_for = "edit_field"
+    
+    bot.send_message(message.from_user.id, 
+                    "✏️ What would you like to edit?",
+                    reply_markup=keyboards.EDIT_NEW_ITEM_FIELDS)
+
+@router.state_button(("confirming_photo_analysis", "confirming_description"), "❌ Cancel")
+def cancel_analysis_handler(message, state):
+    """Discard the analyzed item"""
+    state.reset()
+    
+    bot.send_message(message.from_user.id, "❌ Cancelled. What would you like to do?", reply_markup=keyboards.MAIN_MENU)
+
+@router.state("editing_item", waiting_for="edit_value")
+def edit_analysis_value_handler(message, state):
+    """Update a field of the analyzed item"""
+    field = state.temp_data['editing_field']
+    analysis = state.temp_data['analysis']
+    text = message.text
+    
+    if field == "tags":
+        # Handle tags as a list
+        analysis[field] = [tag.strip() for tag in text.split(',')]
+    else:
+        analysis[field] = text.lower() if field in ['category', 'season', 'occasion'] else text
+    
+    state.temp_data['analysis'] = analysis
+    
+    # Show updated analysis
+    send_analysis_confirmation(message.from_user.id, state, "✅ Updated Analysis Results:")
+
+@router.state_button("editing_item", "❌ Cancel Edit", waiting_for="edit_field")
+def cancel_analysis_edit_handler(message, state):
+    """Go back to confirming the analyzed item"""
+    send_analysis_confirmation(message.from_user.id, state, "✅ Analysis Results:")
+
+NEW_ITEM_FIELDS = {
+    "📝 Name": "name",
+    "📂 Category": "category", 
+    "🏷️ Tags": "tags",
+    "🌤️ Season": "season",
+    "🎯 Occasion": "occasion"
+}
+
+@router.state_button("editing_item", *NEW_ITEM_FIELDS, waiting_for="edit_field")
+def choose_analysis_field_handler(message, state):
+    """Ask for a new value of the chosen field"""
+    user_id = message.from_user.id
+    text = message.text
+    
+    # Store which field to edit
+    state.temp_data['editing_field'] = NEW_ITEM_FIELDS[text]
+    state.waiting_for = "edit_value"
+    
+    if text == "📂 Category":
+        bot.send_message(user_id, "📂 Choose the category:", reply_markup=keyboards.CATEGORY_CHOICES)
+    elif text == "🌤️ Season":
+        bot.send_message(user_id, "🌤️ Choose the season:", reply_markup=keyboards.SEASON_CHOICES)
+    elif text == "🎯 Occasion":
+        bot.send_message(user_id, "🎯 Choose the occasion:", reply_markup=keyboards.OCCASION_CHOICES)
+    else:
+        bot.send_message(user_id, f"Enter the new {NEW_ITEM_FIELDS[text].lower()}:")
+
+def outfit_for_request(user_id, request, user_clothes, version, precomputing=False):
+    """Ask the AI for an outfit, falling back to the best pre-scored combination
+    
+    `version` is the wardrobe version read before `user_clothes` was.
+    
+    Precomputed outfits are recorded under AI_SYSTEM_USER_ID, so they count
+    against the bot's daily budget rather than the user's quota, and are
+    left out (None) when the AI has no answer.
+    """
+    # Large wardrobes only send the items most relevant to the request
+    prompt_clothes = user_clothes
+    if len(user_clothes) > OUTFIT_PROMPT_MAX_ITEMS:
+        prompt_clothes = wardrobe_search.relevant_items(user_id, request, OUTFIT_PROMPT_MAX_ITEMS, user_clothes)
+    
+    combinations = compatibility.top_outfits(user_id, user_clothes, COMPATIBILITY_TOP_OUTFITS, version)
+    # The wardrobe text is memoized per version, which only holds for the whole wardrobe
+    prompt_version = version if prompt_clothes is user_clothes else None
+    if precomputing:
+        outfit = ai_service.generate_outfit(prompt_clothes, request, None, combinations, prompt_version,
+                                            user_id=AI_SYSTEM_USER_ID)
+        return outfit if outfit and outfit.get("selected_items") else None
+    
+    # The same request for an unchanged wardrobe gets the same answer
+    key = ai_results.key(user_id, 'generate_outfit', user_clothes, request)
+    outfit = ai_results.get(key)
+    if outfit is None:
+        outfit = call_ai(user_id, 'generate_outfit', request.strip().lower(),
+                         prompt_clothes, request, None, combinations, prompt_version, version=version)
+        if outfit and outfit.get("selected_items"):
+            ai_results.add(key, outfit)
+    
+    # Without an answer from the AI, fall back to the best pre-scored combination
+    if combinations and not (outfit and outfit.get("selected_items")):
+        outfit = {
+            "selected_items": [item['name'] for item in combinations[0]],
+            "styling_tips": ["These pieces match well by category, season, occasion and color."]
+        }
+    return outfit
+
+def send_outfit(user_id, state, name, outfit, user_clothes, version, header="🎨 Your Outfit:"):
+    """Send an outfit with its collage and a Save button"""
+    outfit_text = f"{header}\n\n"
+    
+    outfit_text += "👕 Items to wear:\n"
+    for item in outfit['selected_items']:
+        outfit_text += f"  • {item}\n"
+    
+    if outfit.get('styling_tips'):
+        outfit_text += "\n💡 Styling Tips:\n"
+        for tip in outfit['styling_tips']:
+            outfit_text += f"  • {tip}\n"
+    
+    # Map the generated item names back to wardrobe items
+    selected_clothes = item_resolver.resolve(user_id, version, user_clothes, outfit['selected_items'])
+    
+    # Show the selected items' photos together when they have any
+    send_outfit_collage(user_id, selected_clothes)
+    
+    sent = bot.send_message(user_id, outfit_text, reply_markup=keyboards.OUTFIT_ACTIONS)
+    
+    # Keep the resolved outfit until the user decides whether to save it
+    state.pending_outfits[sent.message_id] = {
+        'name': name,
+        'description': "\n".join(outfit.get('styling_tips') or []),
+        'clothes_ids': [item['id'] for item in selected_clothes]
+    }
+    while len(state.pending_outfits) > MAX_PENDING_OUTFITS:
+        state.pending_outfits.popitem(last=False)
+
+def today_request():
+    return f"An everyday outfit for today, {datetime.now():%A, %B %d}"
+
+def precompute_suggestions(user_id, clothes, version):
+    """A pool of suggestions for the Suggestions and More Suggestions buttons"""
+    combinations = compatibility.top_outfits(user_id, clothes, COMPATIBILITY_TOP_OUTFITS, version)
+    pool = []
+    for _ in range(PRECOMPUTE_SUGGESTION_ROUNDS):
+        suggestions = ai_service.generate_outfit_suggestions(clothes, combinations, version,
+                                                             user_id=AI_SYSTEM_USER_ID)
+        # The stock list means the AI had no answer; don't keep it for the whole day
+        if tuple(suggestions) == FALLBACK_SUGGESTIONS:
+            break
+        pool.extend(suggestion for suggestion in suggestions if suggestion not in pool)
+    return pool or None
+
+def precompute_daily_outfit(user_id, clothes, version):
+    return outfit_for_request(user_id, today_request(), clothes, version, precomputing=True)
+
+def is_idle():
+    """Whether no user is waiting on the bot or the AI, so background AI work can't slow anyone down"""
+    return bot_queue_depth() == 0 and ai_requests.in_flight() == 0
+
+precomputer = Precomputer(db, {"suggestions": precompute_suggestions, "daily_outfit": precompute_daily_outfit},
+                          is_idle=is_idle)
+scheduler.every(PRECOMPUTE_INTERVAL, "precompute", precomputer.run)
+
+@bot.message_handler(commands=['today'])
+@router.wrap
+def today_command(message):
+    """Handle /today: today's outfit, precomputed off-peak when possible"""
+    user_id = message.from_user.id
+    state = get_user_state(user_id)
+    
+    version = db.get_wardrobe_version(user_id)
+    user_clothes = db.get_user_clothes(user_id)
+    if not user_clothes:
+        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first to create outfits.")
+        return
+    
+    outfit = precomputer.get(user_id, "daily_outfit")
+    if outfit is None:
+        bot.send_message(user_id, "☀️ Picking today's outfit... Please wait!")
+        outfit = outfit_for_request(user_id, today_request(), user_clothes, version)
+    
+    if outfit and outfit.get("selected_items"):
+        send_outfit(user_id, state, "Today's outfit", outfit, user_clothes, version, header="☀️ Today's Outfit:")
+    else:
+        bot.send_message(user_id, "❌ Sorry, I couldn't pick an outfit right now. Try again later!")
+
+@router.state("waiting_for_outfit_request")
+def outfit_request_handler(message, state):
+    """Generate an outfit based on the user's request"""
+    user_id = message.from_user.id
+    text = message.text
+    
+    version = db.get_wardrobe_version(user_id)
+    user_clothes = db.get_user_clothes(user_id)
+    
+    bot.send_message(user_id, "🎨 Creating your outfit... Please wait!")
+    
+    outfit = outfit_for_request(user_id, text, user_clothes, version)
+    
+    if outfit and outfit.get("selected_items"):
+        send_outfit(user_id, state, text, outfit, user_clothes, version)
+    else:
+        bot.send_message(user_id, "❌ Sorry, I couldn't create an outfit with your request. Try a different description!")
+    
+    # Reset state
+    state.state = "idle"
+    state.waiting_for = None
+
+def send_bulk_interrupted(user_id, added_items, left, kind):
+    """Tell the user which items a bulk upload added before an AI call was refused"""
+    if added_items:
+        text = "📋 Added before the limit was reached:\n"
+        text += "".join(f"{i}. {item_name}\n" for i, item_name in enumerate(added_items, 1))
+        text += f"\n{left} {kind} are left; type 'Done' later to add them."
+        bot.send_message(user_id, text)
+
+@router.state_button("bulk_descriptions", "Done")
+def bulk_descriptions_done_handler(message, state):
+    """Analyze and save all collected descriptions"""
+    user_id = message.from_user.id
+    
+    if not state.temp_data['descriptions']:
+        bot.send_message(user_id, "❌ No descriptions added. Please add some descriptions first.")
+        return
+    
+    # Don't start a batch the user has no AI allowance left for
+    usage_tracker.check(user_id, reserve=False)
+    
+    # Store the count before processing
+    descriptions_count = len(state.temp_data['descriptions'])
+    
+    # Process all descriptions
+    bot.send_message(user_id, f"🔍 Processing {descriptions_count} items... Please wait!")
+    
+    success_count = 0
+    added_items = []  # Track successfully added items
+    
+    for description in list(state.temp_data['descriptions']):
+        try:
+            analysis = call_ai(user_id, 'analyze_text_description', description.strip(), description)
+        except QuotaExceededError:
+            send_bulk_interrupted(user_id, added_items, len(state.temp_data['descriptions']), "descriptions")
+            raise
+        if analysis:
             item_id = db.add_clothing_item(
                 user_id=user_id,
                 name=analysis['name'],
                 category=analysis['category'],
-                description=f"{analysis['name']} - {analysis['category']}",
-                photo_file_id=state.temp_data.get('photo_file_id'),
-                photo_path=state.temp_data.get('photo_path'),
-                tags=analysis['tags']
+                description=description,
+                photo_file_id=None,
+                photo_path=None,
+                tags=analysis['tags'],
+                season=analysis.get('season'),
+                occasion=analysis.get('occasion')
             )
-            
-            # Reset state
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            # Show main menu
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, 
-                            f"✅ Successfully added '{analysis['name']}' to your wardrobe!\n\n"
-                            f"Category: {analysis['category'].title()}\n"
-                            f"Item ID: {item_id}",
-                            reply_markup=markup)
-        
-        elif text == "✏️ Edit details":
-            # Start editing process
-            state.state = "editing_item"
-            state.waiting_for = "edit_field"
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📝 Name")
-            btn2 = types.KeyboardButton("📂 Category")
-            btn3 = types.KeyboardButton("🏷️ Tags")
-            btn4 = types.KeyboardButton("🌤️ Season")
-            btn5 = types.KeyboardButton("🎯 Occasion")
-            btn6 = types.KeyboardButton("❌ Cancel Edit")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6)
-            
-            bot.send_message(user_id, 
-                            "✏️ What would you like to edit?",
-                            reply_markup=markup)
-        
-        elif text == "❌ Cancel":
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, "❌ Cancelled. What would you like to do?", reply_markup=markup)
+            if item_id:
+                # A retry after a refused AI call only handles what's left
+                state.temp_data['descriptions'].remove(description)
+                success_count += 1
+                added_items.append(analysis['name'])
+    
+    # Reset state
+    state.reset()
+    
+    # Create the result message with item list
+    if added_items:
+        result_message = f"✅ Successfully added {success_count} out of {descriptions_count} items to your wardrobe!\n\n"
+        result_message += "📋 You added:\n"
+        for i, item_name in enumerate(added_items, 1):
+            result_message += f"{i}. {item_name}\n"
+    else:
+        result_message = f"❌ Failed to add any items. Please try again with better descriptions."
     
-    elif state.state == "editing_item":
-        if state.waiting_for == "edit_value":
-            # Update the field value
-            field = state.temp_data['editing_field']
-            analysis = state.temp_data['analysis']
-            
-            if field == "tags":
-                # Handle tags as a list
-                analysis[field] = [tag.strip() for tag in text.split(',')]
-            else:
-                analysis[field] = text.lower() if field in ['category', 'season', 'occasion'] else text
-            
-            state.temp_data['analysis'] = analysis
-            state.waiting_for = "edit_field"
-            
-            # Show updated analysis
-            confirm_text = f"""
-✅ Updated Analysis Results:
+    # Show main menu
+    bot.send_message(user_id, result_message, reply_markup=keyboards.MAIN_MENU)
 
-📋 Item Details:
-• Name: {analysis['name']}
-• Category: {analysis['category']}
-• Season: {analysis['season']}
-• Occasion: {analysis['occasion']}
-• Tags: {', '.join(analysis['tags'])}
+@router.state_button(("bulk_descriptions", "bulk_photos"), "❌ Cancel")
+def cancel_bulk_handler(message, state):
+    """Cancel a bulk upload"""
+    state.reset()
+    
+    bot.send_message(message.from_user.id, "❌ Bulk upload cancelled.", reply_markup=keyboards.MAIN_MENU)
 
-Is this correct? You can edit any field if needed.
-"""
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("✅ Save as is")
-            btn2 = types.KeyboardButton("✏️ Edit details")
-            btn3 = types.KeyboardButton("❌ Cancel")
-            markup.add(btn1, btn2, btn3)
-            
-            state.state = "confirming_photo_analysis" if state.temp_data.get('photo_path') else "confirming_description"
-            state.waiting_for = "confirmation"
-            
-            bot.send_message(user_id, confirm_text, reply_markup=markup)
-        
-        elif text == "❌ Cancel Edit":
-            # Go back to confirmation
-            analysis = state.temp_data['analysis']
-            confirm_text = f"""
-✅ Analysis Results:
+@router.state("bulk_descriptions")
+def bulk_description_handler(message, state):
+    """Add a description to the bulk list"""
+    user_id = message.from_user.id
+    
+    current_count = len(state.temp_data['descriptions'])
+    max_descriptions = state.temp_data['max_descriptions']
+    
+    if current_count >= max_descriptions:
+        bot.send_message(user_id, f"❌ Maximum {max_descriptions} descriptions reached! Type 'Done' to process them.")
+        return
+    
+    state.temp_data['descriptions'].append(message.text)
+    new_count = len(state.temp_data['descriptions'])
+    bot.send_message(user_id, f"✍️ Description {new_count} added! ({new_count}/{max_descriptions})\n\nSend more descriptions or type 'Done' when finished.")
 
-📋 Item Details:
-• Name: {analysis['name']}
-• Category: {analysis['category']}
-• Season: {analysis['season']}
-• Occasion: {analysis['occasion']}
-• Tags: {', '.join(analysis['tags'])}
+@router.state_button("bulk_photos", "Done")
+def bulk_photos_done_handler(message, state):
+    """Analyze and save all collected photos"""
+    user_id = message.from_user.id
+    
+    if not state.temp_data['photos']:
+        bot.send_message(user_id, "❌ No photos added. Please add some photos first.")
+        return
+    
+    # Don't start a batch the user has no AI allowance left for
+    usage_tracker.check(user_id, reserve=False)
+    
+    # Store the count before processing
+    photo_count = len(state.temp_data['photos'])
+    
+    # Process all photos
+    bot.send_message(user_id, f"🔍 Processing {photo_count} photos... Please wait!")
+    
+    success_count = 0
+    added_items = []  # Track successfully added items
+    
+    for photo_data in list(state.temp_data['photos']):
+        try:
+            analysis = call_ai(user_id, 'analyze_photo', photo_data['path'], photo_data['path'])
+        except QuotaExceededError:
+            send_bulk_interrupted(user_id, added_items, len(state.temp_data['photos']), "photos")
+            raise
+        if analysis:
+            item_id = db.add_clothing_item(
+                user_id=user_id,
+                name=analysis['name'],
+                category=analysis['category'],
+                description=f"{analysis['name']} - {analysis['category']}",
+                photo_file_id=photo_data['file_id'],
+                photo_path=photo_data['path'],
+                tags=analysis['tags'],
+                photo_unique_id=photo_data.get('unique_id'),
+                season=analysis.get('season'),
+                occasion=analysis.get('occasion'),
+                photo_hash=photo_data.get('hash')
+            )
+            if item_id:
+                collage_renderer.ensure_thumbnail(item_id, photo_data['path'])
+                # A retry after a refused AI call only handles what's left
+                state.temp_data['photos'].remove(photo_data)
+                success_count += 1
+                added_items.append(analysis['name'])
+    
+    # Reset state
+    state.reset()
+    
+    # Create the result message with item list
+    if added_items:
+        result_message = f"✅ Successfully added {success_count} out of {photo_count} items to your wardrobe!\n\n"
+        result_message += "📋 You added:\n"
+        for i, item_name in enumerate(added_items, 1):
+            result_message += f"{i}. {item_name}\n"
+    else:
+        result_message = f"❌ Failed to add any items. Please try again with clearer photos."
+    
+    # Show main menu
+    bot.send_message(user_id, result_message, reply_markup=keyboards.MAIN_MENU)
 
-Is this correct? You can edit any field if needed.
-"""
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("✅ Save as is")
-            btn2 = types.KeyboardButton("✏️ Edit details")
-            btn3 = types.KeyboardButton("❌ Cancel")
-            markup.add(btn1, btn2, btn3)
-            
-            state.state = "confirming_photo_analysis" if state.temp_data.get('photo_path') else "confirming_description"
-            state.waiting_for = "confirmation"
-            
-            bot.send_message(user_id, confirm_text, reply_markup=markup)
-        
-        elif text in ["📝 Name", "📂 Category", "🏷️ Tags", "🌤️ Season", "🎯 Occasion"]:
-            # Store which field to edit
-            field_map = {
-                "📝 Name": "name",
-                "📂 Category": "category", 
-                "🏷️ Tags": "tags",
-                "🌤️ Season": "season",
-                "🎯 Occasion": "occasion"
-            }
-            
-            state.temp_data['editing_field'] = field_map[text]
-            state.waiting_for = "edit_value"
-            
-            if text == "📂 Category":
-                markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-                categories = ["tops", "bottoms", "dresses", "outerwear", "shoes", "accessories"]
-                buttons = [types.KeyboardButton(cat.title()) for cat in categories]
-                markup.add(*buttons)
-                bot.send_message(user_id, "📂 Choose the category:", reply_markup=markup)
-            elif text == "🌤️ Season":
-                markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-                seasons = ["spring", "summer", "fall", "winter", "all"]
-                buttons = [types.KeyboardButton(season.title()) for season in seasons]
-                markup.add(*buttons)
-                bot.send_message(user_id, "🌤️ Choose the season:", reply_markup=markup)
-            elif text == "🎯 Occasion":
-                markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-                occasions = ["casual", "formal", "business", "party", "sport"]
-                buttons = [types.KeyboardButton(occasion.title()) for occasion in occasions]
-                markup.add(*buttons)
-                bot.send_message(user_id, "🎯 Choose the occasion:", reply_markup=markup)
-            else:
-                bot.send_message(user_id, f"Enter the new {field_map[text].lower()}:")
-    
-    elif state.state == "waiting_for_outfit_request":
-        # Generate outfit based on request
-        user_clothes = db.get_user_clothes(user_id)
-        
-        bot.send_message(user_id, "🎨 Creating your outfit... Please wait!")
-        
-        outfit = ai_service.generate_outfit(user_clothes, text, None)
-        
-        if outfit and outfit.get("selected_items"):
-            outfit_text = "🎨 Your Outfit:\n\n"
-            
-            outfit_text += "👕 Items to wear:\n"
-            for item in outfit['selected_items']:
-                outfit_text += f"  • {item}\n"
-            
-            if outfit.get('styling_tips'):
-                outfit_text += "\n💡 Styling Tips:\n"
-                for tip in outfit['styling_tips']:
-                    outfit_text += f"  • {tip}\n"
-            
-            markup = types.InlineKeyboardMarkup()
-            btn1 = types.InlineKeyboardButton("💾 Save Outfit", callback_data="save_outfit")
-            btn2 = types.InlineKeyboardButton("🔄 New Outfit", callback_data="new_outfit")
-            markup.add(btn1, btn2)
-            
-            bot.send_message(user_id, outfit_text, reply_markup=markup)
-        else:
-            bot.send_message(user_id, "❌ Sorry, I couldn't create an outfit with your request. Try a different description!")
-        
-        # Reset state
-        state.state = "idle"
-        state.waiting_for = None
-    
-    elif state.state == "bulk_descriptions":
-        if text == "Done":
-            if not state.temp_data['descriptions']:
-                bot.send_message(user_id, "❌ No descriptions added. Please add some descriptions first.")
-                return
-            
-            # Store the count before processing
-            descriptions_count = len(state.temp_data['descriptions'])
-            
-            # Process all descriptions
-            bot.send_message(user_id, f"🔍 Processing {descriptions_count} items... Please wait!")
-            
-            success_count = 0
-            added_items = []  # Track successfully added items
-            
-            for description in state.temp_data['descriptions']:
-                analysis = ai_service.analyze_text_description(description)
-                if analysis:
-                    item_id = db.add_clothing_item(
-                        user_id=user_id,
-                        name=analysis['name'],
-                        category=analysis['category'],
-                        description=description,
-                        photo_file_id=None,
-                        photo_path=None,
-                        tags=analysis['tags']
-                    )
-                    if item_id:
-                        success_count += 1
-                        added_items.append(analysis['name'])
-            
-            # Reset state
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            # Show main menu
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            # Create the result message with item list
-            if added_items:
-                result_message = f"✅ Successfully added {success_count} out of {descriptions_count} items to your wardrobe!\n\n"
-                result_message += "📋 You added:\n"
-                for i, item_name in enumerate(added_items, 1):
-                    result_message += f"{i}. {item_name}\n"
-            else:
-                result_message = f"❌ Failed to add any items. Please try again with better descriptions."
-            
-            bot.send_message(user_id, result_message, reply_markup=markup)
-        
-        elif text == "❌ Cancel":
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, "❌ Bulk upload cancelled.", reply_markup=markup)
-        
-        else:
-            # Add description to bulk list
-            current_count = len(state.temp_data['descriptions'])
-            max_descriptions = state.temp_data['max_descriptions']
-            
-            if current_count >= max_descriptions:
-                bot.send_message(user_id, f"❌ Maximum {max_descriptions} descriptions reached! Type 'Done' to process them.")
-                return
-            
-            state.temp_data['descriptions'].append(text)
-            new_count = len(state.temp_data['descriptions'])
-            bot.send_message(user_id, f"✍️ Description {new_count} added! ({new_count}/{max_descriptions})\n\nSend more descriptions or type 'Done' when finished.")
+@router.state_button("editing_existing_item", "❌ Cancel Edit")
+def cancel_existing_edit_handler(message, state):
+    """Stop editing a wardrobe item"""
+    state.reset()
     
-    elif state.state == "bulk_photos":
-        if text == "Done":
-            if not state.temp_data['photos']:
-                bot.send_message(user_id, "❌ No photos added. Please add some photos first.")
-                return
-            
-            # Store the count before processing
-            photo_count = len(state.temp_data['photos'])
-            
-            # Process all photos
-            bot.send_message(user_id, f"🔍 Processing {photo_count} photos... Please wait!")
-            
-            success_count = 0
-            added_items = []  # Track successfully added items
-            
-            for i, photo_data in enumerate(state.temp_data['photos'], 1):
-                analysis = ai_service.analyze_photo(photo_data['path'])
-                if analysis:
-                    item_id = db.add_clothing_item(
-                        user_id=user_id,
-                        name=analysis['name'],
-                        category=analysis['category'],
-                        description=f"{analysis['name']} - {analysis['category']}",
-                        photo_file_id=photo_data['file_id'],
-                        photo_path=photo_data['path'],
-                        tags=analysis['tags']
-                    )
-                    if item_id:
-                        success_count += 1
-                        added_items.append(analysis['name'])
-            
-            # Reset state
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            # Show main menu
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            # Create the result message with item list
-            if added_items:
-                result_message = f"✅ Successfully added {success_count} out of {photo_count} items to your wardrobe!\n\n"
-                result_message += "📋 You added:\n"
-                for i, item_name in enumerate(added_items, 1):
-                    result_message += f"{i}. {item_name}\n"
-            else:
-                result_message = f"❌ Failed to add any items. Please try again with clearer photos."
-            
-            bot.send_message(user_id, result_message, reply_markup=markup)
-        
-        elif text == "❌ Cancel":
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, "❌ Bulk upload cancelled.", reply_markup=markup)
+    bot.send_message(message.from_user.id, "❌ Edit cancelled.", reply_markup=keyboards.MAIN_MENU)
+
+EXISTING_ITEM_FIELDS = {
+    "📝 Name": "name",
+    "📂 Category": "category", 
+    "🏷️ Tags": "tags",
+    "📄 Description": "description",
+    "🌤️ Season": "season",
+    "🎯 Occasion": "occasion"
+}
+
+@router.state_button("editing_existing_item", *EXISTING_ITEM_FIELDS)
+def choose_existing_field_handler(message, state):
+    """Ask for a new value of the chosen wardrobe item field"""
+    user_id = message.from_user.id
+    text = message.text
     
-    elif state.state == "editing_existing_item":
-        # Handle editing existing wardrobe items
-        if text == "❌ Cancel Edit":
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, "❌ Edit cancelled.", reply_markup=markup)
-        
-        elif text in ["📝 Name", "📂 Category", "🏷️ Tags", "📄 Description"]:
-            # Store which field to edit
-            field_map = {
-                "📝 Name": "name",
-                "📂 Category": "category", 
-                "🏷️ Tags": "tags",
-                "📄 Description": "description"
-            }
-            
-            state.temp_data['editing_field'] = field_map[text]
-            state.waiting_for = "edit_existing_value"
-            
-            if text == "📂 Category":
-                markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-                categories = ["tops", "bottoms", "dresses", "outerwear", "shoes", "accessories"]
-                buttons = [types.KeyboardButton(cat.title()) for cat in categories]
-                markup.add(*buttons)
-                bot.send_message(user_id, "📂 Choose the category:", reply_markup=markup)
-            else:
-                bot.send_message(user_id, f"Enter the new {field_map[text].lower()}:")
-        
-        elif state.waiting_for == "edit_existing_value":
-            # Update the existing item
-            field = state.temp_data['editing_field']
-            item_id = state.temp_data['editing_item_id']
-            
-            if field == "tags":
-                # Handle tags as a list
-                new_value = [tag.strip() for tag in text.split(',')]
-            else:
-                new_value = text.lower() if field in ['category', 'season', 'occasion'] else text
-            
-            # Update in database
-            success = db.update_clothing_item(user_id, item_id, field, new_value)
-            
-            if success:
-                bot.send_message(user_id, f"✅ Updated {field} successfully!")
-            else:
-                bot.send_message(user_id, f"❌ Failed to update {field}. Please try again.")
-            
-            # Reset state
-            state.state = "idle"
-            state.temp_data = {}
-            state.waiting_for = None
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            btn1 = types.KeyboardButton("📸 Add Photo")
-            btn2 = types.KeyboardButton("✍️ Add Description")
-            btn3 = types.KeyboardButton("📦 Bulk Upload")
-            btn4 = types.KeyboardButton("🎨 Create Outfit")
-            btn5 = types.KeyboardButton("📚 My Wardrobe")
-            btn6 = types.KeyboardButton("💡 Suggestions")
-            btn7 = types.KeyboardButton("❓ Help")
-            markup.add(btn1, btn2, btn3, btn4, btn5, btn6, btn7)
-            
-            bot.send_message(user_id, "What would you like to do next?", reply_markup=markup)
+    # Store which field to edit
+    state.temp_data['editing_field'] = EXISTING_ITEM_FIELDS[text]
+    state.waiting_for = "edit_existing_value"
     
+    if text == "📂 Category":
+        bot.send_message(user_id, "📂 Choose the category:", reply_markup=keyboards.CATEGORY_CHOICES)
+    elif text == "🌤️ Season":
+        bot.send_message(user_id, "🌤️ Choose the season:", reply_markup=keyboards.SEASON_CHOICES)
+    elif text == "🎯 Occasion":
+        bot.send_message(user_id, "🎯 Choose the occasion:", reply_markup=keyboards.OCCASION_CHOICES)
     else:
-        # Default response for unrecognized commands
-        bot.send_message(user_id, 
-                        "I didn't understand that. Please use the menu buttons or type /help for assistance!")
+        bot.send_message(user_id, f"Enter the new {EXISTING_ITEM_FIELDS[text].lower()}:")
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_handler(call):
-    """Handle callback queries"""
-    user_id = call.from_user.id
-    state = get_user_state(user_id)
+@router.state("editing_existing_item", waiting_for="edit_existing_value")
+def existing_value_handler(message, state):
+    """Update a field of a wardrobe item"""
+    user_id = message.from_user.id
+    text = message.text
+    field = state.temp_data['editing_field']
+    item_id = state.temp_data['editing_item_id']
     
-    if call.data == "save_outfit":
-        bot.answer_callback_query(call.id, "Outfit saved! ✅")
+    if field == "tags":
+        # Handle tags as a list
+        new_value = [tag.strip() for tag in text.split(',')]
+    else:
+        new_value = text.lower() if field in ['category', 'season', 'occasion'] else text
+    
+    # Update in database
+    success = db.update_clothing_item(user_id, item_id, field, new_value)
+    
+    if success:
+        bot.send_message(user_id, f"✅ Updated {field} successfully!")
+    else:
+        bot.send_message(user_id, f"❌ Failed to update {field}. Please try again.")
+    
+    # Reset state
+    state.reset()
+    
+    bot.send_message(user_id, "What would you like to do next?", reply_markup=keyboards.MAIN_MENU)
+
+@router.fallback
+def unknown_text_handler(message, state):
+    """Default response for unrecognized commands"""
+    bot.send_message(message.from_user.id, 
+                    "I didn't understand that. Please use the menu buttons or type /help for assistance!")
+
+@bot.message_handler(func=lambda message: True)
+def handle_text(message):
+    """Handle all text messages"""
+    router.dispatch_message(message, get_user_state(message.from_user.id))
+
+@router.callback("save_outfit")
+def save_outfit_callback(call, state):
+    """Handle save outfit button"""
+    outfit = state.pending_outfits.pop(call.message.message_id, None)
+    if not outfit:
+        bot.answer_callback_query(call.id, "This outfit can't be saved anymore. Create a new one! 🔄")
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        return
     
-    elif call.data == "new_outfit":
-        bot.answer_callback_query(call.id, "Creating new outfit...")
+    # None of the generated item names matched the wardrobe, so there'd be nothing to show later
+    if not outfit['clothes_ids']:
+        bot.answer_callback_query(call.id, "None of these items are in your wardrobe, so the outfit can't be saved. ❌")
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        
-        # Ask for new outfit request
-        state.state = "waiting_for_outfit_request"
-        state.waiting_for = "outfit_request"
-        
-        bot.send_message(user_id, 
-                        "🎨 What kind of outfit would you like me to create?\n\n"
-                        "Examples:\n"
-                        "• 'Casual weekend look'\n"
-                        "• 'Professional office outfit'\n"
-                        "• 'Evening party ensemble'\n"
-                        "• 'Comfortable weekend look'")
-    
-    elif call.data.startswith("edit_item_"):
-        # Handle editing existing item
-        item_id = int(call.data.split("_")[2])
-        
-        # Get item details
-        item = db.get_clothing_item(user_id, item_id)
-        if not item:
-            bot.answer_callback_query(call.id, "Item not found!")
-            return
-        
-        # Store item info in state
-        state.state = "editing_existing_item"
-        state.temp_data['editing_item_id'] = item_id
-        state.temp_data['current_item'] = item
-        
-        # Show item details and edit options
-        item_text = f"""
+        return
+    
+    db.save_outfit(call.from_user.id, outfit['name'], outfit['description'], outfit['clothes_ids'])
+    
+    bot.answer_callback_query(call.id, "Outfit saved! ✅")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+
+@router.callback("new_outfit")
+def new_outfit_callback(call, state):
+    """Handle new outfit button"""
+    bot.answer_callback_query(call.id, "Creating new outfit...")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    
+    # Ask for new outfit request
+    ask_for_outfit_request(call.from_user.id, state)
+
+@router.callback("more_suggestions")
+def more_suggestions_callback(call, state):
+    """Handle more suggestions button"""
+    bot.answer_callback_query(call.id, "Generating more suggestions...")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    
+    send_suggestions(call.from_user.id, more=True)
+
+@router.callback("create_from_suggestion")
+def create_from_suggestion_callback(call, state):
+    """Handle create outfit button under suggestions"""
+    bot.answer_callback_query(call.id)
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    
+    ask_for_outfit_request(call.from_user.id, state)
+
+@router.callback("add_duplicate")
+def add_duplicate_callback(call, state):
+    """Add a photo that matched a saved item after all"""
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    photo_data = state.temp_data.pop('duplicate_photo', None)
+    if not photo_data or state.state not in ("waiting_for_photo", "bulk_photos"):
+        if photo_data:
+            discard_photo(photo_data)
+        bot.answer_callback_query(call.id, "This photo can't be added anymore. Please send it again.")
+        return
+    
+    bot.answer_callback_query(call.id)
+    accept_photo(call.from_user.id, state, photo_data)
+
+@router.callback("skip_duplicate")
+def skip_duplicate_callback(call, state):
+    """Leave out a photo that matched a saved item"""
+    photo_data = state.temp_data.pop('duplicate_photo', None)
+    if photo_data:
+        discard_photo(photo_data)
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    bot.answer_callback_query(call.id, "Skipped! ✅")
+
+@router.callback_prefix("edit_item")
+def edit_item_callback(call, state, item_id):
+    """Start editing an existing wardrobe item"""
+    user_id = call.from_user.id
+    item_id = int(item_id)
+    
+    # Get item details
+    item = db.get_clothing_item(user_id, item_id)
+    if not item:
+        bot.answer_callback_query(call.id, "Item not found!")
+        return
+    
+    # Store item info in state
+    state.state = "editing_existing_item"
+    state.temp_data['editing_item_id'] = item_id
+    state.temp_data['current_item'] = item
+    
+    # Show item details and edit options
+    item_text = f"""
 📋 Item Details (ID: {item_id}):
 
 • Name: {item['name']}
 • Category: {item['category']}
 • Description: {item['description']}
 • Tags: {', '.join(item['tags']) if item['tags'] else 'None'}
+• Season: {item['season'] or 'Not set'}
+• Occasion: {item['occasion'] or 'Not set'}
 
 What would you like to edit?
 """
-        
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        btn1 = types.KeyboardButton("📝 Name")
-        btn2 = types.KeyboardButton("📂 Category")
-        btn3 = types.KeyboardButton("🏷️ Tags")
-        btn4 = types.KeyboardButton("📄 Description")
-        btn5 = types.KeyboardButton("❌ Cancel Edit")
-        markup.add(btn1, btn2, btn3, btn4, btn5)
-        
-        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        bot.send_message(user_id, item_text, reply_markup=markup)
     
-    elif call.data.startswith("delete_item_"):
-        # Handle deleting existing item
-        item_id = int(call.data.split("_")[2])
-        
-        # Delete the item
-        success, message_text = db.delete_clothing_item(user_id, item_id)
-        
-        if success:
-            bot.answer_callback_query(call.id, "Item deleted! ✅")
-            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-            bot.send_message(user_id, f"✅ {message_text}")
-        else:
-            bot.answer_callback_query(call.id, "Failed to delete! ❌")
-            bot.send_message(user_id, f"❌ {message_text}")
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    bot.send_message(user_id, item_text, reply_markup=keyboards.EDIT_EXISTING_ITEM_FIELDS)
+
+@router.callback_prefix("delete_item")
+def delete_item_callback(call, state, item_id):
+    """Delete an existing wardrobe item"""
+    user_id = call.from_user.id
+    item_id = int(item_id)
     
-    elif call.data == "cancel_delete":
-        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        bot.answer_callback_query(call.id, "Delete cancelled!")
+    # Delete the item
+    success, message_text = db.delete_clothing_item(user_id, item_id)
     
-    elif call.data == "close_wardrobe":
+    if success:
+        collage_renderer.remove_thumbnail(item_id)
+        db.delete_collage_file_ids(collage_renderer.stale_keys(db.get_collage_keys(f"{user_id}:"), item_id))
+        bot.answer_callback_query(call.id, "Item deleted! ✅")
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
-        bot.answer_callback_query(call.id, "Wardrobe closed!")
+        bot.send_message(user_id, f"✅ {message_text}")
+    else:
+        bot.answer_callback_query(call.id, "Failed to delete! ❌")
+        bot.send_message(user_id, f"❌ {message_text}")
 
-@bot.message_handler(func=lambda message: message.text == "✏️ Edit Wardrobe")
-def edit_wardrobe_handler(message):
-    """Handle edit wardrobe button"""
-    user_id = message.from_user.id
-    state = get_user_state(user_id)
-    
-    # Get user's clothes
-    clothes = db.get_user_clothes(user_id)
-    
-    if not clothes:
-        bot.send_message(user_id, "📚 Your wardrobe is empty! Add some clothes first.")
-        return
-    
-    # Show clothes with edit options
-    wardrobe_text = "📚 Your Wardrobe - Click to edit:\n\n"
-    
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    
-    for item in clothes:
-        btn_text = f"✏️ {item['name']} (ID: {item['id']})"
-        callback_data = f"edit_item_{item['id']}"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=callback_data))
-    
-    markup.add(types.InlineKeyboardButton("❌ Close", callback_data="close_wardrobe"))
-    
-    bot.send_message(user_id, wardrobe_text, reply_markup=markup)
+@router.callback("cancel_delete")
+def cancel_delete_callback(call, state):
+    """Handle cancel delete button"""
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    bot.answer_callback_query(call.id, "Delete cancelled!")
+
+@router.callback("close_wardrobe")
+def close_wardrobe_callback(call, state):
+    """Handle close wardrobe button"""
+    bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    bot.answer_callback_query(call.id, "Wardrobe closed!")
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_handler(call):
+    """Handle callback queries"""
+    router.dispatch_callback(call, get_user_state(call.from_user.id))
 
 if __name__ == "__main__":
     print("🤖 Outfitify Bot is starting...")
     print("📱 Bot is running. Press Ctrl+C to stop.")
     
+    if METRICS_PORT:
+        metrics.instrument_telegram(telebot.apihelper)
+        metrics.start_http_server(METRICS_PORT, METRICS_HOST, routes={"/healthz": health_check})
+        print(f"📊 Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics, health at /healthz")
+    
+    if tracer.enabled:
+        tracing.instrument_telegram(telebot.apihelper)
+        print(f"🔎 Tracing {tracer.sample_rate:.0%} of updates")
+    
+    # Build the lazy services in the background so polling starts right away
+    threading.Thread(target=lambda: (db.get(), ai_service.client), name="warm-up", daemon=True).start()
+    
+    usage_tracker.start()
+    scheduler.start()
     try:
         bot.polling(none_stop=True)
     except KeyboardInterrupt:
         print("\n🛑 Bot stopped by user")
     except Exception as e:
-        print(f"❌ Error: {e}") 
\ No newline at end of file
+        print(f"❌ Error: {e}")
+    finally:
+        scheduler.stop()
+        usage_tracker.stop()
+        tracer.flush()
\ No newline at end of file
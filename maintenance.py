@@ -0,0 +1,137 @@
+"""
+Storage maintenance: outfit archival, collage cache pruning, incremental vacuum and planner statistics
+
+The bot runs this every MAINTENANCE_INTERVAL seconds. Switching shards
+made before incremental auto-vacuum over to it rewrites each file, so do
+large ones from here with the bot stopped.
+
+Usage:
+    python maintenance.py status
+    python maintenance.py run
+    python maintenance.py convert
+"""
+
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import (OUTFIT_ARCHIVE_DAYS, ARCHIVE_BATCH_SIZE, VACUUM_STEP_PAGES, MAINTENANCE_MAX_STEPS,
+                    MAINTENANCE_STEP_PAUSE, MAINTENANCE_CACHE_KB, MAINTENANCE_CONVERT_MAX_SIZE, OPTIMIZE_ANALYSIS_LIMIT,
+                    COLLAGE_CACHE_DAYS, COLLAGE_CACHE_MAX_ENTRIES)
+
+class Maintenance:
+    """Keeps the shard files small and their hot B-trees lean
+    
+    Each run drops old and surplus collage file IDs from the catalog, then
+    per shard: moves outfits older than `archive_days` to outfits_archive,
+    hands free pages back to the filesystem with incremental vacuum, and
+    refreshes the planner statistics. Work is done
+    in short transactions with a pause in between, and at most `max_steps`
+    of each kind per shard, so a run never holds a shard's write lock for
+    long; whatever is left over is picked up by the next run.
+    """
+    
+    def __init__(self, db, archive_days=OUTFIT_ARCHIVE_DAYS, archive_batch=ARCHIVE_BATCH_SIZE,
+                 vacuum_pages=VACUUM_STEP_PAGES, max_steps=MAINTENANCE_MAX_STEPS, pause=MAINTENANCE_STEP_PAUSE,
+                 convert_max_size=MAINTENANCE_CONVERT_MAX_SIZE):
+        self.db = db
+        self.archive_days = archive_days
+        self.archive_batch = archive_batch
+        self.vacuum_pages = vacuum_pages
+        self.max_steps = max_steps
+        self.pause = pause
+        self.convert_max_size = convert_max_size
+        self.last = None  # summary of the last run
+    
+    def archive_cutoff(self, days=None):
+        """Outfits created before this are archived (CURRENT_TIMESTAMP format, UTC)"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.archive_days if days is None else days)
+        return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+    
+    def archive(self, shard_id):
+        """Archive old outfits on a shard in batches; returns how many were moved"""
+        if not self.archive_days:
+            return 0
+        before = self.archive_cutoff()
+        archived = 0
+        for _ in range(self.max_steps):
+            # A user being moved while a batch runs could end up with an outfit in both tables
+            with self.db.pause_moves():
+                moved = self.db.archive_outfits(shard_id, before, self.archive_batch)
+            archived += moved
+            if moved < self.archive_batch:
+                break
+            time.sleep(self.pause)
+        return archived
+    
+    def vacuum(self, shard_id):
+        """Reclaim a shard's free pages a step at a time; returns how many were handed back"""
+        info = self.db.storage_info(shard_id)
+        if not info['incremental']:
+            if info['pages'] * info['page_size'] > self.convert_max_size:
+                return 0
+            # Small enough that the one-off rewrite only holds writers up briefly
+            self.db.enable_incremental_vacuum(shard_id)
+            print(f"Shard {shard_id} switched to incremental auto-vacuum")
+            return info['free_pages']
+        
+        freed = 0
+        for _ in range(self.max_steps):
+            pages = self.db.incremental_vacuum(shard_id, self.vacuum_pages, MAINTENANCE_CACHE_KB)
+            freed += pages
+            if pages < self.vacuum_pages:
+                break
+            time.sleep(self.pause)
+        return freed
+    
+    def run(self):
+        """Scheduled job: archive, vacuum and optimize every shard"""
+        start = time.perf_counter()
+        # Telegram keeps sent files, but rows for collages nobody asks for anymore only grow the catalog
+        pruned = self.db.prune_collage_cache(self.archive_cutoff(COLLAGE_CACHE_DAYS), COLLAGE_CACHE_MAX_ENTRIES)
+        archived = freed = 0
+        for shard_id in range(self.db.shard_count):
+            archived += self.archive(shard_id)
+            freed += self.vacuum(shard_id)
+            self.db.optimize(shard_id, OPTIMIZE_ANALYSIS_LIMIT, MAINTENANCE_CACHE_KB)
+        
+        self.last = {
+            "at": time.time(),
+            "seconds": time.perf_counter() - start,
+            "archived_outfits": archived,
+            "pruned_collages": pruned,
+            "freed_pages": freed,
+            "free_pages": sum(self.db.storage_info(shard_id)['free_pages'] for shard_id in range(self.db.shard_count))
+        }
+        return self.last
+
+def status(db):
+    for shard_id in range(db.shard_count):
+        info = db.storage_info(shard_id)
+        print(f"  #{shard_id}: {info['pages'] * info['page_size'] / (1024 * 1024):.1f}MB, "
+              f"{info['free_pages']} free pages, "
+              + ("incremental auto-vacuum" if info['incremental'] else "needs `python maintenance.py convert`"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old outfits and compact the database shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="File size and free pages per shard")
+    commands.add_parser("run", help="Run one maintenance pass now")
+    commands.add_parser("convert", help="Switch every shard to incremental auto-vacuum (stop the bot first)")
+    args = parser.parse_args()
+    
+    from database import Database
+    db = Database()
+    if args.command == "run":
+        summary = Maintenance(db).run()
+        print(f"✅ Archived {summary['archived_outfits']} outfits and freed {summary['freed_pages']} pages "
+              f"in {summary['seconds']:.1f}s")
+    elif args.command == "convert":
+        for shard_id in range(db.shard_count):
+            if not db.storage_info(shard_id)['incremental']:
+                db.enable_incremental_vacuum(shard_id)
+                print(f"✅ Shard {shard_id} converted")
+    status(db)
+
+if __name__ == "__main__":
+    main()
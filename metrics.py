@@ -0,0 +1,348 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+    
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in values]
+
+class Counter(_Metric):
+    """Monotonically increasing count, one series per label combination"""
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+    
+    def total(self):
+        """Sum over every label combination"""
+        with self._lock:
+            return sum(self._values.values())
+    
+    def totals(self, *labelnames):
+        """Sums grouped by the given labels, keyed by their values"""
+        positions = [self.labelnames.index(name) for name in labelnames]
+        with self._lock:
+            values = list(self._values.items())
+        totals = {}
+        for key, value in values:
+            group = tuple(key[position] for position in positions)
+            totals[group] = totals.get(group, 0) + value
+        return totals
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+    kind = "gauge"
+    
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def set_function(self, function, **labels):
+        """Report function() as the value on every scrape"""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+    
+    def _samples(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception as e:
+                print(f"Error reading gauge {self.name}: {e}")
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super()._samples()
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    kind = "histogram"
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def count(self, **labels):
+        series = self._values.get(self._key(labels))
+        return series[2] if series else 0
+    
+    def totals(self):
+        """(bucket counts, sum, count) over every label combination"""
+        bucket_counts = [0] * len(self.buckets)
+        total = 0.0
+        count = 0
+        with self._lock:
+            for series in self._values.values():
+                for i, bucket_count in enumerate(series[0]):
+                    bucket_counts[i] += bucket_count
+                total += series[1]
+                count += series[2]
+        return bucket_counts, total, count
+    
+    def quantile(self, q, bucket_counts=None):
+        """Estimate a quantile by interpolating inside the bucket it falls in"""
+        if bucket_counts is None:
+            bucket_counts = self.totals()[0]
+        count = sum(bucket_counts)
+        if not count:
+            return None
+        
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound if bound != float("inf") else lower
+        return lower
+    
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(series[0]), series[1], series[2])) for key, series in self._values.items())
+        
+        lines = []
+        for key, (bucket_counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    """Holds every metric and renders them in the Prometheus text format"""
+    
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class RateWindow:
+    """Rates of cumulative values over a trailing window, from periodic samples
+    
+    `read` returns a tuple of monotonically increasing values; sample() must be
+    called regularly (from a scheduled job) and deltas() compares the current
+    values with the oldest sample still inside the window.
+    """
+    
+    def __init__(self, read, window=300):
+        self.read = read
+        self.window = window
+        self._samples = deque()
+        self._lock = threading.Lock()
+    
+    def sample(self):
+        now = time.monotonic()
+        values = self.read()
+        with self._lock:
+            self._samples.append((now, values))
+            while len(self._samples) > 1 and self._samples[1][0] <= now - self.window:
+                self._samples.popleft()
+    
+    def deltas(self):
+        """(seconds, value increases) since the oldest sample, or (0, None) before the first sample"""
+        with self._lock:
+            if not self._samples:
+                return 0, None
+            start, start_values = self._samples[0]
+        values = self.read()
+        return time.monotonic() - start, tuple(value - previous for value, previous in zip(values, start_values))
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    "outfitify_handler_seconds", "Time spent in bot handlers", ["route"])
+
+AI_REQUEST_SECONDS = REGISTRY.histogram(
+    "outfitify_ai_request_seconds", "OpenAI chat completion latency", ["method", "model"])
+AI_REQUEST_ERRORS = REGISTRY.counter(
+    "outfitify_ai_request_errors_total", "Failed OpenAI chat completions", ["method", "model"])
+AI_TOKENS = REGISTRY.counter(
+    "outfitify_ai_tokens_total", "OpenAI tokens used", ["method", "model", "kind"])
+AI_QUOTA_REJECTIONS = REGISTRY.counter(
+    "outfitify_ai_quota_rejections_total", "AI calls refused before reaching OpenAI", ["reason"])
+AI_RETRIES = REGISTRY.counter(
+    "outfitify_ai_retries_total", "OpenAI requests retried after a retryable failure", ["method"])
+AI_HEDGES = REGISTRY.counter(
+    "outfitify_ai_hedged_requests_total", "Duplicate OpenAI requests sent for slow calls", ["method"])
+AI_FALLBACKS = REGISTRY.counter(
+    "outfitify_ai_fallbacks_total", "AI calls answered from the fallback cache", ["method", "reason"])
+CIRCUIT_STATE = REGISTRY.gauge(
+    "outfitify_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ["upstream"])
+CONCURRENCY_LIMIT = REGISTRY.gauge(
+    "outfitify_concurrency_limit", "Current adaptive concurrency limit", ["upstream"])
+
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "outfitify_db_query_seconds", "Database method latency", ["method"])
+DB_ERRORS = REGISTRY.counter(
+    "outfitify_db_errors_total", "Database methods that raised", ["method"])
+
+CACHE_REQUESTS = REGISTRY.counter(
+    "outfitify_cache_requests_total", "Cache lookups by result (hit or miss)", ["cache", "result"])
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "outfitify_queue_depth", "Items waiting in internal queues", ["queue"])
+ACTIVE_USERS = REGISTRY.gauge(
+    "outfitify_active_users", "Users with conversation state in memory")
+
+TELEGRAM_API_ERRORS = REGISTRY.counter(
+    "outfitify_telegram_api_errors_total", "Failed Telegram Bot API calls", ["method", "error_code"])
+
+def cache_result(cache, hit):
+    """Count one lookup of a named cache"""
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+def instrument_telegram(apihelper):
+    """Count failed Bot API requests by method and Telegram error code"""
+    make_request = apihelper._make_request
+    
+    def counted_request(token, method_name, *args, **kwargs):
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            TELEGRAM_API_ERRORS.inc(method=method_name, error_code=e.error_code)
+            raise
+        except Exception:
+            TELEGRAM_API_ERRORS.inc(method=method_name, error_code="network")
+            raise
+    
+    apihelper._make_request = counted_request
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY, routes=None):
+    """Serve /metrics from a background thread, returning the server
+    
+    `routes` maps further paths to functions returning (status, content type, body).
+    """
+    handlers = {"/metrics": lambda: (200, "text/plain; version=0.0.4; charset=utf-8", registry.render())}
+    handlers.update(routes or {})
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            handler = handlers.get(self.path.split("?")[0])
+            if handler is None:
+                self.send_error(404)
+                return
+            
+            try:
+                status, content_type, body = handler()
+            except Exception as e:
+                print(f"Error serving {self.path}: {e}")
+                self.send_error(500)
+                return
+            
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
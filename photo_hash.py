@@ -0,0 +1,179 @@
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from config import DUPLICATE_MAX_DISTANCE, PHOTO_HASH_CACHE_SIZE
+import metrics
+
+def dhash(path, size=8):
+    """64-bit difference hash of a photo: which of each pair of neighbouring pixels is brighter
+    
+    Survives re-compression, resizing and small crops, so a garment sent
+    again (even as a new Telegram file) hashes within a few bits of the first.
+    """
+    with Image.open(path) as image:
+        # Let the JPEG decoder downscale while decoding, which is much cheaper than a full decode
+        image.draft("L", (size * 8, size * 8))
+        image = ImageOps.exif_transpose(image).convert("L").resize((size + 1, size), Image.BILINEAR)
+        pixels = list(image.getdata())
+    
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """Metric tree over 64-bit hashes for 'everything within distance d' lookups
+    
+    Each child edge is labelled with its distance to the parent, so a search
+    only descends into edges within d of the query's own distance to the node
+    (triangle inequality). Removed hashes are tombstoned and dropped on the
+    next rebuild.
+    """
+    
+    def __init__(self):
+        self.root = None  # [hash, item_ids, {distance: child}]
+        self.size = 0
+        self.removed = 0
+    
+    def add(self, value, item_id):
+        node = self.root
+        if node is None:
+            self.root = [value, {item_id}, {}]
+            self.size += 1
+            return
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].add(item_id)
+                self.size += 1
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {item_id}, {}]
+                self.size += 1
+                return
+            node = child
+    
+    def remove(self, value, item_id):
+        node = self.root
+        while node is not None:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                if item_id in node[1]:
+                    node[1].discard(item_id)
+                    self.size -= 1
+                    self.removed += 1
+                return
+            node = node[2].get(distance)
+    
+    def search(self, value, max_distance):
+        """(distance, item_id) for every stored hash within max_distance, closest first"""
+        matches = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, item_id) for item_id in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        matches.sort()
+        return matches
+    
+    def items(self):
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            for item_id in node[1]:
+                yield node[0], item_id
+            stack.extend(node[2].values())
+
+class PhotoIndex:
+    """Per-user BK-trees of photo hashes, kept up to date through Database change hooks"""
+    
+    def __init__(self, db, max_distance=DUPLICATE_MAX_DISTANCE, cache_size=PHOTO_HASH_CACHE_SIZE):
+        self.db = db
+        self.max_distance = max_distance
+        self.cache_size = cache_size
+        self._trees = OrderedDict()  # user_id -> (tree, {item_id: hash})
+        self._lock = threading.Lock()
+    
+    def cached_trees(self):
+        """Number of user trees held in memory"""
+        return len(self._trees)
+    
+    def _load(self, user_id):
+        """Build the user's tree, hashing (and saving) photos stored before hashes existed"""
+        tree = BKTree()
+        hashes = {}
+        for item_id, photo_path, photo_hash in self.db.get_photo_hashes(user_id):
+            if photo_hash is None:
+                try:
+                    photo_hash = dhash(photo_path)
+                except OSError:
+                    continue
+                self.db.set_photo_hash(user_id, item_id, photo_hash)
+            tree.add(photo_hash, item_id)
+            hashes[item_id] = photo_hash
+        return tree, hashes
+    
+    def _get(self, user_id):
+        with self._lock:
+            cached = self._trees.get(user_id)
+            if cached:
+                self._trees.move_to_end(user_id)
+                metrics.cache_result("photo_hash", True)
+                return cached
+        
+        metrics.cache_result("photo_hash", False)
+        loaded = self._load(user_id)
+        with self._lock:
+            cached = self._trees.setdefault(user_id, loaded)
+            self._trees.move_to_end(user_id)
+            while len(self._trees) > self.cache_size:
+                self._trees.popitem(last=False)
+        return cached
+    
+    def find_duplicate(self, user_id, photo_hash):
+        """The ID of the user's item whose photo is closest to the hash, if within max_distance"""
+        tree, _ = self._get(user_id)
+        with self._lock:
+            matches = tree.search(photo_hash, self.max_distance)
+        return matches[0][1] if matches else None
+    
+    def on_change(self, user_id, action, item_id):
+        """Database change hook: add or drop the changed item's hash in the user's cached tree"""
+        with self._lock:
+            if action == "reload":
+                self._trees.pop(user_id, None)
+                return
+            cached = self._trees.get(user_id)
+        if cached is None or action == "update":
+            return
+        
+        tree, hashes = cached
+        photo_hash = None
+        if action == "add":
+            item = self.db.get_clothing_item(user_id, item_id)
+            photo_hash = item.get("photo_hash") if item else None
+        
+        with self._lock:
+            if action == "delete" and item_id in hashes:
+                tree.remove(hashes.pop(item_id), item_id)
+                if tree.removed > tree.size:
+                    rebuilt = BKTree()
+                    for value, remaining_id in tree.items():
+                        rebuilt.add(value, remaining_id)
+                    self._trees[user_id] = (rebuilt, hashes)
+            elif photo_hash is not None:
+                tree.add(photo_hash, item_id)
+                hashes[item_id] = photo_hash
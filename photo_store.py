@@ -0,0 +1,116 @@
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from telebot import apihelper
+
+from config import MAX_PHOTO_SIZE, PHOTOS_DIR, PHOTO_DOWNLOAD_CHUNK_SIZE, PHOTO_DOWNLOAD_TIMEOUT
+
+class PhotoStore:
+    def __init__(self, token, photos_dir=PHOTOS_DIR):
+        self.token = token
+        self.photos_dir = photos_dir
+        
+        # Disk usage from the last scan plus the downloads since
+        self.photo_count = 0
+        self.photo_bytes = 0
+        self.scanned_at = None
+        self._usage_lock = threading.Lock()
+    
+    def scan(self):
+        """Recount the photos on disk, picking up files removed since the last scan"""
+        count = 0
+        size = 0
+        try:
+            with os.scandir(self.photos_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.endswith(".part"):
+                        count += 1
+                        size += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        
+        with self._usage_lock:
+            self.photo_count = count
+            self.photo_bytes = size
+            self.scanned_at = time.time()
+    
+    def usage(self):
+        """Photo count and bytes on disk, without touching the filesystem"""
+        with self._usage_lock:
+            return {"photos": self.photo_count, "bytes": self.photo_bytes, "scanned_at": self.scanned_at}
+    
+    def is_too_large(self, file_size):
+        """Check a reported Telegram file size against MAX_PHOTO_SIZE"""
+        return bool(file_size) and file_size > MAX_PHOTO_SIZE
+    
+    def build_path(self, user_id, file_id):
+        """Build the local path a photo is stored under"""
+        return os.path.join(self.photos_dir, f"{user_id}_{int(time.time())}_{file_id}.jpg")
+    
+    def file_url(self, file_path):
+        """Build the download URL for a Telegram file path"""
+        if apihelper.FILE_URL is None:
+            return "https://api.telegram.org/file/bot{0}/{1}".format(self.token, file_path)
+        return apihelper.FILE_URL.format(self.token, file_path)
+    
+    def download(self, file_path, destination, file_size=None):
+        """Stream a Telegram photo to disk in chunks and move it into place atomically
+        
+        Returns (success, error_message).
+        """
+        if self.is_too_large(file_size):
+            return False, "Photo is larger than the maximum allowed size"
+        
+        replaced = os.path.exists(destination)
+        success, error, received = self.fetch(file_path, destination, MAX_PHOTO_SIZE)
+        if success:
+            with self._usage_lock:
+                self.photo_count += 0 if replaced else 1
+                self.photo_bytes += received
+        return success, error
+    
+    def fetch(self, file_path, destination, max_size):
+        """Stream any Telegram file of up to max_size bytes to disk and move it into place atomically
+        
+        Returns (success, error_message, bytes_received).
+        """
+        directory = os.path.dirname(destination) or "."
+        os.makedirs(directory, exist_ok=True)
+        
+        # Write next to the destination so the final rename stays on one filesystem
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        try:
+            with requests.get(self.file_url(file_path), stream=True,
+                              proxies=apihelper.proxy, timeout=PHOTO_DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    return False, f"Download failed with status {response.status_code}", 0
+                
+                if int(response.headers.get('Content-Length') or 0) > max_size:
+                    return False, "File is larger than the maximum allowed size", 0
+                
+                received = 0
+                with os.fdopen(fd, 'wb') as temp_file:
+                    fd = None
+                    for chunk in response.iter_content(chunk_size=PHOTO_DOWNLOAD_CHUNK_SIZE):
+                        received += len(chunk)
+                        # Content-Length can be missing, so enforce the limit while streaming too
+                        if received > max_size:
+                            return False, "File is larger than the maximum allowed size", 0
+                        temp_file.write(chunk)
+            
+            os.replace(temp_path, destination)
+            temp_path = None
+            return True, None, received
+        
+        except (requests.RequestException, OSError) as e:
+            print(f"Error downloading file: {e}")
+            return False, "Download failed", 0
+        
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
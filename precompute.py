@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from config import PRECOMPUTE_HOURS, PRECOMPUTE_ACTIVE_DAYS, PRECOMPUTE_BATCH, PRECOMPUTE_CACHE_SIZE
+import metrics
+
+def parse_hours(text):
+    """'1-6' -> (1, 6): the hours from 1:00 up to 6:00; '22-4' wraps past midnight"""
+    start, end = (int(hour) % 24 for hour in text.split("-"))
+    return start, end
+
+class Precomputer:
+    """AI results worked out ahead of time for active users, during off-peak hours
+    
+    `producers` maps a name to producer(user_id, clothes, version), which returns the
+    value to keep or None when it couldn't be made. Values are kept per user
+    and name with the wardrobe version and day they were made for, so any
+    wardrobe change or a new day makes them stale and they are recomputed in
+    the next off-peak window. Until then, callers fall back to a live AI call.
+    """
+    
+    def __init__(self, db, producers, is_idle=lambda: True, hours=PRECOMPUTE_HOURS,
+                 active_days=PRECOMPUTE_ACTIVE_DAYS, batch=PRECOMPUTE_BATCH, cache_size=PRECOMPUTE_CACHE_SIZE):
+        self.db = db
+        self.producers = producers
+        self.is_idle = is_idle
+        self.hours = parse_hours(hours) if hours else None
+        self.active_days = active_days
+        self.batch = batch
+        self.cache_size = cache_size
+        self._entries = OrderedDict()  # (user_id, name) -> {"version", "day", "value", "served"}
+        self._lock = threading.Lock()
+    
+    def cached_entries(self):
+        """Number of precomputed values held in memory"""
+        return len(self._entries)
+    
+    def in_off_peak(self, now=None):
+        if self.hours is None:
+            return False
+        hour = (now or datetime.now()).hour
+        start, end = self.hours
+        return start <= hour < end if start <= end else hour >= start or hour < end
+    
+    def _fresh(self, user_id, name, version=None):
+        """The entry if it was made for the current wardrobe version and day (called with the lock held)"""
+        entry = self._entries.get((user_id, name))
+        if entry is None:
+            return None
+        if version is None:
+            version = self.db.get_wardrobe_version(user_id)
+        if entry["version"] != version or entry["day"] != date.today().isoformat():
+            return None
+        return entry
+    
+    def get(self, user_id, name):
+        """The precomputed value, or None on a miss"""
+        version = self.db.get_wardrobe_version(user_id)
+        with self._lock:
+            entry = self._fresh(user_id, name, version)
+        metrics.cache_result("precomputed", entry is not None)
+        return entry["value"] if entry else None
+    
+    def take(self, user_id, name, count):
+        """The next `count` entries of a precomputed list not served yet, or None once it's used up"""
+        version = self.db.get_wardrobe_version(user_id)
+        with self._lock:
+            entry = self._fresh(user_id, name, version)
+            taken = None
+            if entry and entry["served"] < len(entry["value"]):
+                taken = entry["value"][entry["served"]:entry["served"] + count]
+                entry["served"] += len(taken)
+        metrics.cache_result("precomputed", taken is not None)
+        return taken
+    
+    def put(self, user_id, name, value, version):
+        """Keep a value made for a wardrobe version, e.g. a live answer to a miss"""
+        with self._lock:
+            self._entries[(user_id, name)] = {"version": version, "day": date.today().isoformat(),
+                                              "value": value, "served": 0}
+            self._entries.move_to_end((user_id, name))
+            while len(self._entries) > self.cache_size:
+                self._entries.popitem(last=False)
+    
+    def refresh(self, user_id):
+        """Produce every value that's missing or stale for the user
+        
+        Returns how many were made, or None when there was nothing to do.
+        """
+        version = self.db.get_wardrobe_version(user_id)
+        with self._lock:
+            stale = [name for name in self.producers if self._fresh(user_id, name, version) is None]
+        if not stale:
+            return None
+        
+        clothes = self.db.get_user_clothes(user_id)
+        if not clothes:
+            return None
+        
+        made = 0
+        for name in stale:
+            value = self.producers[name](user_id, clothes, version)
+            if value is None:
+                continue
+            self.put(user_id, name, value, version)
+            made += 1
+        return made
+    
+    def run(self):
+        """Scheduled job: refresh up to `batch` active users, only off-peak and while the bot is idle"""
+        if not self.in_off_peak() or not self.is_idle():
+            return
+        
+        since = (date.today() - timedelta(days=self.active_days)).isoformat()
+        attempted = 0
+        for user_id in self.db.get_active_users(since):
+            # Live traffic always wins; pick up where we left off next run
+            if attempted >= self.batch or not self.is_idle():
+                break
+            if self.refresh(user_id) is not None:
+                attempted += 1
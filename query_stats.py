@@ -0,0 +1,170 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from config import SLOW_QUERY_MS, SLOW_QUERY_LOG_SIZE
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_sql(sql):
+    """Collapse whitespace so the same statement always has the same key"""
+    return _WHITESPACE.sub(" ", sql).strip()
+
+class StatementStats:
+    __slots__ = ("count", "total_seconds", "max_seconds", "rows")
+    
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+
+class QueryStats:
+    """Per-statement timing for SQLite, collected through a connection factory
+    
+    Connections opened with `connection_factory` time every execute plus the
+    fetches that follow it, and record the result once the cursor moves on or
+    the connection closes. Statements slower than `slow_threshold_ms` are
+    logged with their EXPLAIN QUERY PLAN and kept in `slow_queries`.
+    """
+    
+    def __init__(self, slow_threshold_ms=SLOW_QUERY_MS, slow_log_size=SLOW_QUERY_LOG_SIZE):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.statements = {}
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+        self.connection_factory = self._make_connection_class()
+    
+    def _make_connection_class(self):
+        stats = self
+        
+        class TimedCursor(sqlite3.Cursor):
+            _pending = None
+            
+            def _begin(self, sql, params, method, *args):
+                self._finish()
+                start = time.perf_counter()
+                try:
+                    return method(self, sql, *args)
+                finally:
+                    self._pending = [sql, params, time.perf_counter() - start, max(self.rowcount, 0)]
+            
+            def execute(self, sql, parameters=()):
+                return self._begin(sql, parameters, sqlite3.Cursor.execute, parameters)
+            
+            def executemany(self, sql, seq_of_parameters):
+                seq_of_parameters = list(seq_of_parameters)
+                first = seq_of_parameters[0] if seq_of_parameters else ()
+                return self._begin(sql, first, sqlite3.Cursor.executemany, seq_of_parameters)
+            
+            def _fetched(self, method, *args):
+                start = time.perf_counter()
+                result = method(self, *args)
+                if self._pending is not None:
+                    self._pending[2] += time.perf_counter() - start
+                    if isinstance(result, list):
+                        self._pending[3] += len(result)
+                    elif result is not None:
+                        self._pending[3] += 1
+                return result
+            
+            def fetchone(self):
+                return self._fetched(sqlite3.Cursor.fetchone)
+            
+            def fetchall(self):
+                return self._fetched(sqlite3.Cursor.fetchall)
+            
+            def fetchmany(self, size=None):
+                return self._fetched(sqlite3.Cursor.fetchmany, size or self.arraysize)
+            
+            def _finish(self):
+                if self._pending is not None:
+                    pending, self._pending = self._pending, None
+                    stats.record(self.connection, *pending)
+            
+            def close(self):
+                self._finish()
+                super().close()
+        
+        class TimedConnection(sqlite3.Connection):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self._cursors = []
+            
+            def cursor(self, factory=TimedCursor):
+                cursor = super().cursor(factory)
+                self._cursors.append(cursor)
+                return cursor
+            
+            def execute(self, sql, parameters=()):
+                return self.cursor().execute(sql, parameters)
+            
+            def executemany(self, sql, seq_of_parameters):
+                return self.cursor().executemany(sql, seq_of_parameters)
+            
+            def close(self):
+                for cursor in self._cursors:
+                    cursor._finish()
+                self._cursors = []
+                super().close()
+        
+        return TimedConnection
+    
+    def record(self, connection, sql, params, seconds, rows):
+        """Add one finished statement to the stats, logging it if slow"""
+        key = normalize_sql(sql)
+        with self._lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                statement = self.statements[key] = StatementStats()
+            statement.count += 1
+            statement.total_seconds += seconds
+            statement.rows += rows
+            if seconds > statement.max_seconds:
+                statement.max_seconds = seconds
+        
+        if seconds >= self.slow_threshold and not key.upper().startswith("EXPLAIN"):
+            plan = self.explain(connection, sql, params)
+            self.slow_queries.append({
+                "sql": key,
+                "ms": seconds * 1000,
+                "rows": rows,
+                "plan": plan,
+                "at": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+            print(f"🐢 Slow query ({seconds * 1000:.1f}ms, {rows} rows): {key}")
+            if plan:
+                print(f"    plan: {' | '.join(plan)}")
+    
+    @staticmethod
+    def explain(connection, sql, params=None):
+        """EXPLAIN QUERY PLAN lines for a statement, using NULLs when no parameters are given"""
+        if params is None or (not params and "?" in sql):
+            params = (None,) * sql.count("?")
+        try:
+            rows = sqlite3.Connection.execute(connection, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except sqlite3.Error as e:
+            return [f"(no plan: {e})"]
+        return [row[-1] for row in rows]
+    
+    def snapshot(self):
+        """Statement stats as dicts, most total time first"""
+        with self._lock:
+            items = [(sql, statement.count, statement.total_seconds, statement.max_seconds, statement.rows)
+                     for sql, statement in self.statements.items()]
+        items.sort(key=lambda item: item[2], reverse=True)
+        return [{
+            "sql": sql,
+            "count": count,
+            "total_ms": total * 1000,
+            "avg_ms": total * 1000 / count,
+            "max_ms": maximum * 1000,
+            "rows": rows
+        } for sql, count, total, maximum, rows in items]
+    
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+        self.slow_queries.clear()
@@ -0,0 +1,228 @@
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from config import (AI_MAX_RETRIES, AI_RETRY_BASE_DELAY, AI_RETRY_MAX_DELAY, AI_BREAKER_FAILURES,
+                    AI_BREAKER_RESET, AI_CONCURRENCY_INITIAL, AI_CONCURRENCY_MIN, AI_CONCURRENCY_MAX,
+                    AI_CONCURRENCY_WAIT, AI_LATENCY_TARGET, AI_HEDGE_AFTER)
+import metrics
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+class ConcurrencyLimitError(Exception):
+    """Raised when no concurrency slot frees up in time"""
+
+def is_retryable(error):
+    """Whether a failed call is worth retrying: timeouts, connection errors, 429 and 5xx responses"""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # openai's APITimeoutError subclasses APIConnectionError; matched by name so openai isn't imported here
+    return any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__)
+
+def retry_delay(error, attempt, base=AI_RETRY_BASE_DELAY, cap=AI_RETRY_MAX_DELAY):
+    """Seconds to wait before the next attempt: Retry-After if the server sent one, else full-jitter backoff"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing, probing it again after a cool-down
+    
+    Closed, calls go through until `failure_threshold` fail in a row. Open,
+    calls are refused for `reset_timeout` seconds. Half-open, a single probe
+    goes through: success closes the circuit, failure opens it again.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold=AI_BREAKER_FAILURES, reset_timeout=AI_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """Whether a call may go through now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+    
+    def cancel_probe(self):
+        """Let another call probe, after an allowed call never reached the upstream"""
+        with self._lock:
+            self._probing = False
+    
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"⚡ Circuit opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class AdaptiveLimit:
+    """AIMD concurrency limit
+    
+    Every call that finishes under `latency_target` raises the limit by
+    1/limit, so roughly by one per limit's worth of calls; an overloaded call
+    (timeout, 429, 5xx, or too slow) halves it, at most once per
+    `latency_target` so one burst of failures counts once.
+    """
+    
+    def __init__(self, initial=AI_CONCURRENCY_INITIAL, minimum=AI_CONCURRENCY_MIN, maximum=AI_CONCURRENCY_MAX,
+                 latency_target=AI_LATENCY_TARGET, backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+    
+    def acquire(self, timeout=AI_CONCURRENCY_WAIT):
+        """Take a slot, waiting up to `timeout` seconds, or raise ConcurrencyLimitError"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                raise ConcurrencyLimitError(f"{self.in_flight} AI calls already in flight")
+            self.in_flight += 1
+    
+    def try_acquire(self):
+        """Take a slot only if one is free right now"""
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+    
+    def release(self, seconds=None, overloaded=False):
+        """Give a slot back, adjusting the limit from how the call went (no adjustment if seconds is None)"""
+        with self._condition:
+            self.in_flight -= 1
+            if seconds is not None:
+                now = time.monotonic()
+                if overloaded or seconds > self.latency_target:
+                    if now - self._last_decrease >= self.latency_target:
+                        self.limit = max(self.minimum, self.limit * self.backoff)
+                        self._last_decrease = now
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+class ResilientCaller:
+    """Retries, circuit breaking, adaptive concurrency and hedging around calls to one upstream
+    
+    `function(timeout)` makes one request. Retryable failures are retried up
+    to `max_retries` times with jittered backoff. With `hedge_after` set, a
+    call still running after that many seconds gets a duplicate request and
+    the first success wins; the hedge needs a free concurrency slot.
+    """
+    
+    def __init__(self, name="openai", max_retries=AI_MAX_RETRIES, hedge_after=AI_HEDGE_AFTER,
+                 breaker=None, limit=None):
+        self.name = name
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.limit = limit or AdaptiveLimit()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        
+        states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        metrics.CIRCUIT_STATE.set_function(lambda: states[self.breaker.state], upstream=name)
+        metrics.CONCURRENCY_LIMIT.set_function(lambda: int(self.limit.limit), upstream=name)
+    
+    def call(self, function, timeout, method=None, hedge=True):
+        """Call function(timeout) through the resilience layer, returning its result or raising its last error"""
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            try:
+                self.limit.acquire()
+            except ConcurrencyLimitError:
+                self.breaker.cancel_probe()
+                raise
+            
+            start = time.monotonic()
+            try:
+                result = self._attempt(function, timeout, method, hedge)
+            except Exception as e:
+                retryable = is_retryable(e)
+                self.limit.release(time.monotonic() - start, overloaded=retryable)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    # The upstream answered, it just didn't like the request
+                    self.breaker.record_success()
+                if not retryable or attempt == self.max_retries:
+                    raise
+                metrics.AI_RETRIES.inc(method=method)
+                time.sleep(retry_delay(e, attempt))
+                continue
+            
+            self.limit.release(time.monotonic() - start)
+            self.breaker.record_success()
+            return result
+    
+    def _submit(self, function, timeout):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=2 * AI_CONCURRENCY_MAX, thread_name_prefix="ai-hedge")
+        # Each request runs in its own copy of the caller's context so trace spans still nest
+        return self._pool.submit(contextvars.copy_context().run, function, timeout)
+    
+    def _attempt(self, function, timeout, method, hedge):
+        if not hedge or not self.hedge_after:
+            return function(timeout)
+        
+        first = self._submit(function, timeout)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done or not self.limit.try_acquire():
+            return first.result()
+        
+        metrics.AI_HEDGES.inc(method=method)
+        second = self._submit(function, timeout)
+        second.add_done_callback(lambda future: self.limit.release())
+        
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
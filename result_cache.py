@@ -0,0 +1,101 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from config import RESULT_CACHE_SIZE, RESULT_CACHE_VARIANTS
+import metrics
+
+_SPACES = re.compile(r"\s+")
+
+# Item fields that go into the AI prompts; anything else can change without changing the answer
+FINGERPRINT_FIELDS = ("id", "name", "category", "description", "tags", "season", "occasion")
+
+def normalize_request(text):
+    """'  Casual   weekend look! ' -> 'casual weekend look'"""
+    return _SPACES.sub(" ", (text or "").lower()).strip().strip(".!?")
+
+def wardrobe_fingerprint(clothes):
+    """Hash of what the AI sees of a wardrobe, independent of item order"""
+    items = sorted(([item.get(field) for field in FINGERPRINT_FIELDS] for item in clothes), key=lambda row: row[0])
+    return hashlib.sha1(json.dumps(items, default=str).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """Recent AI answers per (user, method, wardrobe content, request, preferences)
+    
+    Each key keeps up to `variants` answers. Asking again shows the current one;
+    "more" moves on to the next stored answer and only asks the AI for a new
+    one once every stored answer has been shown and there is room for another.
+    A user's entries are dropped as soon as their wardrobe changes.
+    """
+    
+    def __init__(self, cache_size=RESULT_CACHE_SIZE, variants=RESULT_CACHE_VARIANTS):
+        self.cache_size = cache_size
+        self.variants = variants
+        self._entries = OrderedDict()  # key -> {"variants": [...], "current": index}
+        self._user_keys = {}  # user_id -> keys, for dropping them on a wardrobe change
+        self._lock = threading.Lock()
+    
+    def cached_entries(self):
+        """Number of keys with stored answers"""
+        return len(self._entries)
+    
+    def key(self, user_id, method, clothes, request=None, preferences=None):
+        return (user_id, method, wardrobe_fingerprint(clothes), normalize_request(request),
+                json.dumps(preferences, sort_keys=True, default=str))
+    
+    def get(self, key):
+        """The answer shown last for the key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+        metrics.cache_result("ai_result", entry is not None)
+        return entry["variants"][entry["current"]] if entry else None
+    
+    def rotate(self, key):
+        """The next stored answer, or None when a new one should be generated (and add()ed)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            value = None
+            if entry and (entry["current"] + 1 < len(entry["variants"]) or len(entry["variants"]) >= self.variants):
+                entry["current"] = (entry["current"] + 1) % len(entry["variants"])
+                value = entry["variants"][entry["current"]]
+                self._entries.move_to_end(key)
+        metrics.cache_result("ai_result", value is not None)
+        return value
+    
+    def add(self, key, value):
+        """Store a new answer for the key and make it the current one"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {"variants": [], "current": 0}
+                self._user_keys.setdefault(key[0], set()).add(key)
+            if value in entry["variants"]:
+                entry["current"] = entry["variants"].index(value)
+            else:
+                if len(entry["variants"]) >= self.variants:
+                    entry["variants"].pop(0)
+                entry["variants"].append(value)
+                entry["current"] = len(entry["variants"]) - 1
+            self._entries.move_to_end(key)
+            
+            while len(self._entries) > self.cache_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget_key(evicted)
+    
+    def _forget_key(self, key):
+        """Drop an evicted key from its user's index (called with the lock held)"""
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+    
+    def on_change(self, user_id, action, item_id):
+        """Database change hook: answers about the old wardrobe can't be shown anymore"""
+        with self._lock:
+            for key in self._user_keys.pop(user_id, ()):
+                self._entries.pop(key, None)
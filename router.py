@@ -0,0 +1,158 @@
+import functools
+import time
+
+from tracing import tracer
+
+ANY = object()  # Matches any waiting_for value
+
+class Router:
+    """Dictionary-based dispatch of text messages and callback queries
+    
+    Text messages are matched in this order, each step a single dict lookup:
+    global buttons, buttons scoped to (state, waiting_for), then handlers for
+    (state, waiting_for) with ANY as the wildcard. Messages in a state that has
+    routes but no match are ignored; messages in any other state go to the
+    fallback handler.
+    """
+    
+    def __init__(self):
+        self.buttons = {}
+        self.state_buttons = {}
+        self.states = {}
+        self.callbacks = {}
+        self.callback_prefixes = {}
+        self.known_states = set()
+        self.fallback_handler = None
+        self.error_handlers = {}
+        self.timing_hooks = []
+    
+    def button(self, *texts):
+        """Register a handler(message, state) for buttons available in every state"""
+        def decorator(handler):
+            for text in texts:
+                self.buttons[text] = handler
+            return handler
+        return decorator
+    
+    def state_button(self, states, *texts, waiting_for=ANY):
+        """Register a handler(message, state) for buttons within one or more states"""
+        if isinstance(states, str):
+            states = (states,)
+        
+        def decorator(handler):
+            for state in states:
+                self.known_states.add(state)
+                for text in texts:
+                    self.state_buttons[(state, waiting_for, text)] = handler
+            return handler
+        return decorator
+    
+    def state(self, states, waiting_for=ANY):
+        """Register a handler(message, state) for free text within one or more states"""
+        if isinstance(states, str):
+            states = (states,)
+        
+        def decorator(handler):
+            for state in states:
+                self.known_states.add(state)
+                self.states[(state, waiting_for)] = handler
+            return handler
+        return decorator
+    
+    def callback(self, *data):
+        """Register a handler(call, state) for exact callback data"""
+        def decorator(handler):
+            for value in data:
+                self.callbacks[value] = handler
+            return handler
+        return decorator
+    
+    def callback_prefix(self, prefix):
+        """Register a handler(call, state, argument) for callback data like '<prefix>_<argument>'"""
+        def decorator(handler):
+            self.callback_prefixes[prefix] = handler
+            return handler
+        return decorator
+    
+    def fallback(self, handler):
+        """Register the handler(message, state) for text no route matches"""
+        self.fallback_handler = handler
+        return handler
+    
+    def error(self, *exception_types):
+        """Register a handler(update, error) for exceptions a routed handler lets escape"""
+        def decorator(handler):
+            for exception_type in exception_types:
+                self.error_handlers[exception_type] = handler
+            return handler
+        return decorator
+    
+    def wrap(self, handler):
+        """Give a handler registered directly with telebot the router's timing and error handling"""
+        @functools.wraps(handler)
+        def wrapper(*args):
+            return self._run(handler, *args)
+        return wrapper
+    
+    def add_timing_hook(self, hook):
+        """Call hook(route_name, seconds) after every dispatched handler"""
+        self.timing_hooks.append(hook)
+    
+    def resolve_message(self, text, state):
+        """Find the handler for a text message, or None to ignore it"""
+        handler = self.buttons.get(text)
+        if handler:
+            return handler
+        
+        handler = (self.state_buttons.get((state.state, state.waiting_for, text))
+                   or self.state_buttons.get((state.state, ANY, text))
+                   or self.states.get((state.state, state.waiting_for))
+                   or self.states.get((state.state, ANY)))
+        if handler:
+            return handler
+        
+        if state.state in self.known_states:
+            return None
+        return self.fallback_handler
+    
+    def dispatch_message(self, message, state):
+        """Route a text message to its handler"""
+        handler = self.resolve_message(message.text, state)
+        if handler:
+            self._run(handler, message, state)
+    
+    def dispatch_callback(self, call, state):
+        """Route a callback query to its handler"""
+        handler = self.callbacks.get(call.data)
+        if handler:
+            self._run(handler, call, state)
+            return
+        
+        prefix, _, argument = (call.data or "").rpartition("_")
+        handler = self.callback_prefixes.get(prefix)
+        if handler:
+            self._run(handler, call, state, argument)
+    
+    def _run(self, handler, *args):
+        if not tracer.enabled:
+            return self._call(handler, *args)
+        
+        # Each routed update is the root of one trace
+        user = getattr(args[0], "from_user", None)
+        with tracer.trace(f"handler.{handler.__name__}", user_id=getattr(user, "id", None)):
+            return self._call(handler, *args)
+    
+    def _call(self, handler, *args):
+        start = time.perf_counter() if self.timing_hooks else None
+        try:
+            return handler(*args)
+        except tuple(self.error_handlers) as e:
+            for exception_type in type(e).__mro__:
+                error_handler = self.error_handlers.get(exception_type)
+                if error_handler:
+                    return error_handler(args[0], e)
+        finally:
+            if start is not None:
+                elapsed = time.perf_counter() - start
+                for hook in self.timing_hooks:
+                    hook(handler.__name__, elapsed)
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import metrics
+
+class Job:
+    __slots__ = ("name", "interval", "function", "next_run", "last_run", "last_seconds", "last_error", "runs")
+    
+    def __init__(self, name, interval, function, next_run):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.next_run = next_run
+        self.last_run = None
+        self.last_seconds = None
+        self.last_error = None
+        self.runs = 0
+
+class Scheduler:
+    """Runs periodic background jobs one at a time on a single thread
+    
+    Jobs that are due while another job runs wait their turn; how many are
+    waiting is the scheduler's queue depth.
+    """
+    
+    def __init__(self):
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        
+        metrics.QUEUE_DEPTH.set_function(self.pending, queue="scheduler")
+    
+    def every(self, interval, name, function, run_now=False):
+        """Run function() every `interval` seconds, first right away if run_now"""
+        first_run = time.monotonic() + (0 if run_now else interval)
+        with self._lock:
+            self._jobs.append(Job(name, interval, function, first_run))
+        self._wakeup.set()
+    
+    def start(self):
+        """Start the scheduler thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the scheduler thread after the running job finishes"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                job = min(self._jobs, key=lambda job: job.next_run, default=None)
+            delay = None if job is None else job.next_run - time.monotonic()
+            if delay is None or delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+            self._run_job(job)
+    
+    def _run_job(self, job):
+        start = time.monotonic()
+        try:
+            job.function()
+            job.last_error = None
+        except Exception as e:
+            job.last_error = f"{type(e).__name__}: {e}"
+            print(f"Error in scheduled job {job.name}: {e}")
+        finally:
+            job.last_run = time.time()
+            job.last_seconds = time.monotonic() - start
+            job.runs += 1
+            job.next_run = max(job.next_run + job.interval, time.monotonic())
+    
+    def pending(self):
+        """Number of jobs that are due and haven't finished yet"""
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for job in self._jobs if job.next_run <= now)
+    
+    def jobs(self):
+        """Status of every job as dicts"""
+        with self._lock:
+            jobs = list(self._jobs)
+        return [{
+            "name": job.name,
+            "interval": job.interval,
+            "runs": job.runs,
+            "last_run": job.last_run,
+            "last_seconds": job.last_seconds,
+            "last_error": job.last_error
+        } for job in jobs]
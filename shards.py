@@ -0,0 +1,47 @@
+"""
+Inspect and rebalance the database shards
+
+While the bot is running, use the /rebalance admin command instead: the bot
+keeps shard placement in memory and must make the moves itself.
+
+Usage:
+    python shards.py status
+    python shards.py rebalance [--limit N]
+    python shards.py move USER_ID SHARD_ID
+"""
+
+import argparse
+
+from database import Database
+
+def format_size(size):
+    return f"{size / (1024 * 1024):.1f}MB"
+
+def status(db):
+    print(f"🗄️  {db.shard_count} shards, {db.pinned_users()} users waiting to be rebalanced")
+    for shard in db.shard_stats():
+        print(f"  #{shard['shard']}: {shard['users']} users, {shard['items']} items, "
+              f"{format_size(shard['db'])} (+{format_size(shard['wal'])} WAL), {shard['pinned_users']} pinned")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and rebalance the database shards (stop the bot first)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="Users, items and file size per shard")
+    rebalance = commands.add_parser("rebalance", help="Move every pinned user to the shard their ID hashes to")
+    rebalance.add_argument("--limit", type=int, help="Move at most this many users")
+    move = commands.add_parser("move", help="Move one user to a shard")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard_id", type=int)
+    args = parser.parse_args()
+    
+    db = Database()
+    if args.command == "rebalance":
+        moved, failed = db.rebalance(limit=args.limit)
+        print(f"✅ Moved {moved} users" + (f", {failed} failed" if failed else ""))
+    elif args.command == "move":
+        moved = db.move_user(args.user_id, args.shard_id)
+        print(f"✅ Moved user {args.user_id} to shard {args.shard_id}" if moved else "ℹ️  Already on that shard")
+    status(db)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import copy
+import threading
+
+import metrics
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution
+    
+    The first caller for a key runs the function; callers arriving while it is
+    still running wait for it and get a copy of its result (or its exception).
+    Nothing is cached once the call finishes.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+    
+    def in_flight(self):
+        """Number of distinct calls currently running"""
+        return len(self._calls)
+    
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        metrics.cache_result("ai_singleflight", not leader)
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Results like analyses get edited in place later, so never share them
+            return copy.deepcopy(call.result)
+        
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -5,6 +5,10 @@ Test script to verify Outfitify bot setup
 
 import sys
 import os
+import json
+import subprocess
+import tempfile
+import time
 
 def test_imports():
     """Test if all required modules can be imported"""
@@ -45,6 +49,13 @@ def test_imports():
         print(f"❌ Failed to import python-dotenv: {e}")
         return False
     
+    try:
+        import numpy
+        print("✅ NumPy imported successfully")
+    except ImportError as e:
+        print(f"❌ Failed to import NumPy: {e}")
+        return False
+    
     return True
 
 def test_local_modules():
@@ -64,7 +75,7 @@ def test_local_modules():
             print("✅ OpenAI API key is configured")
         else:
             print("⚠️  OpenAI API key needs to be configured")
-            
+    
     except ImportError as e:
         print(f"❌ Failed to import config: {e}")
         return False
@@ -107,6 +118,327 @@ def test_database():
         print(f"❌ Database test failed: {e}")
         return False
 
+def test_sharding():
+    """Test that growing the shard count keeps every wardrobe readable and rebalancing moves them home"""
+    print("\n🔍 Testing database sharding...")
+    
+    try:
+        from database import Database
+        
+        db_path = os.path.join(tempfile.mkdtemp(prefix="outfitify-shards-"), "outfitify.db")
+        single = Database(db_path, shards=1)
+        wardrobes = {}
+        for user_id in range(1, 21):
+            item_ids = [single.add_clothing_item(user_id, f"Item {n}", "tops", "Test item") for n in range(3)]
+            single.save_outfit(user_id, "Test outfit", "", item_ids[:2])
+            wardrobes[user_id] = sorted(item_ids)
+        
+        sharded = Database(db_path, shards=3)
+        if any(sorted(item['id'] for item in sharded.get_user_clothes(user_id)) != item_ids
+               for user_id, item_ids in wardrobes.items()):
+            print("❌ Wardrobes went missing after adding shards")
+            return False
+        print(f"✅ Wardrobes readable after adding shards ({sharded.pinned_users()} users pinned)")
+        
+        moved, failed = sharded.rebalance()
+        shards = sharded.shard_stats()
+        if failed or sharded.pinned_users() or sum(shard['items'] for shard in shards) != 60:
+            print(f"❌ Rebalance moved {moved}, failed {failed}, left {sharded.pinned_users()} pinned")
+            return False
+        if any(sorted(item['id'] for item in sharded.get_user_clothes(user_id)) != item_ids
+               or len(sharded.get_user_outfits(user_id)) != 1 for user_id, item_ids in wardrobes.items()):
+            print("❌ Rows changed while moving between shards")
+            return False
+        print(f"✅ Rebalanced {moved} users: " + ", ".join(f"#{shard['shard']} {shard['users']} users" for shard in shards))
+        return True
+    except Exception as e:
+        print(f"❌ Sharding test failed: {e}")
+        return False
+
+def test_wardrobe_io():
+    """Test that a wardrobe survives an export and import, and importing it again adds nothing"""
+    print("\n🔍 Testing wardrobe export and import...")
+    
+    try:
+        from database import Database
+        from wardrobe_io import export_wardrobe, import_wardrobe
+        
+        directory = tempfile.mkdtemp(prefix="outfitify-io-")
+        db = Database(os.path.join(directory, "outfitify.db"), shards=2)
+        item_ids = db.add_clothing_items(1, [{'name': f"Item {n}", 'category': "tops", 'description': "Test item",
+                                              'tags': ["test"]} for n in range(1200)])
+        db.save_outfit(1, "Test outfit", "", item_ids[:3])
+        db.update_user_preferences(1, "casual", "blue", "all")
+        
+        export_path = os.path.join(directory, "wardrobe.jsonl")
+        exported = export_wardrobe(db, 1, export_path, batch_size=100)
+        imported = import_wardrobe(db, 2, export_path, chunk_size=100)
+        clothes = db.get_user_clothes(2)
+        outfits = db.get_user_outfits(2)
+        if imported['items'] != 1200 or len(clothes) != 1200 or clothes[0]['tags'] != ["test"]:
+            print(f"❌ Imported {imported['items']} of {exported['items']} items")
+            return False
+        if len(outfits) != 1 or len(json.loads(outfits[0][4])) != 3 or not db.get_user_preferences(2):
+            print("❌ Outfits or preferences were lost in the import")
+            return False
+        print(f"✅ Exported and imported {exported['items']} items and {exported['outfits']} outfits")
+        
+        again = import_wardrobe(db, 2, export_path)
+        if again['items'] or again['duplicates'] != 1200 or len(db.get_user_outfits(2)) != 1:
+            print(f"❌ Importing again added {again['items']} items")
+            return False
+        print("✅ Importing again skipped every existing item")
+        return True
+    except Exception as e:
+        print(f"❌ Wardrobe export/import test failed: {e}")
+        return False
+
+def test_backup():
+    """Test that a snapshot taken while writes continue verifies, and unchanged photos aren't copied again"""
+    print("\n🔍 Testing backups...")
+    
+    try:
+        import threading
+        from PIL import Image
+        from database import Database
+        from backup import BackupManager
+        
+        directory = tempfile.mkdtemp(prefix="outfitify-backup-")
+        photos_dir = os.path.join(directory, "photos")
+        os.makedirs(photos_dir)
+        for n in range(5):
+            Image.new("RGB", (32, 32), (n * 50, 0, 0)).save(os.path.join(photos_dir, f"{n}.jpg"))
+        db = Database(os.path.join(directory, "outfitify.db"), shards=2)
+        db.add_clothing_items(1, [{'name': f"Item {n}", 'category': "tops"} for n in range(2000)])
+        
+        stop = threading.Event()
+        def write():
+            while not stop.is_set():
+                db.add_clothing_item(2, "Shirt", "tops", "Test item")
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            backups = BackupManager(db, os.path.join(directory, "backups"), photos_dir, keep=2)
+            first = backups.snapshot()
+        finally:
+            stop.set()
+            writer.join()
+        
+        problems = backups.verify(deep=True)
+        if problems or first['items'] < 2000 or first['photos_copied'] != 5:
+            print(f"❌ Snapshot didn't verify: {problems or first}")
+            return False
+        print(f"✅ Snapshot of {first['items']} items verified ({first['restarts']} restarts under writes)")
+        
+        backups.snapshot()
+        third = backups.snapshot()
+        if third['photos_copied'] or len(backups.snapshots()) != 2:
+            print(f"❌ Copied {third['photos_copied']} unchanged photos, kept {len(backups.snapshots())} snapshots")
+            return False
+        print("✅ Unchanged photos skipped and old snapshots pruned")
+        return True
+    except Exception as e:
+        print(f"❌ Backup test failed: {e}")
+        return False
+
+def test_maintenance():
+    """Test that old outfits are archived and deleted rows' pages are handed back to the filesystem"""
+    print("\n🔍 Testing storage maintenance...")
+    
+    try:
+        from database import Database
+        from maintenance import Maintenance
+        
+        db = Database(os.path.join(tempfile.mkdtemp(prefix="outfitify-maintenance-"), "outfitify.db"))
+        item_ids = db.add_clothing_items(1, [{'name': f"Item {n}", 'category': "tops", 'description': "Test item " * 50}
+                                             for n in range(2000)])
+        db.save_outfits(1, [{'name': f"Old outfit {n}", 'clothes_ids': item_ids[:3], 'created_at': "2020-01-01 00:00:00"}
+                            for n in range(300)] + [{'name': "New outfit", 'clothes_ids': item_ids[:2]}])
+        for item_id in item_ids[:1500]:
+            db.delete_clothing_item(1, item_id)
+        before = db.storage_info(0)
+        
+        summary = Maintenance(db, archive_days=30, pause=0).run()
+        after = db.storage_info(0)
+        archived = sum(1 for _ in db.iter_outfits(1, archived=True))
+        if summary['archived_outfits'] != 300 or archived != 300 or len(db.get_user_outfits(1)) != 1:
+            print(f"❌ Archived {summary['archived_outfits']} outfits, expected 300")
+            return False
+        if not after['incremental'] or after['free_pages'] or after['pages'] >= before['pages']:
+            print(f"❌ File went from {before['pages']} to {after['pages']} pages, {after['free_pages']} still free")
+            return False
+        print(f"✅ Archived {archived} outfits and shrank the file from {before['pages']} to {after['pages']} pages")
+        return True
+    except Exception as e:
+        print(f"❌ Maintenance test failed: {e}")
+        return False
+
+def test_compatibility():
+    """Test that the incrementally maintained compatibility matrix matches a rebuild"""
+    print("\n🔍 Testing compatibility matrix...")
+    
+    try:
+        import random
+        from compatibility import CompatibilityMatrix
+        
+        def item(item_id, category, season="all", occasion="casual"):
+            return {'id': item_id, 'name': f"Item {item_id}", 'category': category, 'season': season, 'occasion': occasion}
+        
+        # Equal partners: removing the chosen one must fall back to the same one a rebuild picks
+        matrix = CompatibilityMatrix([item(1, "tops"), item(2, "bottoms"), item(3, "bottoms"),
+                                      item(4, "bottoms"), item(5, "shoes")])
+        matrix.remove(2)
+        rebuilt = CompatibilityMatrix([item(1, "tops"), item(3, "bottoms"), item(4, "bottoms"), item(5, "shoes")])
+        if matrix.top_outfits(1) != rebuilt.top_outfits(1):
+            print(f"❌ Tie broken differently after a remove: {matrix.top_outfits(1)} vs {rebuilt.top_outfits(1)}")
+            return False
+        print("✅ Ties between equal partners are broken the same way after a remove")
+        
+        rng = random.Random(7)
+        categories = ["tops", "bottoms", "shoes", "outerwear", "accessories", "dresses"]
+        for trial in range(50):
+            matrix = CompatibilityMatrix()
+            wardrobe = {}
+            for item_id in range(1, 61):
+                if wardrobe and rng.random() < 0.3:
+                    removed = rng.choice(list(wardrobe))
+                    del wardrobe[removed]
+                    matrix.remove(removed)
+                wardrobe[item_id] = item(item_id, rng.choice(categories), rng.choice(["all", "summer", "winter"]),
+                                         rng.choice(["casual", "business", "formal"]))
+                matrix.add(wardrobe[item_id])
+                # Re-adding an item is how an edit is applied
+                if rng.random() < 0.1:
+                    matrix.add(wardrobe[rng.choice(list(wardrobe))])
+            
+            # Built in reverse, so insertion order can't make them agree by accident
+            rebuilt = CompatibilityMatrix(sorted(wardrobe.values(), key=lambda item: -item['id']))
+            if matrix.best != rebuilt.best or matrix.top_outfits(10) != rebuilt.top_outfits(10):
+                print(f"❌ Incremental matrix differs from a rebuild in trial {trial}")
+                return False
+        print("✅ Random adds, edits and removes match a rebuild (50 wardrobes)")
+        return True
+    except Exception as e:
+        print(f"❌ Compatibility test failed: {e}")
+        return False
+
+def test_photo_hash():
+    """Test BK-tree duplicate lookups against a linear scan"""
+    print("\n🔍 Testing photo hash index...")
+    
+    try:
+        import random
+        from photo_hash import BKTree, hamming
+        
+        rng = random.Random(11)
+        stored = {}
+        tree = BKTree()
+        for item_id in range(1, 501):
+            if item_id % 5 == 0:
+                # A near-duplicate of an earlier photo: a few bits flipped
+                value = stored[rng.randrange(1, item_id)]
+                for bit in rng.sample(range(64), rng.randrange(1, 6)):
+                    value ^= 1 << bit
+            else:
+                value = rng.getrandbits(64)
+            stored[item_id] = value
+            tree.add(value, item_id)
+        # The same photo saved twice shares a node
+        stored[501] = stored[1]
+        tree.add(stored[501], 501)
+        
+        def scan(query, max_distance):
+            return sorted((hamming(query, value), item_id) for item_id, value in stored.items()
+                          if hamming(query, value) <= max_distance)
+        
+        queries = [stored[item_id] ^ (1 << rng.randrange(64)) for item_id in rng.sample(sorted(stored), 50)]
+        queries += [rng.getrandbits(64) for _ in range(20)]
+        for max_distance in (0, 2, 6, 12):
+            for query in queries + [stored[1]]:
+                if tree.search(query, max_distance) != scan(query, max_distance):
+                    print(f"❌ Search within {max_distance} bits differs from a linear scan")
+                    return False
+        print("✅ Lookups within 0-12 bits match a linear scan")
+        
+        for item_id in (1, 10, 250):
+            tree.remove(stored[item_id], item_id)
+            del stored[item_id]
+        # Removing something that was never added leaves the tree alone
+        tree.remove(rng.getrandbits(64), 999)
+        if tree.size != len(stored) or sorted(item_id for _, item_id in tree.items()) != sorted(stored):
+            print(f"❌ Tree holds {tree.size} hashes after removals, expected {len(stored)}")
+            return False
+        for query in queries + [stored[501]]:
+            if tree.search(query, 6) != scan(query, 6):
+                print("❌ Removed photos are still found")
+                return False
+        print("✅ Removed photos are no longer found, and a shared hash keeps its other item")
+        return True
+    except Exception as e:
+        print(f"❌ Photo hash test failed: {e}")
+        return False
+
+def test_result_cache():
+    """Test result cache keys, variant rotation, size bound and invalidation"""
+    print("\n🔍 Testing AI result cache...")
+    
+    try:
+        from result_cache import ResultCache
+        
+        cache = ResultCache(cache_size=2, variants=2)
+        clothes = [{'id': 1, 'name': "White shirt", 'category': "tops"},
+                   {'id': 2, 'name': "Blue jeans", 'category': "bottoms"}]
+        key = cache.key(1, "outfit", clothes, "Casual  weekend look!")
+        if key != cache.key(1, "outfit", list(reversed(clothes)), " casual weekend LOOK"):
+            print("❌ Item order or request formatting changes the key")
+            return False
+        if key == cache.key(1, "outfit", clothes[:1], "casual weekend look"):
+            print("❌ A different wardrobe gives the same key")
+            return False
+        print("✅ Keys ignore item order and request formatting but not wardrobe content")
+        
+        if cache.get(key) is not None or cache.rotate(key) is not None:
+            print("❌ An empty cache returned an answer")
+            return False
+        cache.add(key, "v1")
+        if cache.get(key) != "v1" or cache.rotate(key) is not None:
+            print("❌ Rotation should ask for a new answer while there is room for one")
+            return False
+        cache.add(key, "v2")
+        shown = [cache.get(key), cache.rotate(key), cache.rotate(key), cache.rotate(key)]
+        if shown != ["v2", "v1", "v2", "v1"]:
+            print(f"❌ Full entry rotated as {shown}, expected v2, v1, v2, v1")
+            return False
+        cache.add(key, "v3")
+        if cache.get(key) != "v3" or cache.rotate(key) != "v2":
+            print("❌ A new answer should replace the oldest one")
+            return False
+        print("✅ More Suggestions cycles through stored answers once they're all made")
+        
+        other = cache.key(1, "suggestions", clothes)
+        cache.add(other, "s1")
+        cache.get(key)
+        newest = cache.key(2, "suggestions", clothes)
+        cache.add(newest, "s2")
+        if cache.cached_entries() != 2 or cache.get(other) is not None or cache.get(key) != "v2":
+            print("❌ The least recently used key should be evicted past cache_size")
+            return False
+        print("✅ Cache stays within its size, evicting the least recently used key")
+        
+        cache.on_change(1, "add", 3)
+        if cache.get(key) is not None or cache.get(newest) != "s2" or cache.cached_entries() != 1:
+            print("❌ A wardrobe change should drop only that user's answers")
+            return False
+        cache.on_change(2, "delete", 1)
+        if cache.cached_entries() != 0:
+            print("❌ Answers survived a wardrobe change")
+            return False
+        print("✅ A wardrobe change drops only that user's answers")
+        return True
+    except Exception as e:
+        print(f"❌ Result cache test failed: {e}")
+        return False
+
 def test_ai_service():
     """Test AI service functionality"""
     print("\n🔍 Testing AI service...")
@@ -136,6 +468,172 @@ def test_ai_service():
         print(f"❌ AI service test failed: {e}")
         return False
 
+def test_ai_resilience():
+    """Test retries, the circuit breaker and hedging against a local fake OpenAI endpoint"""
+    print("\n🔍 Testing AI resilience...")
+    
+    try:
+        import openai
+        from ai_service import AIService
+        from resilience import ResilientCaller, CircuitBreaker, AdaptiveLimit
+        from benchmarks.fakes import FakeOpenAIServer
+        
+        fake = FakeOpenAIServer().start()
+        try:
+            breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.2)
+            ai = AIService(resilience=ResilientCaller("test", max_retries=2, breaker=breaker, limit=AdaptiveLimit()))
+            ai._client = openai.OpenAI(api_key="sk-test", base_url=f"{fake.url}/v1", max_retries=0)
+            
+            answer = ai.suggest_outfit_improvements("jeans and a tee", [])
+            
+            # Every attempt fails: two retries, then the breaker opens and the cached answer is served
+            fake.error_rate = 1.0
+            fallback = ai.suggest_outfit_improvements("jeans and a tee", [])
+            if fake.requests != 4 or fallback != answer or breaker.state != CircuitBreaker.OPEN:
+                print(f"❌ Expected 3 attempts then the cached answer, got {fake.requests - 1} attempts")
+                return False
+            print("✅ Retries and cached fallback work")
+            
+            ai.suggest_outfit_improvements("a suit", [])
+            if fake.requests != 4:
+                print("❌ Request reached the endpoint while the circuit was open")
+                return False
+            print("✅ Open circuit fails fast")
+            
+            fake.error_rate = 0.0
+            time.sleep(0.25)
+            ai.suggest_outfit_improvements("a suit", [])
+            if breaker.state != CircuitBreaker.CLOSED:
+                print("❌ Circuit did not close after a successful probe")
+                return False
+            print("✅ Circuit closes after a successful probe")
+        finally:
+            fake.stop()
+        
+        # The first request stalls; the hedge sent after 50ms answers instead
+        calls = []
+        def request(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                time.sleep(1)
+                return "slow"
+            return "fast"
+        
+        start = time.perf_counter()
+        result = ResilientCaller("hedge-test", hedge_after=0.05).call(request, 5)
+        if result != "fast" or time.perf_counter() - start > 0.5:
+            print("❌ Hedged request did not win")
+            return False
+        print("✅ Hedged request wins over a slow one")
+        return True
+    except Exception as e:
+        print(f"❌ AI resilience test failed: {e}")
+        return False
+
+def test_prompt_cache():
+    """Test that outfit prompts keep the wardrobe in a stable, cacheable prefix"""
+    print("\n🔍 Testing prompt caching...")
+    
+    try:
+        import openai
+        import random
+        from ai_service import AIService
+        from benchmarks.fakes import FakeOpenAIServer
+        
+        clothes = [{'id': i, 'name': f"Shirt {i}", 'category': "tops", 'description': f"A cotton shirt in shade {i}"}
+                   for i in range(1, 301)]
+        shuffled = random.Random(1).sample(clothes, len(clothes))
+        
+        ai = AIService()
+        text = ai._format_wardrobe(clothes, 7)
+        if ai._format_wardrobe(shuffled, 7) is not text or ai._format_wardrobe(shuffled) != text:
+            print("❌ Wardrobe section depends on item order or isn't memoized")
+            return False
+        print("✅ Wardrobe section is rendered in a canonical order and memoized")
+        
+        fake = FakeOpenAIServer().start()
+        try:
+            ai._client = openai.OpenAI(api_key="sk-test", base_url=f"{fake.url}/v1", max_retries=0)
+            ai.generate_outfit(clothes, "Something for the office", wardrobe_version=7)
+            outfit = ai.generate_outfit(shuffled, "A beach day", wardrobe_version=7)
+            if not outfit.get("selected_items") or fake.cached_tokens < 1024:
+                print(f"❌ Second request reused only {fake.cached_tokens} cached prompt tokens")
+                return False
+        finally:
+            fake.stop()
+        print(f"✅ A different request reuses {fake.cached_tokens} cached prompt tokens")
+        
+        # An item added between reading the clothes and rendering them must show up in the next prompt
+        from database import Database
+        from precompute import Precomputer
+        db = Database(os.path.join(tempfile.mkdtemp(prefix="outfitify-prompt-"), "outfitify.db"))
+        db.add_clothing_item(1, "Grey wool coat", "outerwear", "Test item")
+        read_clothes = db.get_user_clothes
+        def get_user_clothes_then_add(user_id):
+            clothes = read_clothes(user_id)
+            db.get_user_clothes = read_clothes
+            db.add_clothing_item(user_id, "Red silk scarf", "accessories", "Test item")
+            return clothes
+        db.get_user_clothes = get_user_clothes_then_add
+        
+        prompts = Precomputer(db, {"wardrobe": lambda user_id, clothes, version: ai._format_wardrobe(clothes, version)},
+                              hours=None)
+        prompts.refresh(1)
+        if "Red silk scarf" not in ai._format_wardrobe(db.get_user_clothes(1), db.get_wardrobe_version(1)):
+            print("❌ Wardrobe text read before a change was cached under the new version")
+            return False
+        print("✅ A change between the reads doesn't leave stale wardrobe text behind")
+        return True
+    except Exception as e:
+        print(f"❌ Prompt cache test failed: {e}")
+        return False
+
+def test_startup_imports():
+    """Test that importing main stays fast and defers the heavy services"""
+    print("\n🔍 Testing startup import time...")
+    
+    # A fresh interpreter, so modules already imported by other tests don't hide the cost
+    workdir = tempfile.mkdtemp(prefix="outfitify-startup-")
+    db_path = os.path.join(workdir, "outfitify.db")
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE_PATH=db_path, OPENAI_API_KEY="sk-startup-check",
+               TELEGRAM_TOKEN="123456:STARTUP", PYTHONPATH=repo_dir)
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import main\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))\n"
+    )
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=workdir, env=env,
+                            capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        print(f"❌ Importing main failed: {result.stderr.strip()[-500:]}")
+        return False
+    
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"ℹ️  import main took {report['seconds'] * 1000:.0f}ms")
+    
+    # -X importtime lines: "import time: self | cumulative | name"
+    slowest = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            slowest.append((int(parts[1]), parts[2].strip()))
+    for cumulative, name in sorted(slowest, reverse=True)[:3]:
+        print(f"   {cumulative / 1000:7.1f}ms  {name.strip()}")
+    
+    ok = True
+    for module in ("openai", "httpx", "pydantic", "numpy"):
+        if module in report['modules']:
+            print(f"❌ {module} is imported at startup; it should load on first use")
+            ok = False
+    if os.path.exists(db_path):
+        print("❌ The database is opened at import time; it should open on first use")
+        ok = False
+    if ok:
+        print("✅ Heavy services are deferred until first use")
+    return ok
+
 def test_environment():
     """Test environment setup"""
     print("\n🔍 Testing environment...")
@@ -171,7 +669,17 @@ def main():
         test_imports,
         test_local_modules,
         test_database,
+        test_sharding,
+        test_wardrobe_io,
+        test_backup,
+        test_maintenance,
+        test_compatibility,
+        test_photo_hash,
+        test_result_cache,
         test_ai_service,
+        test_ai_resilience,
+        test_prompt_cache,
+        test_startup_imports,
         test_environment
     ]
     
@@ -0,0 +1,246 @@
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from config import TRACE_SAMPLE_RATE, TRACE_FILE, TRACE_OTLP_ENDPOINT, TRACE_BATCH_SIZE, TRACE_FLUSH_INTERVAL
+
+# The span new spans attach to; None outside sampled traces
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+    
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+    
+    def set(self, key, value):
+        """Attach an attribute to the span"""
+        self.attributes[key] = value
+    
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+class _NoopSpan:
+    """Stands in for a span when the current update isn't sampled"""
+    __slots__ = ()
+    
+    def set(self, key, value):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+class JsonlExporter:
+    """Appends finished spans to a JSON Lines file"""
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def export(self, spans):
+        with open(self.path, "a", encoding="utf-8") as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+class OtlpExporter:
+    """Posts finished spans to an OTLP/HTTP collector as JSON"""
+    
+    def __init__(self, endpoint, service_name="outfitify", timeout=5):
+        self.endpoint = endpoint.rstrip("/")
+        if not self.endpoint.endswith("/v1/traces"):
+            self.endpoint += "/v1/traces"
+        self.service_name = service_name
+        self.timeout = timeout
+    
+    @staticmethod
+    def _attribute(key, value):
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+    
+    def _span(self, span):
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [self._attribute(key, value) for key, value in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+    
+    def export(self, spans):
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "outfitify"}, "spans": [self._span(span) for span in spans]}]
+        }]}
+        response = requests.post(self.endpoint, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+
+class Tracer:
+    """Per-update request tracing with head sampling
+    
+    trace() opens the root span for one update and decides whether it is
+    sampled; span() opens child spans under whatever is current. Outside a
+    sampled trace both are a context-variable lookup and nothing else.
+    Finished spans are exported in batches from a background thread.
+    """
+    
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, exporter=None,
+                 batch_size=TRACE_BATCH_SIZE, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+    
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 and self.exporter is not None
+    
+    @contextmanager
+    def trace(self, name, **attributes):
+        """Start a new trace for one update, sampled with probability sample_rate"""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            yield NOOP_SPAN
+            return
+        
+        with self._open(os.urandom(16).hex(), None, name, attributes) as span:
+            yield span
+    
+    @contextmanager
+    def span(self, name, **attributes):
+        """Open a child span of the current span, if the current update is being traced"""
+        parent = _current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        
+        with self._open(parent.trace_id, parent.span_id, name, attributes) as span:
+            yield span
+    
+    @contextmanager
+    def _open(self, trace_id, parent_id, name, attributes):
+        span = Span(trace_id, parent_id, name, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self._finish(span)
+    
+    def traced(self, name):
+        """Decorator opening a span around every call of a function"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return function(*args, **kwargs)
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def current_trace_id(self):
+        span = _current_span.get()
+        return span.trace_id if span else None
+    
+    def _finish(self, span):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+    
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._export(batch)
+    
+    def _export(self, batch):
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            print(f"Error exporting {len(batch)} trace spans: {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+    
+    def flush(self, timeout=5):
+        """Wait until queued spans have been exported"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+def create_exporter():
+    """Exporter chosen by the tracing settings"""
+    if TRACE_OTLP_ENDPOINT:
+        return OtlpExporter(TRACE_OTLP_ENDPOINT)
+    if TRACE_FILE:
+        return JsonlExporter(TRACE_FILE)
+    return None
+
+tracer = Tracer(exporter=create_exporter())
+
+def instrument_telegram(apihelper):
+    """Open a span around every Bot API request made during a traced update"""
+    make_request = apihelper._make_request
+    
+    def traced_request(token, method_name, *args, **kwargs):
+        with tracer.span(f"telegram.{method_name}"):
+            return make_request(token, method_name, *args, **kwargs)
+    
+    apihelper._make_request = traced_request
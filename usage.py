@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import deque
+from datetime import date
+
+from config import (AI_USER_DAILY_TOKEN_QUOTA, AI_USER_RATE_LIMIT, AI_USER_RATE_WINDOW,
+                    AI_DAILY_TOKEN_BUDGET, USAGE_FLUSH_INTERVAL, USAGE_FLUSH_BATCH, AI_SYSTEM_USER_ID)
+import metrics
+
+class QuotaExceededError(Exception):
+    """Raised before an AI call the user (or the bot as a whole) has no budget left for"""
+    
+    def __init__(self, reason, message, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+
+class UsageTracker:
+    """Per-user OpenAI token accounting with quotas and sliding-window rate limits
+    
+    Usage is aggregated in memory and written to the ai_usage table in batches
+    by a background thread, so recording a call never waits on SQLite. Daily
+    totals are loaded from the database once per user and day, then kept up to
+    date in memory, so quota checks are dictionary lookups.
+    """
+    
+    def __init__(self, db, daily_token_quota=AI_USER_DAILY_TOKEN_QUOTA, rate_limit=AI_USER_RATE_LIMIT,
+                 rate_window=AI_USER_RATE_WINDOW, daily_token_budget=AI_DAILY_TOKEN_BUDGET,
+                 flush_interval=USAGE_FLUSH_INTERVAL, flush_batch=USAGE_FLUSH_BATCH):
+        self.db = db
+        self.daily_token_quota = daily_token_quota
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.daily_token_budget = daily_token_budget
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        
+        self._pending = {}  # (user_id, day, method) -> [prompt_tokens, completion_tokens, requests]
+        self._user_tokens = {}  # (user_id, day) -> tokens used, flushed or not
+        self._total_tokens = {}  # day -> tokens used by everyone
+        self._windows = {}  # user_id -> timestamps of recent requests
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        
+        metrics.QUEUE_DEPTH.set_function(self.buffered, queue="usage_writes")
+    
+    def buffered(self):
+        """Usage rows waiting to be written"""
+        return len(self._pending)
+    
+    def start(self):
+        """Start the background writer"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+            self._thread.start()
+    
+    def stop(self):
+        """Stop the background writer and write whatever is still buffered"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+    
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def _tokens_for(self, cache, key, load):
+        """Get a day's running total, loading the flushed part from the database on first use"""
+        tokens = cache.get(key)
+        if tokens is None:
+            loaded = load()
+            with self._lock:
+                tokens = cache.setdefault(key, loaded)
+        return tokens
+    
+    def _user_total(self, user_id, day):
+        return self._tokens_for(self._user_tokens, (user_id, day),
+                                lambda: self.db.get_ai_usage_tokens(day, user_id))
+    
+    def _day_total(self, day):
+        return self._tokens_for(self._total_tokens, day, lambda: self.db.get_ai_usage_tokens(day))
+    
+    def check(self, user_id, reserve=True):
+        """Reserve a request slot for the user, raising QuotaExceededError if over a limit
+        
+        With reserve=False nothing is reserved, e.g. to check before a batch of calls.
+        """
+        day = date.today().isoformat()
+        
+        if self.daily_token_budget and self._day_total(day) >= self.daily_token_budget:
+            metrics.AI_QUOTA_REJECTIONS.inc(reason="budget")
+            raise QuotaExceededError("budget", "⏳ The AI stylist is at capacity for today. Please try again tomorrow!")
+        
+        # The bot's own calls only count against the daily budget
+        if user_id is None or user_id == AI_SYSTEM_USER_ID:
+            return
+        
+        if self.daily_token_quota and self._user_total(user_id, day) >= self.daily_token_quota:
+            metrics.AI_QUOTA_REJECTIONS.inc(reason="daily_quota")
+            raise QuotaExceededError("daily_quota", "⏳ You've used today's AI allowance. It resets at midnight!")
+        
+        if not self.rate_limit:
+            return
+        
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.setdefault(user_id, deque())
+            while window and window[0] <= now - self.rate_window:
+                window.popleft()
+            if len(window) >= self.rate_limit:
+                retry_after = max(1, int(window[0] + self.rate_window - now) + 1)
+                metrics.AI_QUOTA_REJECTIONS.inc(reason="rate_limit")
+                raise QuotaExceededError(
+                    "rate_limit", f"⏳ Too many AI requests at once. Please wait {retry_after}s and try again!",
+                    retry_after=retry_after)
+            if reserve:
+                window.append(now)
+    
+    def record(self, user_id, method, prompt_tokens, completion_tokens):
+        """Buffer the token usage of one completed call"""
+        day = date.today().isoformat()
+        tokens = prompt_tokens + completion_tokens
+        self._day_total(day)
+        if user_id is not None:
+            self._user_total(user_id, day)
+        
+        with self._lock:
+            self._total_tokens[day] = self._total_tokens.get(day, 0) + tokens
+            if user_id is not None:
+                self._user_tokens[(user_id, day)] = self._user_tokens.get((user_id, day), 0) + tokens
+                pending = self._pending.setdefault((user_id, day, method), [0, 0, 0])
+                pending[0] += prompt_tokens
+                pending[1] += completion_tokens
+                pending[2] += 1
+            buffered = len(self._pending)
+        
+        if buffered >= self.flush_batch:
+            self._wakeup.set()
+    
+    def flush(self):
+        """Write buffered usage to the database"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._forget_old_days()
+            if not pending:
+                return
+            
+            rows = [(user_id, day, method, *counts) for (user_id, day, method), counts in pending.items()]
+            try:
+                self.db.add_ai_usage(rows)
+            except Exception as e:
+                print(f"Error saving AI usage: {e}")
+                # Keep the rows for the next attempt
+                with self._lock:
+                    for key, counts in pending.items():
+                        current = self._pending.setdefault(key, [0, 0, 0])
+                        for i, count in enumerate(counts):
+                            current[i] += count
+    
+    def _forget_old_days(self):
+        """Drop in-memory totals of past days and idle rate-limit windows (called with the lock held)"""
+        today = date.today().isoformat()
+        for key in [key for key in self._user_tokens if key[1] != today]:
+            del self._user_tokens[key]
+        for day in [day for day in self._total_tokens if day != today]:
+            del self._total_tokens[day]
+        
+        cutoff = time.monotonic() - self.rate_window
+        for user_id in [user_id for user_id, window in self._windows.items() if not window or window[-1] <= cutoff]:
+            del self._windows[user_id]
+    
+    def get_usage(self, user_id):
+        """Tokens the user has used today"""
+        return self._user_total(user_id, date.today().isoformat())
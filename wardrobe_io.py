@@ -0,0 +1,376 @@
+"""
+Export and import wardrobes as JSON Lines, optionally zipped with their photos
+
+While the bot is running, use /export and /import instead: an import from
+here skips the bot's in-memory caches. Exporting is safe at any time.
+
+Usage:
+    python wardrobe_io.py export USER_ID FILE [--photos]
+    python wardrobe_io.py import USER_ID FILE
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+from datetime import datetime
+
+from config import (PHOTOS_DIR, MAX_PHOTO_SIZE, EXPORT_BATCH_SIZE, IMPORT_CHUNK_SIZE, IMPORT_MAX_ITEMS,
+                    IMPORT_MAX_LINE)
+
+FORMAT = "outfitify_wardrobe"
+FORMAT_VERSION = 1
+
+# Name of the JSON Lines file inside a zipped export
+WARDROBE_FILE = "wardrobe.jsonl"
+
+def photo_entry(item):
+    """Where an item's photo goes in a zipped export, or None if it has no photo on disk"""
+    if not item.get('photo_path') or not os.path.isfile(item['photo_path']):
+        return None
+    return f"photos/{os.path.basename(item['photo_path'])}"
+
+def _write_records(db, user_id, stream, counts, photos, batch_size):
+    """Write the header, preferences, items and outfits, one JSON object per line"""
+    def write(record):
+        stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    
+    write({"type": FORMAT, "version": FORMAT_VERSION, "exported_at": datetime.now().isoformat(timespec="seconds")})
+    
+    preferences = db.get_user_preferences(user_id)
+    if preferences:
+        write({"type": "preferences", "style": preferences[1], "color": preferences[2], "season": preferences[3]})
+    
+    for item in db.iter_clothes(user_id, batch_size):
+        record = {"type": "item", "id": item['id'], "name": item['name'], "category": item['category'],
+                  "description": item['description'], "tags": item['tags'], "season": item['season'],
+                  "occasion": item['occasion'], "created_at": item['created_at'],
+                  "photo_file_id": item['photo_file_id'], "photo_unique_id": item['photo_unique_id'],
+                  "photo_hash": f"{item['photo_hash']:016x}" if item['photo_hash'] is not None else None}
+        if photos:
+            record["photo"] = photo_entry(item)
+        write(record)
+        counts["items"] += 1
+    
+    for archived in (False, True):
+        for outfit in db.iter_outfits(user_id, batch_size, archived=archived):
+            write({"type": "outfit", "id": outfit[0], "name": outfit[2], "description": outfit[3],
+                   "items": json.loads(outfit[4]) if outfit[4] else [], "season": outfit[5], "occasion": outfit[6],
+                   "created_at": outfit[7]})
+            counts["outfits"] += 1
+
+def export_wardrobe(db, user_id, destination, photos=False, batch_size=EXPORT_BATCH_SIZE):
+    """Write a user's wardrobe to a JSON Lines file, or to a zip with the photos as well
+    
+    Rows are read and written batch_size at a time, so memory use doesn't
+    grow with the wardrobe. Returns counts of items, outfits and photos.
+    """
+    counts = {"items": 0, "outfits": 0, "photos": 0}
+    if not photos:
+        with open(destination, "w", encoding="utf-8") as stream:
+            _write_records(db, user_id, stream, counts, False, batch_size)
+        return counts
+    
+    with zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED) as archive:
+        with io.TextIOWrapper(archive.open(WARDROBE_FILE, "w", force_zip64=True), encoding="utf-8") as stream:
+            _write_records(db, user_id, stream, counts, True, batch_size)
+        
+        # A zip is written one entry at a time, so the photos take a second pass over the clothes
+        written = set()
+        for item in db.iter_clothes(user_id, batch_size):
+            entry = photo_entry(item)
+            if entry is None or entry in written:
+                continue
+            try:
+                # JPEGs are already compressed
+                archive.write(item['photo_path'], entry, compress_type=zipfile.ZIP_STORED)
+            except OSError as e:
+                print(f"Error exporting photo {item['photo_path']}: {e}")
+                continue
+            written.add(entry)
+            counts["photos"] += 1
+    return counts
+
+def _read_lines(stream, limit=IMPORT_MAX_LINE):
+    """Lines of a text stream, read at most `limit` characters at a time; overlong lines come out as None"""
+    while True:
+        line = stream.readline(limit)
+        if not line:
+            return
+        if len(line) >= limit and not line.endswith("\n"):
+            while line and not line.endswith("\n"):
+                line = stream.readline(limit)
+            yield None
+            continue
+        yield line
+
+def _normalize(text):
+    return " ".join(str(text or "").lower().split())
+
+def item_key(item):
+    """Digest identifying an item as a garment: its Telegram photo, else its text
+    
+    Photo hashes aren't compared: similar photos of different garments can
+    hash alike, and unlike a photo upload, an import can't ask the user.
+    """
+    if item.get('photo_unique_id'):
+        key = ("photo", item['photo_unique_id'])
+    else:
+        key = ("text", _normalize(item.get('name')), _normalize(item.get('category')), _normalize(item.get('description')))
+    # Short digests keep the index of a large wardrobe small
+    return hashlib.sha1(repr(key).encode("utf-8")).digest()[:12]
+
+def outfit_key(name, item_ids):
+    return (_normalize(name), tuple(sorted(set(item_ids))))
+
+class WardrobeImporter:
+    """Adds the records of an export to a user's wardrobe in chunked transactions
+    
+    Items already in the wardrobe (or earlier in the file) are skipped, and
+    outfits that use them point at the item that was kept. Only digests of the
+    existing items and a map of exported to new item IDs are held in memory.
+    """
+    
+    def __init__(self, db, user_id, archive=None, photos_dir=PHOTOS_DIR, chunk_size=IMPORT_CHUNK_SIZE,
+                 max_items=IMPORT_MAX_ITEMS):
+        self.db = db
+        self.user_id = user_id
+        self.archive = archive
+        self.photos_dir = photos_dir
+        self.chunk_size = chunk_size
+        self.max_items = max_items
+        self.counts = {"items": 0, "duplicates": 0, "outfits": 0, "photos": 0, "skipped": 0, "preferences": False}
+        self._seen = {}  # item digest -> ID in the database, or None while the item waits in _items
+        self._ids = {}  # exported item ID -> ID in the database
+        self._aliases = {}  # exported item ID -> exported ID of a pending item it duplicates
+        self._items = []  # (exported ID, item, digest) waiting to be written
+        self._outfits = []  # outfits waiting to be written
+        self._outfit_keys = set()
+        self._photos = {}  # zip entry -> extracted path
+    
+    def _load_existing(self):
+        for item in self.db.iter_clothes(self.user_id):
+            self._seen.setdefault(item_key(item), item['id'])
+        for archived in (False, True):
+            for outfit in self.db.iter_outfits(self.user_id, archived=archived):
+                self._outfit_keys.add(outfit_key(outfit[2], json.loads(outfit[4]) if outfit[4] else []))
+    
+    def run(self, stream):
+        """Import every record of a text stream; returns the counts"""
+        lines = _read_lines(stream)
+        header = self._parse(next(lines, None))
+        if not header or header.get("type") != FORMAT:
+            raise ValueError("This isn't an Outfitify wardrobe export")
+        if not isinstance(header.get("version"), int) or header["version"] > FORMAT_VERSION:
+            raise ValueError("This export was made by a newer version of Outfitify")
+        
+        self._load_existing()
+        for line in lines:
+            if line is not None and not line.strip():
+                continue
+            record = self._parse(line)
+            kind = record.get("type") if record else None
+            if kind == "item":
+                if self.counts["items"] + self.counts["duplicates"] >= self.max_items:
+                    self.counts["skipped"] += 1
+                    continue
+                self._add_item(record)
+            elif kind == "outfit":
+                self._add_outfit(record)
+            elif kind == "preferences":
+                self._set_preferences(record)
+            else:
+                self.counts["skipped"] += 1
+        
+        self._flush_items()
+        self._flush_outfits()
+        return self.counts
+    
+    def _parse(self, line):
+        if line is None:
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        return record if isinstance(record, dict) else None
+    
+    def _add_item(self, record):
+        name = record.get("name")
+        category = record.get("category")
+        if not isinstance(name, str) or not name.strip() or not isinstance(category, str) or not category.strip():
+            self.counts["skipped"] += 1
+            return
+        
+        try:
+            photo_hash = int(record["photo_hash"], 16) if record.get("photo_hash") else None
+        except (TypeError, ValueError):
+            photo_hash = None
+        tags = record.get("tags")
+        item = {
+            'name': name.strip(),
+            'category': category.strip().lower(),
+            'description': record.get("description") if isinstance(record.get("description"), str) else None,
+            'tags': [str(tag) for tag in tags] if isinstance(tags, list) else None,
+            'season': record.get("season"),
+            'occasion': record.get("occasion"),
+            'created_at': record.get("created_at"),
+            'photo_file_id': record.get("photo_file_id"),
+            'photo_unique_id': record.get("photo_unique_id"),
+            'photo_hash': photo_hash
+        }
+        exported_id = record.get("id")
+        
+        key = item_key(item)
+        if key in self._seen:
+            self.counts["duplicates"] += 1
+            if exported_id is not None:
+                if self._seen[key] is not None:
+                    self._ids[exported_id] = self._seen[key]
+                else:
+                    self._aliases[exported_id] = next(pending_id for pending_id, _, pending_key in self._items
+                                                      if pending_key == key)
+            return
+        
+        item['photo_path'] = self._extract_photo(record.get("photo"))
+        self._seen[key] = None
+        self._items.append((exported_id, item, key))
+        if len(self._items) >= self.chunk_size:
+            self._flush_items()
+    
+    def _extract_photo(self, entry):
+        """Copy a photo out of the zip into the photos directory; returns its path or None"""
+        if self.archive is None or not isinstance(entry, str):
+            return None
+        if entry in self._photos:
+            return self._photos[entry]
+        
+        # Only the file name is used, so entries can't write outside the photos directory
+        filename = os.path.basename(entry)
+        try:
+            info = self.archive.getinfo(entry)
+        except KeyError:
+            return None
+        if not filename or info.file_size > MAX_PHOTO_SIZE:
+            return None
+        
+        path = os.path.join(self.photos_dir, f"{self.user_id}_{int(time.time())}_{filename}")
+        try:
+            os.makedirs(self.photos_dir, exist_ok=True)
+            with self.archive.open(info) as source, open(path, "wb") as target:
+                shutil.copyfileobj(source, target)
+        except (OSError, zipfile.BadZipFile) as e:
+            print(f"Error importing photo {entry}: {e}")
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        
+        self._photos[entry] = path
+        self.counts["photos"] += 1
+        return path
+    
+    def _flush_items(self):
+        if not self._items:
+            return
+        new_ids = self.db.add_clothing_items(self.user_id, [item for _, item, _ in self._items])
+        for (exported_id, _, key), item_id in zip(self._items, new_ids):
+            self._seen[key] = item_id
+            if exported_id is not None:
+                self._ids[exported_id] = item_id
+        for exported_id, pending_id in self._aliases.items():
+            if pending_id in self._ids:
+                self._ids[exported_id] = self._ids[pending_id]
+        self._aliases.clear()
+        self.counts["items"] += len(new_ids)
+        self._items = []
+    
+    def _add_outfit(self, record):
+        name = record.get("name")
+        items = record.get("items")
+        if not isinstance(name, str) or not name.strip() or not isinstance(items, list):
+            self.counts["skipped"] += 1
+            return
+        self._outfits.append(record)
+        if len(self._outfits) >= self.chunk_size:
+            self._flush_outfits()
+    
+    def _flush_outfits(self):
+        if not self._outfits:
+            return
+        # Outfits can only be resolved once the items they use are written
+        self._flush_items()
+        
+        outfits = []
+        for record in self._outfits:
+            clothes_ids = []
+            for exported_id in record["items"]:
+                item_id = self._ids.get(exported_id)
+                if item_id is not None and item_id not in clothes_ids:
+                    clothes_ids.append(item_id)
+            key = outfit_key(record["name"], clothes_ids)
+            if not clothes_ids or key in self._outfit_keys:
+                self.counts["skipped"] += 1
+                continue
+            self._outfit_keys.add(key)
+            outfits.append({'name': record["name"].strip(), 'description': record.get("description"),
+                            'clothes_ids': clothes_ids, 'season': record.get("season"),
+                            'occasion': record.get("occasion"), 'created_at': record.get("created_at")})
+        
+        self.counts["outfits"] += len(self.db.save_outfits(self.user_id, outfits))
+        self._outfits = []
+    
+    def _set_preferences(self, record):
+        # Preferences the user already set win over imported ones
+        if self.counts["preferences"] or self.db.get_user_preferences(self.user_id):
+            return
+        self.db.update_user_preferences(self.user_id, record.get("style"), record.get("color"), record.get("season"))
+        self.counts["preferences"] = True
+
+def import_wardrobe(db, user_id, source, photos_dir=PHOTOS_DIR, chunk_size=IMPORT_CHUNK_SIZE):
+    """Add the wardrobe in an export file (JSON Lines or zip) to a user's wardrobe; returns counts
+    
+    Raises ValueError if the file isn't an Outfitify export.
+    """
+    if not zipfile.is_zipfile(source):
+        with open(source, encoding="utf-8-sig", errors="replace") as stream:
+            return WardrobeImporter(db, user_id, None, photos_dir, chunk_size).run(stream)
+    
+    with zipfile.ZipFile(source) as archive:
+        try:
+            raw = archive.open(WARDROBE_FILE)
+        except KeyError:
+            raise ValueError(f"The zip has no {WARDROBE_FILE}")
+        with io.TextIOWrapper(raw, encoding="utf-8-sig", errors="replace") as stream:
+            return WardrobeImporter(db, user_id, archive, photos_dir, chunk_size).run(stream)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a user's wardrobe")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Write a wardrobe to a .jsonl file (or .zip with --photos)")
+    export.add_argument("user_id", type=int)
+    export.add_argument("file")
+    export.add_argument("--photos", action="store_true", help="Zip the photos together with the wardrobe")
+    imports = commands.add_parser("import", help="Add the wardrobe in an export file to a user (stop the bot first)")
+    imports.add_argument("user_id", type=int)
+    imports.add_argument("file")
+    args = parser.parse_args()
+    
+    from database import Database
+    db = Database()
+    start = time.perf_counter()
+    if args.command == "export":
+        counts = export_wardrobe(db, args.user_id, args.file, photos=args.photos)
+        print(f"✅ Exported {counts['items']} items, {counts['outfits']} outfits and {counts['photos']} photos "
+              f"in {time.perf_counter() - start:.1f}s")
+    else:
+        counts = import_wardrobe(db, args.user_id, args.file)
+        print(f"✅ Imported {counts['items']} items ({counts['duplicates']} already there), {counts['outfits']} outfits "
+              f"and {counts['photos']} photos in {time.perf_counter() - start:.1f}s"
+              + (f"; skipped {counts['skipped']} records" if counts['skipped'] else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import math
+import re
+import threading
+import zlib
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from config import SEARCH_VECTOR_DIM, SEARCH_CACHE_SIZE
+import metrics
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+# Everyday words mapped to words items are usually described with
+QUERY_EXPANSIONS = {
+    "warm": ["wool", "fleece", "knit", "sweater", "coat", "winter", "thermal", "puffer"],
+    "cold": ["wool", "coat", "winter", "scarf", "boots", "puffer"],
+    "cozy": ["knit", "fleece", "sweater", "hoodie", "wool"],
+    "rain": ["raincoat", "waterproof", "boots", "jacket", "trench"],
+    "rainy": ["raincoat", "waterproof", "boots", "jacket", "trench"],
+    "hot": ["linen", "shorts", "summer", "tank", "sandals", "light"],
+    "summer": ["linen", "shorts", "sandals", "light"],
+    "office": ["business", "formal", "blazer", "shirt", "trousers", "loafers"],
+    "work": ["business", "blazer", "shirt", "trousers"],
+    "wedding": ["formal", "suit", "dress", "heels"],
+    "party": ["party", "dress", "heels", "sequin"],
+    "gym": ["sport", "sneakers", "leggings", "shorts"],
+    "running": ["sport", "sneakers", "running"]
+}
+
+def item_text(item):
+    """The text an item is indexed under"""
+    parts = [item.get("name"), item.get("category"), item.get("description"),
+             " ".join(item.get("tags") or []), item.get("season"), item.get("occasion")]
+    return " ".join(part for part in parts if part)
+
+def expand_query(text):
+    words = _WORD.findall(text.lower())
+    return " ".join(words + [extra for word in words for extra in QUERY_EXPANSIONS.get(word, ())])
+
+class HashingEmbedder:
+    """Term counts of words and character trigrams, hashed into a fixed number of dimensions
+    
+    Trigrams let "sneaker" match "sneakers" and survive typos; a second hash
+    picks the sign so colliding features tend to cancel out rather than add up.
+    """
+    uses_idf = True
+    
+    def __init__(self, dim=SEARCH_VECTOR_DIM):
+        self.dim = dim
+    
+    def _features(self, text):
+        words = _WORD.findall(text.lower())
+        features = [f"w:{word}" for word in words]
+        for word in words:
+            padded = f" {word} "
+            features.extend(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+    
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self._features(text)).items():
+                digest = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dim] += sign * (1 + math.log(count))
+        return vectors
+
+class VectorIndex:
+    """One user's item vectors in a float32 matrix that grows in place
+    
+    Adding or changing an item writes one row; removing one moves the last
+    row into its place. With a hashing embedder, document frequencies are
+    kept per dimension so queries are weighted by TF-IDF without re-embedding.
+    """
+    
+    def __init__(self, embedder, clothes=()):
+        self.embedder = embedder
+        self.vectors = np.zeros((max(8, len(clothes)), embedder.dim), dtype=np.float32)
+        self.doc_freq = np.zeros(embedder.dim, dtype=np.int32)
+        self.item_ids = []
+        self.items = {}
+        self._rows = {}
+        if clothes:
+            self._append_many(list(clothes))
+    
+    def __len__(self):
+        return len(self.item_ids)
+    
+    def _append_many(self, clothes):
+        vectors = self.embedder.embed([item_text(item) for item in clothes])
+        for item, vector in zip(clothes, vectors):
+            self._append(item, vector)
+    
+    def _append(self, item, vector):
+        row = len(self.item_ids)
+        if row == len(self.vectors):
+            grown = np.zeros((2 * row, self.vectors.shape[1]), dtype=np.float32)
+            grown[:row] = self.vectors
+            self.vectors = grown
+        self.vectors[row] = vector
+        self.doc_freq += vector != 0
+        self.item_ids.append(item["id"])
+        self.items[item["id"]] = item
+        self._rows[item["id"]] = row
+    
+    def add(self, item):
+        """Index a new item, or re-index a changed one"""
+        self.remove(item["id"])
+        self._append(item, self.embedder.embed([item_text(item)])[0])
+    
+    def remove(self, item_id):
+        row = self._rows.pop(item_id, None)
+        if row is None:
+            return
+        self.doc_freq -= self.vectors[row] != 0
+        del self.items[item_id]
+        
+        last = len(self.item_ids) - 1
+        if row != last:
+            self.vectors[row] = self.vectors[last]
+            self.item_ids[row] = self.item_ids[last]
+            self._rows[self.item_ids[row]] = row
+        self.vectors[last] = 0
+        self.item_ids.pop()
+    
+    def search(self, query, k=5):
+        """The k items most similar to the query as (cosine score, item), best first"""
+        count = len(self.item_ids)
+        if not count:
+            return []
+        
+        query_vector = self.embedder.embed([expand_query(query)])[0]
+        matrix = self.vectors[:count]
+        if self.embedder.uses_idf:
+            weights = np.log((1 + count) / (1 + self.doc_freq)).astype(np.float32) + 1
+            matrix = matrix * weights
+            query_vector = query_vector * weights
+        
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query_vector) or 1.0)
+        scores = matrix @ query_vector / np.where(norms == 0, 1.0, norms)
+        
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[row]), self.items[self.item_ids[row]]) for row in top if scores[row] > 0]
+
+class WardrobeSearch:
+    """Semantic search over users' wardrobes, kept up to date through Database change hooks
+    
+    `embedder` may be any object with a `dim`, a `uses_idf` flag and an
+    `embed(texts)` method returning a float32 array, such as a wrapper
+    around a local sentence-embedding model.
+    """
+    
+    def __init__(self, db, embedder=None, cache_size=SEARCH_CACHE_SIZE):
+        self.db = db
+        self.embedder = embedder or HashingEmbedder()
+        self.cache_size = cache_size
+        self._indexes = OrderedDict()  # user_id -> (wardrobe version, index)
+        self._lock = threading.Lock()
+    
+    def cached_indexes(self):
+        """Number of user indexes held in memory"""
+        return len(self._indexes)
+    
+    def get_index(self, user_id, clothes=None):
+        """The user's index, built from `clothes` (or the database) if it isn't in memory"""
+        version = self.db.get_wardrobe_version(user_id)
+        with self._lock:
+            cached = self._indexes.get(user_id)
+            if cached and cached[0] == version:
+                self._indexes.move_to_end(user_id)
+                metrics.cache_result("search_index", True)
+                return cached[1]
+        
+        metrics.cache_result("search_index", False)
+        index = VectorIndex(self.embedder, clothes if clothes is not None else self.db.get_user_clothes(user_id))
+        with self._lock:
+            self._indexes[user_id] = (version, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.cache_size:
+                self._indexes.popitem(last=False)
+        return index
+    
+    def on_change(self, user_id, action, item_id):
+        """Database change hook: re-index the one item that changed in the user's cached index"""
+        with self._lock:
+            if action == "reload":
+                self._indexes.pop(user_id, None)
+                return
+            cached = self._indexes.get(user_id)
+        if cached is None:
+            return
+        
+        item = self.db.get_clothing_item(user_id, item_id) if action != "delete" else None
+        with self._lock:
+            index = cached[1]
+            if item is None:
+                index.remove(item_id)
+            else:
+                index.add(item)
+            self._indexes[user_id] = (self.db.get_wardrobe_version(user_id), index)
+    
+    def search(self, user_id, query, k=5, clothes=None):
+        """The user's k items most relevant to the query as (score, item), best first"""
+        index = self.get_index(user_id, clothes)
+        with self._lock:
+            return index.search(query, k)
+    
+    def relevant_items(self, user_id, query, limit, clothes=None):
+        """Up to `limit` items for a prompt: the most relevant ones, spread over every category"""
+        index = self.get_index(user_id, clothes)
+        with self._lock:
+            ranked = index.search(query, len(index))
+            ranked_ids = {item["id"] for _, item in ranked}
+            # Items that share no words with the query still count, after the matches
+            ranked += [(0.0, item) for item in index.items.values() if item["id"] not in ranked_ids]
+        
+        by_category = OrderedDict()
+        for _, item in ranked:
+            by_category.setdefault(item.get("category"), []).append(item)
+        
+        # Round-robin over categories so a request about shoes still leaves tops to pair them with
+        selected = []
+        while len(selected) < limit and any(by_category.values()):
+            for items in by_category.values():
+                if items and len(selected) < limit:
+                    selected.append(items.pop(0))
+        return selected